@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+"""
+Offline benchmarks for the VNC to Flaschen-Taschen bridge.
+
+Usage:
+  python bench.py receive --chunk 1460
+  python bench.py hextile --width 1920 --height 1080
+  python bench.py scale --damage 16
+  python bench.py des
+  python bench.py replay --paced session.rec.gz
+  python bench.py e2e --workload scroll --seconds 10
+
+MIT License
+"""
+
+from twisted.python import usage
+from twisted.internet.protocol import Protocol
+from twisted.test import proto_helpers
+from twisted.internet.address import IPv4Address
+
+# PIL
+from PIL import Image
+
+#std stuff
+import sys, os, struct, time, random, math, signal, shlex, subprocess
+
+import numpy
+
+#local
+import rfb
+import fastdes
+import framebuffer
+import flaschenvnc
+import flaschen
+import rfbrecord
+import fakevnc
+import fakeflaschen
+
+class NullClient(rfb.RFBClient):
+    """RFBClient that drops all display updates"""
+
+    def fillRectangle(self, x, y, width, height, color):
+        pass
+
+class PILClient(rfb.RFBClient):
+    """RFBClient that paints into a PIL image the way flaschenvnc did"""
+
+    def vncConnectionMade(self):
+        self.fb = Image.new('RGB', (self.width, self.height))
+
+    def updateRectangle(self, x, y, width, height, data):
+        self.fb.paste(Image.frombytes('RGBA', (width, height), data.tobytes()), (x, y))
+
+    def fillRectangle(self, x, y, width, height, color):
+        self.fb.paste(struct.unpack("BBBB", color), (x, y, x + width, y + height))
+
+class FramebufferClient(rfb.RFBClient):
+    """RFBClient that paints into a framebuffer.Framebuffer the way
+       flaschenvnc does, hextile straight into its array"""
+
+    def vncConnectionMade(self):
+        self.fb = framebuffer.Framebuffer(self.width, self.height)
+
+    def rectangleTarget(self, x, y, width, height):
+        return self.fb.target(x, y, width, height)
+
+    def updateRectangle(self, x, y, width, height, data):
+        self.fb.update(x, y, width, height, data)
+
+    def fillRectangle(self, x, y, width, height, color):
+        self.fb.fill(x, y, width, height, color)
+
+def connectedClient(cls, width=1920, height=1080):
+    """return a protocol instance that is past the handshake, in the
+       state where it waits for the next server message"""
+    client = cls()
+    if isinstance(client, Protocol):
+        client.makeConnection(proto_helpers.StringTransport())
+    client.width, client.height = width, height
+    client.setPixelFormat()
+    client.data_to_send()
+    if isinstance(client, Protocol):
+        client.transport.clear()
+    client.vncConnectionMade()
+    client._handler = client._handleExpected
+    client.expect(client._handleConnection, 1)
+    return client
+
+def hextileStream(rectangles, subrects=4, per_update=1000):
+    """FramebufferUpdates made of many small 16x16 hextile rectangles,
+       each a single tile with a background and a few foreground subrects"""
+    tile = struct.pack("!B4s4sB", 2 | 4 | 8, "\x10\x20\x30\x00", "\xff\xff\xff\x00", subrects)
+    tile += "".join([struct.pack("!BB", (i << 4) | i, 0x11) for i in xrange(subrects)])
+    data = []
+    for i in xrange(rectangles):
+        if i % per_update == 0:
+            data.append(struct.pack("!BxH", 0, min(per_update, rectangles - i)))
+        x = (i * 16) % 1920
+        y = ((i * 16) // 1920 * 16) % 1072
+        data.append(struct.pack("!HHHHI", x, y, 16, 16, rfb.HEXTILE_ENCODING))
+        data.append(tile)
+    return "".join(data)
+
+def hextileScreen(width, height, seed=0):
+    """one FramebufferUpdate covering the screen with a hextile rectangle,
+       tiles are a mix of solid, foreground subrects, coloured subrects
+       and raw like a desktop UI"""
+    rnd = random.Random(seed)
+    def color():
+        return struct.pack("BBBB", rnd.randrange(256), rnd.randrange(256), rnd.randrange(256), 0)
+    data = [struct.pack("!BxH", 0, 1), struct.pack("!HHHHI", 0, 0, width, height, rfb.HEXTILE_ENCODING)]
+    for ty in xrange(0, height, 16):
+        for tx in xrange(0, width, 16):
+            tw, th = min(16, width - tx), min(16, height - ty)
+            kind = rnd.random()
+            if kind < 0.5:
+                data.append(struct.pack("!B", 2) + color())
+            elif kind < 0.95:
+                coloured = kind >= 0.8 and 16 or 4
+                subrects = rnd.randrange(1, 12)
+                tile = [struct.pack("!B", 2 | 8 | coloured) + color()]
+                if coloured == 4:
+                    tile.append(color())
+                tile.append(struct.pack("!B", subrects))
+                for i in xrange(subrects):
+                    if coloured == 16:
+                        tile.append(color())
+                    sx, sy = rnd.randrange(tw), rnd.randrange(th)
+                    sw, sh = rnd.randrange(1, tw - sx + 1), rnd.randrange(1, th - sy + 1)
+                    tile.append(struct.pack("!BB", sx << 4 | sy, (sw - 1) << 4 | (sh - 1)))
+                data.append("".join(tile))
+            else:
+                data.append(struct.pack("!B", 1) + "".join([color() for i in xrange(tw * th)]))
+    return "".join(data)
+
+def feed(client, data, chunk):
+    for pos in xrange(0, len(data), chunk):
+        client.feed(data[pos:pos+chunk])
+
+def benchReceive(opts):
+    print "%10s %12s %12s %8s %10s" % ("rects", "received", "copied", "ratio", "MB/s")
+    for rectangles in opts['rects']:
+        data = hextileStream(rectangles)
+        client = connectedClient(opts['core'] and rfb.RFBClientCore or NullClient)
+        start = time.time()
+        feed(client, data, opts['chunk'])
+        elapsed = time.time() - start
+        print "%10d %12d %12d %8.3f %10.1f" % (
+            rectangles, client.bytes_received, client.bytes_copied,
+            float(client.bytes_copied) / client.bytes_received,
+            client.bytes_received / elapsed / 1e6)
+
+def benchHextile(opts):
+    width, height = opts['width'], opts['height']
+    data = hextileScreen(width, height)
+    tiles = ((width + 15) // 16) * ((height + 15) // 16)
+    print "%dx%d, %d tiles, %d bytes" % (width, height, tiles, len(data))
+    print "%12s %8s %12s %10s" % ("decoder", "sink", "tiles/s", "ms/frame")
+    for sink, cls in (("null", NullClient), ("PIL", PILClient), ("fb", FramebufferClient)):
+        for name, batch in (("per-tile", False), ("batch", True)):
+            client = connectedClient(cls, width, height)
+            client.batch_hextile = batch
+            start = time.time()
+            for i in xrange(opts['frames']):
+                feed(client, data, opts['chunk'])
+            elapsed = (time.time() - start) / opts['frames']
+            print "%12s %8s %12.0f %10.1f" % (name, sink, tiles / elapsed, elapsed * 1000)
+
+# screen sizes for the scale benchmark
+SCREENS = [("1080p", 1920, 1080), ("1440p", 2560, 1440), ("4K", 3840, 2160)]
+
+def benchScale(opts):
+    led = (opts['width'], opts['height'])
+    print "%dx%d LEDs, damaged rectangles of %d%% of the screen" % (led + (opts['damage'],))
+    print "%8s %10s %12s %12s" % ("screen", "filter", "full ms", "damaged ms")
+    for screen, width, height in SCREENS:
+        fb = framebuffer.Framebuffer(width, height)
+        fb.array[:] = numpy.random.RandomState(0).randint(0, 256, fb.array.shape)
+        damage = [(width // 3, height // 3, width * opts['damage'] // 100, height * opts['damage'] // 100)]
+        for name in sorted(flaschenvnc.SCALE_FILTERS):
+            scaler = flaschenvnc.makeScaler(name, (width, height), led)
+            times = []
+            for rectangles in (None, damage):
+                scaler.update(fb, rectangles)
+                start = time.time()
+                for i in xrange(opts['frames']):
+                    scaler.update(fb, rectangles)
+                times.append((time.time() - start) / opts['frames'] * 1000)
+            print "%8s %10s %12.2f %12.2f" % ((screen, name) + tuple(times))
+
+def benchDes(opts):
+    """fastdes against pyDes, test_fastdes checks that they agree"""
+    challenge = "0123456789abcdef"
+    def pydes():
+        rfb.RFBDes("password").encrypt(challenge)
+    def cold():
+        fastdes._last = None
+        fastdes.RFBDes("password").encrypt(challenge)
+    def cached():
+        fastdes.RFBDes("password").encrypt(challenge)
+    print "%12s %12s %10s" % ("des", "auths/s", "speedup")
+    base = None
+    for name, auth in (("pyDes", pydes), ("fast", cold), ("fast cached", cached)):
+        start = time.time()
+        for i in xrange(opts['auths']):
+            auth()
+        rate = opts['auths'] / (time.time() - start)
+        base = base or rate
+        print "%12s %12.0f %10.1f" % (name, rate, rate / base)
+
+class NullFlaschen(flaschen.Flaschen):
+    """Flaschen that counts datagrams instead of sending them"""
+
+    packets = 0
+    bytes_sent = 0
+
+    def _send(self, data, address=None):
+        self.packets += 1
+        self.bytes_sent += len(data)
+
+class ReplayClient(flaschenvnc.RFBToGUI):
+    """RFBToGUI that counts the frames it renders"""
+
+    frames = 0
+
+    def commitUpdate(self, rectangles=None):
+        self.frames += 1
+        flaschenvnc.RFBToGUI.commitUpdate(self, rectangles)
+
+def recordedDepth(pixel_format):
+    """the --depth that asks for a recorded pixel format"""
+    if pixel_format is None:
+        return 32
+    for depth, wanted in flaschenvnc.PIXEL_FORMATS.items():
+        if all([pixel_format[name] == value for name, value in wanted.items()]):
+            return depth
+    raise SystemExit, "recorded pixel format is not one flaschenvnc asks for: %r" % pixel_format
+
+def benchReplay(opts):
+    recording = rfbrecord.Recording(opts['recording'])
+    print "%s: %d sessions, %d chunks, %d bytes, %.1f s recorded" % (opts['recording'],
+        len(recording.sessions), len(recording.chunks), recording.size(), recording.duration())
+    print "%10s %8s %10s %10s %10s" % ("run", "frames", "seconds", "fps", "MB/s")
+    for run in xrange(opts['runs']):
+        ft = NullFlaschen('localhost', 1337, opts['width'], opts['height'], delta=opts['delta'])
+        factory = flaschenvnc.VNCFactory(ft, recordedDepth(recording.pixel_format), False, None, 0,
+                                         scale_filter=opts['scale-filter'])
+        factory.protocol = ReplayClient
+        clients = []
+        def connect():
+            client = factory.buildProtocol(IPv4Address('TCP', '127.0.0.1', 5900))
+            client.makeConnection(proto_helpers.StringTransport())
+            clients.append(client)
+            return client
+        elapsed = rfbrecord.replay(recording, connect, opts['paced'])
+        clients[-1].pacer.stop()
+        frames = sum([client.frames for client in clients])
+        print "%10d %8d %10.2f %10.1f %10.1f" % (run + 1, frames, elapsed,
+            frames / elapsed, recording.size() / elapsed / 1e6)
+
+def percentile(values, fraction):
+    """of a sorted list"""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def benchEndToEnd(opts):
+    """run flaschenvnc.py against a fake VNC server and a fake Flaschen
+       Taschen on this machine"""
+    from twisted.internet import reactor
+    led_w, led_h = opts['ft-width'], opts['ft-height']
+    # each marker block covers 4 LEDs, enough for every scale filter to
+    # keep its channels on their side of half way at the LED in the middle
+    scale_x, scale_y = float(opts['width']) / led_w, float(opts['height']) / led_h
+    marker = int(math.ceil(4.0 * max(scale_x, scale_y)))
+    server = fakevnc.FakeVNCFactory(opts['width'], opts['height'], opts['workload'], opts['fps'],
+                                    opts['password'], marker)
+    port = reactor.listenTCP(0, server, interface='127.0.0.1').getHost().port
+    middles = [(int((i + 0.5) * marker / scale_x), int(0.5 * marker / scale_y))
+               for i in xrange(fakevnc.MARKER_BLOCKS)]
+    receiver = fakeflaschen.FlaschenReceiver(led_w, led_h, marker=middles)
+    ftport = reactor.listenUDP(0, receiver, interface='127.0.0.1').getHost().port
+
+    bridge = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flaschenvnc.py')
+    command = [sys.executable, bridge, '--vnchost=127.0.0.1', '--display=%d' % (port - 5900),
+               '--fthost=127.0.0.1:%d' % ftport, '--width=%d' % led_w, '--height=%d' % led_h]
+    if opts['password'] is not None:
+        command.append('--password=%s' % opts['password'])
+    command.extend(shlex.split(opts['args']))
+    log = open(os.devnull, 'w')
+    process = subprocess.Popen(command, stdout=log, stderr=log)
+
+    reactor.callLater(opts['seconds'], reactor.stop)
+    reactor.run()
+    process.send_signal(signal.SIGINT)
+    pid, status, usage = os.wait4(process.pid, 0)
+    cpu = usage.ru_utime + usage.ru_stime
+
+    # skip the first second, the connection and first full frame
+    start = server.frame_times and server.frame_times[0] + 1.0 or 0
+    frames = [(when, frame) for when, frame in receiver.frames if when >= start]
+    latencies = sorted([when - server.frame_times[frame] for when, frame in frames
+                        if frame < len(server.frame_times)])
+    made = len([when for when in server.frame_times if when >= start])
+    print "%s at %dx%d -> %dx%d LEDs, %.0f fps for %.0f s: %s" % (opts['workload'],
+        opts['width'], opts['height'], led_w, led_h, opts['fps'], opts['seconds'], ' '.join(command[2:]))
+    if not latencies:
+        print "no frames arrived"
+        return
+    seconds = opts['seconds'] - 1.0
+    print "%10s %10s %10s %10s %10s %12s" % ("made", "shown", "fps", "p50 ms", "p90 ms", "p99 ms")
+    print "%10d %10d %10.1f %10.1f %10.1f %12.1f" % (made, len(frames), len(frames) / seconds,
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.9) * 1000,
+        percentile(latencies, 0.99) * 1000)
+    print "bridge cpu %.2f s, %.2f ms per frame shown, %d packets, %d bad" % (
+        cpu, cpu / len(receiver.frames) * 1000, receiver.packets, receiver.errors)
+
+def intList(value):
+    return [int(v) for v in value.split(',')]
+
+class ReceiveOptions(usage.Options):
+    optParameters = [
+        ['chunk',       'c', 1460,              'bytes per dataReceived() call', int],
+        ['rects',       'r', [1000, 10000, 100000], 'comma separated run lengths', intList],
+    ]
+    optFlags = [
+        ['core',        None,                   'drive the sans-IO RFBClientCore, collecting events'],
+    ]
+
+class HextileOptions(usage.Options):
+    optParameters = [
+        ['chunk',       'c', 65536,             'bytes per dataReceived() call', int],
+        ['width',       None, 1920,             'screen width', int],
+        ['height',      None, 1080,             'screen height', int],
+        ['frames',      'n', 5,                 'full screen updates to decode', int],
+    ]
+
+class ScaleOptions(usage.Options):
+    optParameters = [
+        ['width',       None, 45,               'LED grid width', int],
+        ['height',      None, 35,               'LED grid height', int],
+        ['damage',      None, 10,               'damaged rectangle size in percent of the screen', int],
+        ['frames',      'n', 10,                'frames to scale per measurement', int],
+    ]
+
+class DesOptions(usage.Options):
+    optParameters = [
+        ['auths',       'n', 2000,              'authentication responses to compute', int],
+    ]
+
+class ReplayOptions(usage.Options):
+    optParameters = [
+        ['width',       None, 45,               'flaschen taschen width', int],
+        ['height',      None, 35,               'flaschen taschen height', int],
+        ['scale-filter', None, 'bilinear',      'downscaling filter'],
+        ['runs',        'n', 3,                 'times to replay the recording', int],
+    ]
+    optFlags = [
+        ['paced',       None,                   'replay at the recorded pace, not as fast as possible'],
+        ['delta',       None,                   'send only the changed parts of frames'],
+    ]
+
+    def parseArgs(self, recording):
+        self['recording'] = recording
+
+    def postOptions(self):
+        if self['scale-filter'] not in flaschenvnc.SCALE_FILTERS:
+            raise usage.UsageError, "unknown scale filter %r" % self['scale-filter']
+
+class EndToEndOptions(usage.Options):
+    optParameters = [
+        ['workload',    'w', 'ui',              'server screen changes: ' + ', '.join(sorted(fakevnc.WORKLOADS))],
+        ['width',       None, 1280,             'server screen width', int],
+        ['height',      None, 720,              'server screen height', int],
+        ['ft-width',    None, 45,               'flaschen taschen width', int],
+        ['ft-height',   None, 35,               'flaschen taschen height', int],
+        ['fps',         None, 30.0,             'frames the server makes per second', float],
+        ['seconds',     's', 10.0,              'run time', float],
+        ['password',    'p', None,              'use VNC authentication'],
+        ['args',        'a', '',                'more flaschenvnc.py arguments, e.g. "--pipeline --delta"'],
+    ]
+
+    def postOptions(self):
+        if self['workload'] not in fakevnc.WORKLOADS:
+            raise usage.UsageError, "unknown workload %r" % self['workload']
+
+class Options(usage.Options):
+    subCommands = [
+        ['receive',     None, ReceiveOptions,   'receive buffer copy overhead for small hextile messages'],
+        ['hextile',     None, HextileOptions,   'full screen hextile decode, batch vs per-tile'],
+        ['scale',       None, ScaleOptions,     'scaler time per frame at 1080p, 1440p and 4K'],
+        ['des',         None, DesOptions,       'VNC authentication, fastdes vs pyDes'],
+        ['replay',      None, ReplayOptions,    'decode, scale and FT output of a recorded session, see flaschenvnc.py --record'],
+        ['e2e',         None, EndToEndOptions,  'flaschenvnc.py against a fake VNC server and Flaschen Taschen'],
+    ]
+
+    def postOptions(self):
+        if self.subCommand is None:
+            raise usage.UsageError, "no benchmark given"
+
+BENCHMARKS = {
+    'receive':  benchReceive,
+    'hextile':  benchHextile,
+    'scale':    benchScale,
+    'des':      benchDes,
+    'replay':   benchReplay,
+    'e2e':      benchEndToEnd,
+}
+
+def main():
+    o = Options()
+    try:
+        o.parseOptions()
+    except usage.UsageError, errortext:
+        print "%s: %s" % (sys.argv[0], errortext)
+        print "%s: Try --help for usage details." % (sys.argv[0])
+        raise SystemExit, 1
+
+    BENCHMARKS[o.subCommand](o.subOptions)
+
+
+if __name__ == '__main__':
+    main()
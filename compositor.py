@@ -0,0 +1,103 @@
+"""
+Compositing several VNC sessions onto one Flaschen Taschen.
+
+Each session renders into a Region, which stands in for the Flaschen it
+would otherwise own. The Compositor lays the regions out on one frame and
+sends that frame, at most max_fps times a second, however many regions
+changed in between.
+
+MIT License
+"""
+
+from twisted.internet import reactor
+
+import numpy
+
+#std stuff
+import time
+
+class Region(object):
+    """The part x, y, width, height of a compositor's frame. Has the
+       width, height, set_buffer(), set_image() and show() of a Flaschen,
+       so RFBToGUI can render into it unchanged."""
+
+    def __init__(self, compositor, x, y, width, height):
+        self.compositor = compositor
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        # replaced as a whole on every update, so the sender always sees
+        # a complete image even while a render thread sets the next one
+        self.pixels = numpy.zeros((height, width, 3), numpy.uint8)
+
+    def set_buffer(self, data):
+        """Set all pixels from row major r, g, b bytes."""
+        if len(data) != self.width * self.height * 3:
+            raise ValueError, "expected %d bytes of pixel data, got %d" % (self.width * self.height * 3, len(data))
+        self.pixels = numpy.frombuffer(data, numpy.uint8).reshape(self.height, self.width, 3)
+
+    def set_image(self, img):
+        """Set all pixels from a PIL image of the region size."""
+        if img.size != (self.width, self.height):
+            raise ValueError, "expected a %dx%d image, got %dx%d" % ((self.width, self.height) + img.size)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        self.set_buffer(img.tobytes())
+
+    def show(self):
+        """the region is ready to be sent, from any thread"""
+        self.compositor.changed()
+
+class Compositor(object):
+    """Composes regions, later ones on top, into frames for one Flaschen
+       and sends them paced to max_fps."""
+
+    def __init__(self, ft, max_fps=None):
+        self.ft = ft
+        self.interval = max_fps and 1.0 / max_fps or 0.0
+        self.regions = []
+        self.frame = numpy.zeros((ft.height, ft.width, 3), numpy.uint8)
+        self.updates = 0
+        self.frames_sent = 0
+        self._last_sent = 0
+        self._call = None
+
+    def region(self, x, y, width, height):
+        """a new region on top of the ones so far, clipped to the frame"""
+        width = max(0, min(width, self.ft.width - x))
+        height = max(0, min(height, self.ft.height - y))
+        region = Region(self, x, y, width, height)
+        self.regions.append(region)
+        return region
+
+    def setMaxFps(self, max_fps):
+        self.interval = max_fps and 1.0 / max_fps or 0.0
+
+    def changed(self):
+        self.updates += 1
+        reactor.callFromThread(self._schedule)
+
+    def _schedule(self):
+        if self._call is not None:
+            return
+        delay = max(0.0, self._last_sent + self.interval - time.time())
+        # even without a delay, wait for the other sessions' updates that
+        # are handled in the same reactor iteration
+        self._call = reactor.callLater(delay, self._send)
+
+    def _send(self):
+        self._call = None
+        self._last_sent = time.time()
+        frame = self.frame
+        frame[:] = 0
+        for region in self.regions:
+            frame[region.y:region.y+region.height, region.x:region.x+region.width] = region.pixels
+        self.ft.set_buffer(frame.tostring())
+        self.ft.show()
+        self.frames_sent += 1
+
+    def stop(self):
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
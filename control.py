@@ -0,0 +1,228 @@
+"""
+HTTP endpoint of a running bridge, with twisted.web.
+
+  GET  /metrics     Prometheus text: fps, stage latencies, bytes per
+                    encoding, dropped frames, reconnects, UDP send errors
+  GET  /control     the current settings as JSON, fps null for no cap
+  POST /control     change them, without reconnecting to the VNC server:
+
+    fps=20                  frame rate cap, 0 for none
+    viewport=x,y,w,h        screen area to show, "full" for the whole screen
+    brightness=0.5          LED brightness, 0.0 to 1.0
+    source=1                only change the session of this --sources
+                            entry, the viewport of all of them otherwise
+
+  curl -d fps=15 -d brightness=0.3 http://localhost:8080/control
+
+MIT License
+"""
+
+from twisted.web import server, resource
+
+#std stuff
+import json
+
+#local
+import rfb
+
+# counters of metrics.Metrics, as prometheus name and help
+COUNTERS = [
+    ('updates',         'flaschenvnc_updates_total',        'Framebuffer updates received'),
+    ('frames',          'flaschenvnc_frames_total',         'Frames scaled for the LEDs'),
+    ('frames.dropped',  'flaschenvnc_frames_dropped_total', 'Frames dropped by the render pipeline'),
+    ('frames.suppressed', 'flaschenvnc_frames_suppressed_total', 'Frames not sent, unchanged within tolerance'),
+    ('heartbeats',      'flaschenvnc_heartbeats_total',     'Unchanged frames sent again by the heartbeat'),
+    ('reconnects',      'flaschenvnc_reconnects_total',     'Reconnects to VNC servers'),
+    ('datagrams',       'flaschenvnc_datagrams_total',      'UDP datagrams sent'),
+    ('bytes.sent',      'flaschenvnc_sent_bytes_total',     'UDP bytes sent'),
+    ('send.errors',     'flaschenvnc_send_errors_total',    'UDP datagrams that could not be sent'),
+]
+
+def _labels(**labels):
+    return '{%s}' % ','.join(['%s="%s"' % item for item in sorted(labels.items())])
+
+QUANTILES = [('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99')]
+
+def _summary(lines, name, help, histograms, label):
+    """a prometheus summary of a dict of histogram snapshots, told apart
+       by label"""
+    lines.append('# HELP %s %s' % (name, help))
+    lines.append('# TYPE %s summary' % name)
+    for key, h in sorted(histograms.items()):
+        for quantile, percentile in QUANTILES:
+            lines.append('%s%s %r' % (name, _labels(quantile=quantile, **{label: key}), h[percentile]))
+        lines.append('%s_sum%s %r' % (name, _labels(**{label: key}), h['sum']))
+        lines.append('%s_count%s %d' % (name, _labels(**{label: key}), h['count']))
+
+class Bridge(object):
+    """What the endpoint reports on and controls: the shared metrics, the
+       VNCFactory of every source, and the Flaschen and compositors they
+       render into."""
+
+    def __init__(self, metrics, factories, flaschens, compositors=()):
+        self.metrics = metrics
+        self.factories = factories
+        self.flaschens = flaschens
+        self.compositors = compositors
+
+    def prometheus(self):
+        """the metrics in the prometheus text format"""
+        snapshot = self.metrics.snapshot()
+        counters = snapshot['counters']
+        lines = []
+        lines.append('# HELP flaschenvnc_fps Frames per second, smoothed')
+        lines.append('# TYPE flaschenvnc_fps gauge')
+        for source, factory in enumerate(self.factories):
+            session = factory.session
+            fps = session is not None and session.framerate.framerate or 0.0
+            lines.append('flaschenvnc_fps%s %r' % (_labels(source=source), fps))
+        lines.append('# HELP flaschenvnc_connected Whether the source is connected')
+        lines.append('# TYPE flaschenvnc_connected gauge')
+        for source, factory in enumerate(self.factories):
+            lines.append('flaschenvnc_connected%s %d' % (_labels(source=source), factory.session is not None))
+        _summary(lines, 'flaschenvnc_stage_seconds', 'Time per frame in each stage',
+                 snapshot['stages'], 'stage')
+        _summary(lines, 'flaschenvnc_distribution', 'Sizes per framebuffer update',
+                 snapshot['distributions'], 'name')
+        lines.append('# HELP flaschenvnc_received_bytes_total Bytes of rectangle data received')
+        lines.append('# TYPE flaschenvnc_received_bytes_total counter')
+        for encoding in sorted(rfb.ENCODING_NAMES.values()) + ['other']:
+            value = counters.get('bytes.' + encoding, 0)
+            lines.append('flaschenvnc_received_bytes_total%s %d' % (_labels(encoding=encoding), value))
+        for key, name, help in COUNTERS:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %d' % (name, counters.get(key, 0)))
+        return '\n'.join(lines) + '\n'
+
+    def state(self):
+        """the current settings"""
+        sources = []
+        for factory in self.factories:
+            session = factory.session
+            if session is not None:
+                viewport = (session.fb.x, session.fb.y, session.fb.width, session.fb.height)
+            else:
+                viewport = factory.viewport
+            sources.append({'connected': session is not None, 'viewport': viewport})
+        max_fps = None
+        if self.factories:
+            max_fps = self.factories[0].max_fps
+        brightness = 1.0
+        if self.flaschens:
+            brightness = self.flaschens[0].brightness
+        return {
+            'fps': max_fps,
+            'brightness': brightness,
+            'sources': sources,
+        }
+
+    def setMaxFps(self, max_fps):
+        """None for no cap"""
+        for factory in self.factories:
+            factory.max_fps = max_fps
+            if factory.session is not None:
+                factory.session.pacer.setMaxFps(max_fps)
+        for comp in self.compositors:
+            comp.setMaxFps(max_fps)
+
+    def setViewport(self, viewport, source=None):
+        """(x, y, width, height) or None for the whole screen, of one
+           source or all of them"""
+        factories = self.factories
+        if source is not None:
+            factories = [factories[source]]
+        for factory in factories:
+            factory.viewport = viewport
+            session = factory.session
+            if session is None:
+                continue
+            if viewport is None:
+                session.resetViewport()
+            else:
+                session.setViewport(*viewport)
+
+    def setBrightness(self, brightness):
+        for ft in self.flaschens:
+            ft.set_brightness(brightness)
+
+class MetricsPage(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, bridge):
+        resource.Resource.__init__(self)
+        self.bridge = bridge
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return self.bridge.prometheus()
+
+class ControlPage(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, bridge):
+        resource.Resource.__init__(self)
+        self.bridge = bridge
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'application/json')
+        return json.dumps(self.bridge.state()) + '\n'
+
+    def parse(self, args):
+        """the settings in args, checked, as a dict of the ones given.
+           raises ValueError for any that is invalid."""
+        settings = {'source': None}
+        if 'source' in args:
+            source = int(args['source'])
+            if not 0 <= source < len(self.bridge.factories):
+                raise ValueError, "no source %d" % source
+            settings['source'] = source
+        if 'fps' in args:
+            fps = float(args['fps'])
+            if not fps >= 0:
+                raise ValueError, "fps must be 0 or more"
+            settings['fps'] = fps or None
+        if 'viewport' in args:
+            if args['viewport'] == 'full':
+                settings['viewport'] = None
+            else:
+                viewport = tuple([int(v) for v in args['viewport'].split(',')])
+                if len(viewport) != 4:
+                    raise ValueError, "viewport must be x,y,w,h"
+                settings['viewport'] = viewport
+        if 'brightness' in args:
+            brightness = float(args['brightness'])
+            if not 0.0 <= brightness <= 1.0:
+                raise ValueError, "brightness must be 0.0 to 1.0"
+            settings['brightness'] = brightness
+        return settings
+
+    def render_POST(self, request):
+        args = dict([(key, values[-1]) for key, values in request.args.items()])
+        # all or nothing: check every setting before changing any
+        try:
+            settings = self.parse(args)
+        except ValueError, e:
+            request.setResponseCode(400)
+            request.setHeader('content-type', 'text/plain')
+            return "%s\n" % e
+        if 'fps' in settings:
+            self.bridge.setMaxFps(settings['fps'])
+        if 'viewport' in settings:
+            self.bridge.setViewport(settings['viewport'], settings['source'])
+        if 'brightness' in settings:
+            self.bridge.setBrightness(settings['brightness'])
+        return self.render_GET(request)
+
+class QuietSite(server.Site):
+    """no access log, scrapes would fill it"""
+
+    def log(self, request):
+        pass
+
+def site(bridge):
+    """a twisted.web Site with /metrics and /control for bridge"""
+    root = resource.Resource()
+    root.putChild('metrics', MetricsPage(bridge))
+    root.putChild('control', ControlPage(bridge))
+    return QuietSite(root)
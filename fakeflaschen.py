@@ -0,0 +1,76 @@
+"""
+A UDP Flaschen Taschen receiver for end to end load tests, the other end
+of flaschen.Flaschen.show().
+
+It decodes the PPM packets into a canvas, tiles and delta boxes at the
+offsets in their footers, and watches the fakevnc frame marker blocks to
+tell when each frame arrived.
+
+MIT License
+"""
+
+from twisted.internet.protocol import DatagramProtocol
+
+import numpy
+
+#std stuff
+import time
+
+#local
+import fakevnc
+
+def parsePacket(data):
+    """(x, y, layer, width, height, pixels) of a PPM packet, pixels as a
+       (height, width, 3) uint8 array"""
+    magic, size, depth, rest = data.split('\n', 3)
+    if magic != 'P6' or depth != '255':
+        raise ValueError, "not a P6 PPM packet"
+    width, height = [int(v) for v in size.split()]
+    length = width * height * 3
+    pixels = numpy.frombuffer(rest[:length], numpy.uint8).reshape(height, width, 3)
+    footer = rest[length:].split()
+    x, y, layer = (footer + ['0', '0', '0'])[:3]
+    return int(x), int(y), int(layer), width, height, pixels
+
+class FlaschenReceiver(DatagramProtocol):
+    """Collects packets into a (height, width, 3) canvas. With marker, a
+       list of the (x, y) LEDs in the middle of the marker blocks, frames
+       is a list of (time received, frame number) for every newer frame
+       whose marker showed up there."""
+
+    def __init__(self, width, height, marker=None):
+        self.width = width
+        self.height = height
+        self.canvas = numpy.zeros((height, width, 3), numpy.uint8)
+        self.marker = marker
+        self.packets = 0
+        self.bytes_received = 0
+        self.errors = 0
+        self.frames = []
+        self._last_frame = None
+
+    def datagramReceived(self, data, address):
+        now = time.time()
+        self.packets += 1
+        self.bytes_received += len(data)
+        try:
+            x, y, layer, width, height, pixels = parsePacket(data)
+        except ValueError:
+            self.errors += 1
+            return
+        # clip to the canvas
+        width, height = min(width, self.width - x), min(height, self.height - y)
+        if width <= 0 or height <= 0:
+            return
+        self.canvas[y:y+height, x:x+width] = pixels[:height, :width]
+        if self.marker is not None:
+            # only packets with every block, so that they all show one frame
+            for mx, my in self.marker:
+                if not (x <= mx < x + width and y <= my < y + height):
+                    return
+            colors = [self.canvas[my, mx] for mx, my in self.marker]
+            frame = fakevnc.markerFrame(colors, self._last_frame)
+            # heartbeats and late datagrams repeat older frames
+            if self._last_frame is None or frame > self._last_frame:
+                self._last_frame = frame
+                self.frames.append((now, frame))
@@ -0,0 +1,429 @@
+"""
+An in-process stand-in for a VNC server, for end to end load tests of the
+bridge on one machine.
+
+It speaks the server side of what rfb.RFBClient implements: protocol
+3.3 and 3.8, no authentication or VNC authentication, SetPixelFormat for
+true colour formats, raw, copyrect and hextile updates, and continuous
+updates and fences. The screen changes according to a scripted
+workload. Every frame also carries a marker, a row of blocks in the top
+left corner whose colours are the frame number, so that a receiver can
+tell which frame reached the LEDs and when.
+
+MIT License
+"""
+
+from twisted.internet.protocol import Protocol, Factory
+from twisted.internet import reactor
+
+import numpy
+
+#std stuff
+import os, time, random
+from struct import pack, unpack
+
+#local
+import rfb
+import fastdes
+import rfbrecord
+
+# the pixel format in ServerInit, the one RFBToGUI asks for at 32 bits
+SERVER_PIXEL_FORMAT = dict(bpp=32, depth=24, bigendian=0, truecolor=1, redmax=255, greenmax=255,
+                           bluemax=255, redshift=0, greenshift=8, blueshift=16)
+
+# the marker blocks, each carries 3 bits of the frame number as channels
+# that are off or fully on, which every pixel format, scale filter and the
+# black lifting of the Flaschen Taschen leave on their side of half way
+MARKER_BLOCKS = 4
+MARKER_PERIOD = 1 << (3 * MARKER_BLOCKS)
+
+def markerColors(frame):
+    """the r, g, b of each marker block, for the frame number modulo
+       MARKER_PERIOD"""
+    colors = []
+    for i in xrange(MARKER_BLOCKS):
+        bits = frame >> (3 * i)
+        colors.append([bits & 1 and 255 or 0, bits & 2 and 255 or 0, bits & 4 and 255 or 0])
+    return colors
+
+def markerFrame(colors, last=None):
+    """the frame number back from the colours of the marker blocks. with
+       the last frame number seen, the one closest to it, otherwise the
+       one below MARKER_PERIOD."""
+    frame = 0
+    for i, (r, g, b) in enumerate(colors):
+        frame |= ((r >= 128) | (g >= 128) << 1 | (b >= 128) << 2) << (3 * i)
+    if last is None:
+        return frame
+    return last + (frame - last + MARKER_PERIOD // 2) % MARKER_PERIOD - MARKER_PERIOD // 2
+
+#------------------------------------------------------
+# workloads
+#------------------------------------------------------
+
+class Workload(object):
+    """Changes the server screen, an (height, width, 3) uint8 r, g, b
+       array, once per frame. step() returns what to send as a list of
+       ('copy', srcx, srcy, x, y, width, height) and
+       ('update', x, y, width, height, encoding) operations, in order.
+       They are already applied to the screen."""
+
+    def __init__(self, screen, seed=0):
+        self.screen = screen
+        self.height, self.width = screen.shape[:2]
+        self.random = random.Random(seed)
+
+    def step(self):
+        raise NotImplementedError
+
+class Scroll(Workload):
+    """a terminal scrolling up one line of text per frame, copyrect for
+       the scroll and a hextile line of new text"""
+
+    line = 16
+
+    def step(self):
+        line = self.line
+        screen = self.screen
+        screen[:-line] = screen[line:].copy()
+        # a new line of glyph sized blocks, light on dark
+        screen[-line:] = (16, 16, 32)
+        x = 4
+        while x < self.width - 8:
+            if self.random.random() < 0.8:
+                glyph = numpy.array([[self.random.random() < 0.4 for gx in xrange(6)] for gy in xrange(10)])
+                screen[-line+3:-line+13, x:x+6][glyph] = (200, 220, 200)
+            x += 8
+        return [('copy', 0, line, 0, 0, self.width, self.height - line),
+                ('update', 0, self.height - line, self.width, line, rfb.HEXTILE_ENCODING)]
+
+class Noise(Workload):
+    """video: a window of random pixels that all change every frame, sent
+       raw"""
+
+    def __init__(self, screen, seed=0):
+        Workload.__init__(self, screen, seed)
+        self._numpy_random = numpy.random.RandomState(seed)
+        self.box = (self.width // 8, self.height // 8, self.width * 3 // 4, self.height * 3 // 4)
+
+    def step(self):
+        x, y, width, height = self.box
+        self.screen[y:y+height, x:x+width] = self._numpy_random.randint(0, 256, (height, width, 3))
+        return [('update', x, y, width, height, rfb.RAW_ENCODING)]
+
+class UI(Workload):
+    """a desktop: a few flat coloured windows with lines of text that move
+       or get redrawn, sent hextile"""
+
+    def step(self):
+        ops = []
+        for i in xrange(self.random.randrange(1, 4)):
+            width = self.random.randrange(32, max(33, self.width // 3))
+            height = self.random.randrange(32, max(33, self.height // 3))
+            x = self.random.randrange(0, self.width - width)
+            y = self.random.randrange(0, self.height - height)
+            window = self.screen[y:y+height, x:x+width]
+            window[:] = (self.random.randrange(256), self.random.randrange(256), self.random.randrange(256))
+            window[:12] = (40, 40, 120)
+            for row in xrange(20, height - 8, 12):
+                length = self.random.randrange(width // 4, width - 8)
+                window[row:row+2, 4:4+length] = (0, 0, 0)
+            ops.append(('update', x, y, width, height, rfb.HEXTILE_ENCODING))
+        return ops
+
+WORKLOADS = {
+    'scroll':   Scroll,
+    'noise':    Noise,
+    'ui':       UI,
+}
+
+#------------------------------------------------------
+# the server
+#------------------------------------------------------
+
+class FakeVNCServer(Protocol):
+    """server side of one RFB connection"""
+
+    def connectionMade(self):
+        self._buffer = ''
+        self._state = self._handleVersion
+        self.version = None
+        self.pixel_format = dict(SERVER_PIXEL_FORMAT)
+        self.encodings = []
+        self.requested = False
+        self.continuous = False
+        self.pending = []
+        self.pending_frames = 0
+        self.transport.write('RFB 003.008\n')
+        self.factory.clients.append(self)
+
+    def connectionLost(self, reason):
+        if self in self.factory.clients:
+            self.factory.clients.remove(self)
+
+    def dataReceived(self, data):
+        self._buffer += data
+        while self._state is not None and self._state():
+            pass
+
+    def _take(self, size):
+        """size bytes off the input, or None if they aren't there yet"""
+        if len(self._buffer) < size:
+            return None
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    # --- handshake
+
+    def _handleVersion(self):
+        data = self._take(12)
+        if data is None:
+            return False
+        self.version = int(data[8:11])
+        security = self.factory.password is None and 1 or 2
+        if self.version >= 7:
+            self.transport.write(pack("!BB", 1, security))
+            self._state = self._handleSecurityChoice
+        else:
+            self.transport.write(pack("!I", security))
+            self._startSecurity(security)
+        return True
+
+    def _handleSecurityChoice(self):
+        data = self._take(1)
+        if data is None:
+            return False
+        self._startSecurity(ord(data))
+        return True
+
+    def _startSecurity(self, security):
+        if security == 2:
+            self._challenge = os.urandom(16)
+            self.transport.write(self._challenge)
+            self._state = self._handleAuthResponse
+        else:
+            if self.version >= 8:
+                self.transport.write(pack("!I", 0))
+            self._state = self._handleClientInit
+
+    def _handleAuthResponse(self):
+        data = self._take(16)
+        if data is None:
+            return False
+        password = (self.factory.password + '\0' * 8)[:8]
+        if data != fastdes.RFBDes(password).encrypt(self._challenge):
+            self.transport.write(pack("!I", 1))
+            if self.version >= 8:
+                reason = "authentication failed"
+                self.transport.write(pack("!I", len(reason)) + reason)
+            self.transport.loseConnection()
+            self._state = None
+            return False
+        self.transport.write(pack("!I", 0))
+        self._state = self._handleClientInit
+        return True
+
+    def _handleClientInit(self):
+        if self._take(1) is None:
+            return False
+        f = SERVER_PIXEL_FORMAT
+        pixformat = pack("!BBBBHHHBBBxxx", f['bpp'], f['depth'], f['bigendian'], f['truecolor'],
+                         f['redmax'], f['greenmax'], f['bluemax'],
+                         f['redshift'], f['greenshift'], f['blueshift'])
+        name = "fakevnc %s" % self.factory.workload_name
+        screen = self.factory.screen
+        self.transport.write(pack("!HH16sI", screen.shape[1], screen.shape[0], pixformat, len(name)) + name)
+        self._state = self._handleMessage
+        return True
+
+    # --- client messages
+
+    def _handleMessage(self):
+        if not self._buffer:
+            return False
+        msgid = ord(self._buffer[0])
+        sizes = {0: 20, 2: 4, 3: 10, 4: 8, 5: 6, 6: 8, 150: 10, 248: 9}
+        if msgid not in sizes:
+            self.transport.loseConnection()
+            self._state = None
+            return False
+        if len(self._buffer) < sizes[msgid]:
+            return False
+        header = self._buffer[:sizes[msgid]]
+        # messages with a variable length tail
+        extra = 0
+        if msgid == 2:
+            extra = unpack("!xxH", header)[0] * 4
+        elif msgid == 6:
+            extra = unpack("!xxxxI", header)[0]
+        elif msgid == 248:
+            extra = ord(header[8])
+        data = self._take(sizes[msgid] + extra)
+        if data is None:
+            return False
+        if msgid == 0:
+            self.pixel_format = rfbrecord.parsePixelFormat(data[4:20])
+        elif msgid == 2:
+            count = unpack("!xxH", data[:4])[0]
+            self.encodings = list(unpack("!%dI" % count, data[4:]))
+            if rfb.CONTINUOUS_UPDATES_ENCODING in self.encodings:
+                # tell the client continuous updates are there
+                self.transport.write(pack("!B", 150))
+            if rfb.FENCE_ENCODING in self.encodings:
+                self.fence(rfb.FENCE_REQUEST, "hello")
+        elif msgid == 3:
+            incremental = ord(data[1])
+            if not incremental:
+                self.pending = [('update', 0, 0, self.factory.screen.shape[1],
+                                 self.factory.screen.shape[0], rfb.RAW_ENCODING)]
+                self.pending_frames = 1
+            self.requested = True
+            self.flush()
+        elif msgid == 150:
+            (enable,) = unpack("!xB8x", data)
+            self.continuous = bool(enable)
+            if self.continuous:
+                self.flush()
+            else:
+                self.transport.write(pack("!B", 150))
+        elif msgid == 248:
+            (flags,) = unpack("!xxxxIx", data[:9])
+            if flags & rfb.FENCE_REQUEST:
+                self.fence(flags & ~rfb.FENCE_REQUEST & 0x7, data[9:])
+        return True
+
+    def fence(self, flags, payload=''):
+        self.transport.write(pack("!BxxxIB", 248, flags, len(payload)) + payload)
+
+    # --- updates
+
+    def frame(self, ops):
+        """a new frame, called by the factory after it changed the screen"""
+        self.pending.extend(ops)
+        self.pending_frames += 1
+        self.flush()
+
+    def flush(self):
+        """send the pending changes if the client asked for them"""
+        if not self.pending or not (self.requested or self.continuous):
+            return
+        ops = self.pending
+        if self.pending_frames > 1 or rfb.COPY_RECTANGLE_ENCODING not in self.encodings:
+            # several frames got merged, or copyrect isn't allowed: the
+            # copies can't be replayed on top of the later changes, send
+            # what they covered from the current screen instead
+            ops = [op[0] == 'copy' and ('update',) + op[3:] + (rfb.RAW_ENCODING,) or op for op in ops]
+        self.pending = []
+        self.pending_frames = 0
+        self.requested = False
+        self.transport.write(self.encodeUpdate(ops))
+
+    def encodeUpdate(self, ops):
+        data = [pack("!BxH", 0, len(ops))]
+        for op in ops:
+            if op[0] == 'copy':
+                srcx, srcy, x, y, width, height = op[1:]
+                data.append(pack("!HHHHIHH", x, y, width, height, rfb.COPY_RECTANGLE_ENCODING, srcx, srcy))
+                continue
+            x, y, width, height, encoding = op[1:]
+            if encoding not in self.encodings:
+                encoding = rfb.RAW_ENCODING
+            data.append(pack("!HHHHI", x, y, width, height, encoding))
+            area = self.factory.screen[y:y+height, x:x+width]
+            if encoding == rfb.HEXTILE_ENCODING:
+                data.append(self.hextile(area))
+            else:
+                data.append(self.pixels(area))
+        return ''.join(data)
+
+    def pixels(self, rgb):
+        """an r, g, b array as bytes in the client's pixel format"""
+        f = self.pixel_format
+        if f['bpp'] == 32 and (f['redshift'], f['greenshift'], f['blueshift']) == (0, 8, 16) and not f['bigendian']:
+            out = numpy.zeros(rgb.shape[:2] + (4,), numpy.uint8)
+            out[:, :, :3] = rgb
+            return out.tostring()
+        rgb = rgb.astype(numpy.uint32)
+        value = ((rgb[:, :, 0] * f['redmax'] // 255) << f['redshift'] |
+                 (rgb[:, :, 1] * f['greenmax'] // 255) << f['greenshift'] |
+                 (rgb[:, :, 2] * f['bluemax'] // 255) << f['blueshift'])
+        dtype = {8: 'u1', 16: 'u2', 32: 'u4'}[f['bpp']]
+        return value.astype((f['bigendian'] and '>' or '<') + dtype).tostring()
+
+    def hextile(self, rgb):
+        """hextile tiles: one colour tiles as a background, two colour
+           tiles as foreground runs, the rest raw"""
+        height, width = rgb.shape[:2]
+        data = []
+        for ty in xrange(0, height, 16):
+            for tx in xrange(0, width, 16):
+                tile = rgb[ty:ty+16, tx:tx+16]
+                th, tw = tile.shape[:2]
+                flat = tile.reshape(-1, 3)
+                bg = flat[0]
+                other = (flat != bg).any(axis=1)
+                if not other.any():
+                    data.append(pack("!B", 2) + self.pixels(tile[:1, :1]))
+                    continue
+                fg = flat[other.argmax()]
+                mask = other.reshape(th, tw)
+                if ((flat != bg).any(axis=1) & (flat != fg).any(axis=1)).any():
+                    data.append(pack("!B", 1) + self.pixels(tile))
+                    continue
+                # runs of foreground in each row
+                subrects = []
+                for row in xrange(th):
+                    x = 0
+                    line = mask[row]
+                    while x < tw:
+                        if line[x]:
+                            start = x
+                            while x < tw and line[x]:
+                                x += 1
+                            subrects.append(pack("!BB", start << 4 | row, (x - start - 1) << 4))
+                        else:
+                            x += 1
+                if len(subrects) > 255:
+                    data.append(pack("!B", 1) + self.pixels(tile))
+                    continue
+                data.append(pack("!B", 2 | 4 | 8) + self.pixels(tile[:1, :1]) +
+                            self.pixels(fg.reshape(1, 1, 3)) + pack("!B", len(subrects)) + ''.join(subrects))
+        return ''.join(data)
+
+class FakeVNCFactory(Factory):
+    """Serves one screen that a workload changes fps times a second, to
+       all connected clients. frame_times[n] is when frame n was made.
+       marker is the side of each marker block in pixels."""
+
+    protocol = FakeVNCServer
+
+    def __init__(self, width, height, workload='ui', fps=30.0, password=None, marker=32, seed=0):
+        self.screen = numpy.zeros((height, width, 3), numpy.uint8)
+        self.workload_name = workload
+        self.workload = WORKLOADS[workload](self.screen, seed)
+        self.interval = 1.0 / fps
+        self.password = password
+        self.marker = marker
+        self.clients = []
+        self.frame_times = []
+        self._call = None
+
+    def startFactory(self):
+        self._call = reactor.callLater(0, self.step)
+
+    def stopFactory(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+
+    def step(self):
+        """make the next frame and hand it to the clients"""
+        frame = len(self.frame_times)
+        self.frame_times.append(time.time())
+        ops = self.workload.step()
+        m = self.marker
+        for i, color in enumerate(markerColors(frame)):
+            self.screen[:m, i * m:(i + 1) * m] = color
+        ops.append(('update', 0, 0, MARKER_BLOCKS * m, m, rfb.RAW_ENCODING))
+        for client in self.clients:
+            client.frame(ops)
+        self._call = reactor.callLater(self.interval, self.step)
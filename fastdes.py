@@ -0,0 +1,201 @@
+"""
+Table driven DES for VNC authentication.
+
+pyDes works on lists of bits and permutes them one bit at a time. Here
+the permutations are lookups of whole bytes in precomputed tables, the
+S-boxes are merged with the P permutation into SP tables, blocks are
+32 bit integer halves, and the schedule of the last key is kept for
+reconnects. Same results as pyDes.des in ECB mode, see test_fastdes.py.
+
+MIT License
+"""
+
+#std stuff
+from struct import pack, unpack
+
+# the standard DES tables, with 0 based bit numbers, bit 0 is the most
+# significant bit of the first byte
+_PC1 = [56, 48, 40, 32, 24, 16,  8,  0, 57, 49, 41, 33, 25, 17,
+         9,  1, 58, 50, 42, 34, 26, 18, 10,  2, 59, 51, 43, 35,
+        62, 54, 46, 38, 30, 22, 14,  6, 61, 53, 45, 37, 29, 21,
+        13,  5, 60, 52, 44, 36, 28, 20, 12,  4, 27, 19, 11,  3]
+
+_LEFT_ROTATIONS = [1, 1, 2, 2, 2, 2, 2, 2, 1, 2, 2, 2, 2, 2, 2, 1]
+
+_PC2 = [13, 16, 10, 23,  0,  4,  2, 27, 14,  5, 20,  9,
+        22, 18, 11,  3, 25,  7, 15,  6, 26, 19, 12,  1,
+        40, 51, 30, 36, 46, 54, 29, 39, 50, 44, 32, 47,
+        43, 48, 38, 55, 33, 52, 45, 41, 49, 35, 28, 31]
+
+_IP = [57, 49, 41, 33, 25, 17,  9,  1, 59, 51, 43, 35, 27, 19, 11,  3,
+       61, 53, 45, 37, 29, 21, 13,  5, 63, 55, 47, 39, 31, 23, 15,  7,
+       56, 48, 40, 32, 24, 16,  8,  0, 58, 50, 42, 34, 26, 18, 10,  2,
+       60, 52, 44, 36, 28, 20, 12,  4, 62, 54, 46, 38, 30, 22, 14,  6]
+
+_FP = [39,  7, 47, 15, 55, 23, 63, 31, 38,  6, 46, 14, 54, 22, 62, 30,
+       37,  5, 45, 13, 53, 21, 61, 29, 36,  4, 44, 12, 52, 20, 60, 28,
+       35,  3, 43, 11, 51, 19, 59, 27, 34,  2, 42, 10, 50, 18, 58, 26,
+       33,  1, 41,  9, 49, 17, 57, 25, 32,  0, 40,  8, 48, 16, 56, 24]
+
+_SBOX = [
+    [14,  4, 13,  1,  2, 15, 11,  8,  3, 10,  6, 12,  5,  9,  0,  7,
+      0, 15,  7,  4, 14,  2, 13,  1, 10,  6, 12, 11,  9,  5,  3,  8,
+      4,  1, 14,  8, 13,  6,  2, 11, 15, 12,  9,  7,  3, 10,  5,  0,
+     15, 12,  8,  2,  4,  9,  1,  7,  5, 11,  3, 14, 10,  0,  6, 13],
+    [15,  1,  8, 14,  6, 11,  3,  4,  9,  7,  2, 13, 12,  0,  5, 10,
+      3, 13,  4,  7, 15,  2,  8, 14, 12,  0,  1, 10,  6,  9, 11,  5,
+      0, 14,  7, 11, 10,  4, 13,  1,  5,  8, 12,  6,  9,  3,  2, 15,
+     13,  8, 10,  1,  3, 15,  4,  2, 11,  6,  7, 12,  0,  5, 14,  9],
+    [10,  0,  9, 14,  6,  3, 15,  5,  1, 13, 12,  7, 11,  4,  2,  8,
+     13,  7,  0,  9,  3,  4,  6, 10,  2,  8,  5, 14, 12, 11, 15,  1,
+     13,  6,  4,  9,  8, 15,  3,  0, 11,  1,  2, 12,  5, 10, 14,  7,
+      1, 10, 13,  0,  6,  9,  8,  7,  4, 15, 14,  3, 11,  5,  2, 12],
+    [ 7, 13, 14,  3,  0,  6,  9, 10,  1,  2,  8,  5, 11, 12,  4, 15,
+     13,  8, 11,  5,  6, 15,  0,  3,  4,  7,  2, 12,  1, 10, 14,  9,
+     10,  6,  9,  0, 12, 11,  7, 13, 15,  1,  3, 14,  5,  2,  8,  4,
+      3, 15,  0,  6, 10,  1, 13,  8,  9,  4,  5, 11, 12,  7,  2, 14],
+    [ 2, 12,  4,  1,  7, 10, 11,  6,  8,  5,  3, 15, 13,  0, 14,  9,
+     14, 11,  2, 12,  4,  7, 13,  1,  5,  0, 15, 10,  3,  9,  8,  6,
+      4,  2,  1, 11, 10, 13,  7,  8, 15,  9, 12,  5,  6,  3,  0, 14,
+     11,  8, 12,  7,  1, 14,  2, 13,  6, 15,  0,  9, 10,  4,  5,  3],
+    [12,  1, 10, 15,  9,  2,  6,  8,  0, 13,  3,  4, 14,  7,  5, 11,
+     10, 15,  4,  2,  7, 12,  9,  5,  6,  1, 13, 14,  0, 11,  3,  8,
+      9, 14, 15,  5,  2,  8, 12,  3,  7,  0,  4, 10,  1, 13, 11,  6,
+      4,  3,  2, 12,  9,  5, 15, 10, 11, 14,  1,  7,  6,  0,  8, 13],
+    [ 4, 11,  2, 14, 15,  0,  8, 13,  3, 12,  9,  7,  5, 10,  6,  1,
+     13,  0, 11,  7,  4,  9,  1, 10, 14,  3,  5, 12,  2, 15,  8,  6,
+      1,  4, 11, 13, 12,  3,  7, 14, 10, 15,  6,  8,  0,  5,  9,  2,
+      6, 11, 13,  8,  1,  4, 10,  7,  9,  5,  0, 15, 14,  2,  3, 12],
+    [13,  2,  8,  4,  6, 15, 11,  1, 10,  9,  3, 14,  5,  0, 12,  7,
+      1, 15, 13,  8, 10,  3,  7,  4, 12,  5,  6, 11,  0, 14,  9,  2,
+      7, 11,  4,  1,  9, 12, 14,  2,  0,  6, 10, 13, 15,  3,  5,  8,
+      2,  1, 14,  7,  4, 10,  8, 13, 15, 12,  9,  0,  3,  5,  6, 11],
+]
+
+_P = [15,  6, 19, 20, 28, 11, 27, 16,  0, 14, 22, 25,  4, 17, 30,  9,
+       1,  7, 23, 13, 31, 26,  2,  8, 18, 12, 29,  5, 21, 10,  3, 24]
+
+def _byteTables(table, in_bits):
+    """for a permutation table over in_bits bits, one 256 entry table per
+       input byte that maps the byte to its output bits. the permutation
+       of a value is the OR of the lookups of all its bytes."""
+    out_bits = len(table)
+    tables = []
+    for chunk in xrange(in_bits // 8):
+        entries = []
+        for value in xrange(256):
+            out = 0
+            for i, bit in enumerate(table):
+                if chunk * 8 <= bit < chunk * 8 + 8 and value & (0x80 >> (bit - chunk * 8)):
+                    out |= 1 << (out_bits - 1 - i)
+            entries.append(out)
+        tables.append(entries)
+    return tables
+
+def _spTables():
+    """S-box j looked up with the 6 bit group j of the expanded half and
+       its output moved through P, as 8 tables of 64 32 bit values"""
+    position = [0] * 32
+    for i, bit in enumerate(_P):
+        position[bit] = i
+    tables = []
+    for j in xrange(8):
+        entries = []
+        for group in xrange(64):
+            row = (group >> 4 & 2) | (group & 1)
+            column = group >> 1 & 0xf
+            value = _SBOX[j][row * 16 + column]
+            out = 0
+            for n in xrange(4):
+                if value & (8 >> n):
+                    out |= 1 << (31 - position[j * 4 + n])
+            entries.append(out)
+        tables.append(entries)
+    return tables
+
+# IP split into the left and right halves, FP from the two halves back to
+# the 64 bit block, PC1 and PC2 for the key schedule
+_IP_TABLES = _byteTables(_IP, 64)
+_FP_TABLES = _byteTables(_FP, 64)
+_PC1_TABLES = _byteTables(_PC1, 64)
+_PC2_TABLES = _byteTables(_PC2, 56)
+_SP = _spTables()
+
+# bits of each byte in reverse order, for the VNC variant of the key
+_REVERSED = ''.join([chr(int('{0:08b}'.format(i)[::-1], 2)) for i in xrange(256)])
+
+def _permute(tables, value, in_bits):
+    out = 0
+    for chunk, table in enumerate(tables):
+        out |= table[value >> (in_bits - 8 - chunk * 8) & 0xff]
+    return out
+
+def _schedule(key):
+    """the 16 subkeys of an 8 byte key, each as 8 groups of 6 bits"""
+    (k,) = unpack("!Q", key)
+    cd = _permute(_PC1_TABLES, k, 64)
+    c, d = cd >> 28, cd & 0xfffffff
+    subkeys = []
+    for rotation in _LEFT_ROTATIONS:
+        c = (c << rotation | c >> (28 - rotation)) & 0xfffffff
+        d = (d << rotation | d >> (28 - rotation)) & 0xfffffff
+        k = _permute(_PC2_TABLES, c << 28 | d, 56)
+        subkeys.append(tuple([k >> (42 - 6 * j) & 0x3f for j in xrange(8)]))
+    return subkeys
+
+# (key, schedule) of the last key, a reconnect authenticates with the
+# same password again. no more is kept of passwords than that.
+_last = None
+
+def schedule(key):
+    """the key schedule for key, cached for the last key only"""
+    global _last
+    if _last is None or _last[0] != key:
+        _last = (key, _schedule(key))
+    return _last[1]
+
+def _crypt(subkeys, block):
+    """run one 8 byte block through the 16 rounds with the subkeys in the
+       given order"""
+    (value,) = unpack("!Q", block)
+    ip = _IP_TABLES
+    lr = (ip[0][value >> 56] | ip[1][value >> 48 & 0xff] | ip[2][value >> 40 & 0xff] |
+          ip[3][value >> 32 & 0xff] | ip[4][value >> 24 & 0xff] | ip[5][value >> 16 & 0xff] |
+          ip[6][value >> 8 & 0xff] | ip[7][value & 0xff])
+    left, right = lr >> 32, lr & 0xffffffff
+    sp0, sp1, sp2, sp3, sp4, sp5, sp6, sp7 = _SP
+    for k0, k1, k2, k3, k4, k5, k6, k7 in subkeys:
+        # the expansion of right as 34 bits: bit 32, bits 1-32, bit 1. the
+        # 6 bit groups are 4 bits apart
+        e = (right & 1) << 33 | right << 1 | right >> 31
+        left, right = right, left ^ (
+            sp0[e >> 28 & 0x3f ^ k0] | sp1[e >> 24 & 0x3f ^ k1] |
+            sp2[e >> 20 & 0x3f ^ k2] | sp3[e >> 16 & 0x3f ^ k3] |
+            sp4[e >> 12 & 0x3f ^ k4] | sp5[e >> 8 & 0x3f ^ k5] |
+            sp6[e >> 4 & 0x3f ^ k6] | sp7[e & 0x3f ^ k7])
+    return pack("!Q", _permute(_FP_TABLES, right << 32 | left, 64))
+
+class DES(object):
+    """DES in ECB mode, data must be a multiple of 8 bytes"""
+
+    def __init__(self, key):
+        self.setKey(key)
+
+    def setKey(self, key):
+        if len(key) != 8:
+            raise ValueError, "DES keys must be 8 bytes long"
+        self._subkeys = schedule(key)
+        self._reversed = self._subkeys[::-1]
+
+    def encrypt(self, data):
+        return ''.join([_crypt(self._subkeys, data[i:i+8]) for i in xrange(0, len(data), 8)])
+
+    def decrypt(self, data):
+        return ''.join([_crypt(self._reversed, data[i:i+8]) for i in xrange(0, len(data), 8)])
+
+class RFBDes(DES):
+    """DES with the bits of each key byte reversed, as VNC authentication
+       uses it"""
+
+    def setKey(self, key):
+        DES.setKey(self, key.translate(_REVERSED))
@@ -1,41 +1,311 @@
 import socket
+import threading
+import time
+
+import numpy
+
+from metrics import clock
+
+def _levels(brightness):
+  """A translate() table that scales bytes by brightness."""
+  return str(bytearray([min(255, int(round(v * brightness))) for v in range(256)]))
+
+# in delta mode, the changed pixels are sent in at most this many boxes
+MAX_BOXES = 4
+
+# largest UDP payload, and room for a PPM header and footer
+MAX_PACKET = 65507
+PACKET_OVERHEAD = 64
+
+def parse_address(address, port):
+  """Parse "host" or "host:port" into a (host, port) pair."""
+  if ':' in address:
+    address, port = address.rsplit(':', 1)
+  return (address, int(port))
+
+def parse_panels(spec, port):
+  """Parse a panel map "host[:port]@x,y,w,h;..." into a list of
+  ((host, port), (x, y, width, height))."""
+  panels = []
+  for panel in spec.split(';'):
+    address, box = panel.split('@')
+    box = tuple([int(v) for v in box.split(',')])
+    if len(box) != 4:
+      raise ValueError("panel box must be x,y,w,h: %r" % panel)
+    panels.append((parse_address(address.strip(), port), box))
+  return panels
 
 class Flaschen(object):
-  def __init__(self, host, port, width, height, layer=0):
+  def __init__(self, host, port, width, height, layer=0, delta=False, refresh=1.0,
+               targets=None, panels=None, max_packet=MAX_PACKET,
+               tolerance=None, heartbeat=None):
+    """With delta set, show() only sends the boxes that changed since the
+    last frame, and a full frame every refresh seconds in case packets
+    got lost.
+
+    With a tolerance, show() skips frames whose pixels all differ by at
+    most that much per channel from the last frame sent, 0 skips only
+    identical ones. They are sent anyway once heartbeat seconds passed
+    since the last send, and keepalive() resends the last frame then.
+
+    Frames that don't fit into max_packet bytes are cut into tiles. Tiles
+    go round-robin to the (host, port) targets, or with a panel map of
+    ((host, port), (x, y, width, height)) entries to the receiver whose
+    panel they fall on, with offsets relative to that panel."""
     self.host = host
     self.port = port
+    self.targets = targets or [(host, port)]
+    self.panels = panels
+    self.max_packet = max_packet
+    self._next_target = 0
     self.width = width
     self.height = height
     self.layer = layer
-    self.pixels = []
-    for x in xrange(width):
-      self.pixels.append([(0, 0, 0) for y in xrange(height)])
+    self.delta = delta
+    self.refresh = refresh
+    self.max_boxes = MAX_BOXES
+    # the whole PPM packet is preallocated, pixels are a row major r, g, b
+    # view into it
+    header = self._header(width, height)
+    size = width * height * 3
+    self._packet = bytearray(header + "\0" * size + "\n" + self._footer())
+    self._start = len(header)
+    self._end = self._start + size
+    self.pixels = memoryview(self._packet)[self._start:self._end]
+    # the same as an array of r, g, b rows
+    self._rgb = numpy.frombuffer(self._packet, numpy.uint8)[self._start:self._end].reshape(-1, 3)
+    # the pixels as set, before brightness, to scale them again with
+    self._raw = bytearray(size)
+    # pixels as of the last show() that sent, for delta mode and tolerance
+    self._sent = None
+    self._last_full = 0
+    self.tolerance = tolerance
+    self.heartbeat = heartbeat
+    self._last_send = None
+    self.frames_suppressed = 0
+    # show() runs on the render thread with a pipeline, keepalive() on
+    # the reactor's
+    self._lock = threading.Lock()
+    # whether the prebuilt packet can go out as it is
+    self._single = (not panels and len(self.targets) == 1 and
+                    len(self._packet) <= max_packet)
     self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # a metrics.Metrics for the encode and send timings
+    self.metrics = None
+    self._send_time = 0.0
+    # datagrams that could not be sent, e.g. refused or out of buffers
+    self.send_errors = 0
+    self.brightness = 1.0
+    self._levels = _levels(1.0)
 
-  def _send(self, data):
-    self.sock.sendto(data, (self.host, self.port))
+  def set_brightness(self, brightness):
+    """Scale the pixels by brightness, 0.0 to 1.0, and show the current
+    frame again at it, so that a picture standing still changes too."""
+    with self._lock:
+      self.brightness = max(0.0, min(1.0, float(brightness)))
+      self._levels = _levels(self.brightness)
+      self._packet[self._start:self._end] = str(self._raw).translate(self._levels)
+      self._lift_black()
+      shown = self._last_send is not None
+    if shown:
+      self.show()
+
+  def _send(self, data, address=None):
+    start = clock()
+    try:
+      self.sock.sendto(data, address or self.targets[0])
+    except socket.error:
+      # a lost datagram, as if the network had dropped it
+      self.send_errors += 1
+      if self.metrics is not None:
+        self.metrics.count('send.errors')
+      return
+    if self.metrics is not None:
+      self._send_time += clock() - start
+      self.metrics.count('datagrams')
+      self.metrics.count('bytes.sent', len(data))
 
-  def _header(self):
+  def _header(self, width, height):
     return ''.join(["P6\n",
-                    "45 35\n",
+                    "%d %d\n" % (width, height),
                     "255\n"])
 
-  def _footer(self):
-    return ''.join(["0\n",
-                    "0\n",
+  def _footer(self, x=0, y=0):
+    return ''.join(["%d\n" % x,
+                    "%d\n" % y,
                     "%d\n" % self.layer])
 
   def set(self, x, y, color):
     if x >= self.width or y >= self.height:
       return
+    pos = (y * self.width + x) * 3
+    self._raw[pos], self._raw[pos + 1], self._raw[pos + 2] = color
+    levels = self._levels
+    color = (ord(levels[color[0]]), ord(levels[color[1]]), ord(levels[color[2]]))
     if color == (0, 0, 0):
       color = (1, 1, 1)
-    self.pixels[x][y] = color
-  
+    pos += self._start
+    self._packet[pos], self._packet[pos + 1], self._packet[pos + 2] = color
+
+  def set_buffer(self, data):
+    """Set all pixels from row major r, g, b bytes."""
+    if len(data) != self._end - self._start:
+      raise ValueError("expected %d bytes of pixel data, got %d" % (self._end - self._start, len(data)))
+    with self._lock:
+      self._raw[:] = data
+      self._packet[self._start:self._end] = data.translate(self._levels)
+      self._lift_black()
+
+  def _lift_black(self):
+    """Black is transparent on the flaschen taschen, so pixels that are
+    0, 0, 0 are sent as 1, 1, 1. Other pixels keep their zero channels."""
+    rgb = self._rgb
+    rgb[(rgb == 0).all(axis=1)] = 1
+
+  def set_image(self, img):
+    """Set all pixels from a PIL image of the display size."""
+    if img.size != (self.width, self.height):
+      raise ValueError("expected a %dx%d image, got %dx%d" % ((self.width, self.height) + img.size))
+    if img.mode != 'RGB':
+      img = img.convert('RGB')
+    self.set_buffer(img.tobytes())
+
+  def _changed_boxes(self):
+    """Bounding boxes (x, y, width, height) around the pixels that differ
+    from the last frame sent. Runs of changed rows form one box each,
+    the closest ones are merged until at most max_boxes are left."""
+    row = self.width * 3
+    packet, sent = self._packet, self._sent
+    bands = []
+    for y in xrange(self.height):
+      pos = y * row
+      new = packet[self._start + pos:self._start + pos + row]
+      old = sent[pos:pos + row]
+      if new == old:
+        continue
+      first, last = 0, row - 1
+      while new[first] == old[first]:
+        first += 1
+      while new[last] == old[last]:
+        last -= 1
+      x0, x1 = first // 3, last // 3 + 1
+      if bands and bands[-1][1] == y:
+        band = bands[-1]
+        band[1], band[2], band[3] = y + 1, min(band[2], x0), max(band[3], x1)
+      else:
+        bands.append([y, y + 1, x0, x1])
+    while len(bands) > self.max_boxes:
+      # merge the neighbouring pair that adds the least area
+      best, cost = 0, None
+      for i in xrange(len(bands) - 1):
+        a, b = bands[i], bands[i + 1]
+        area = (b[1] - a[0]) * (max(a[3], b[3]) - min(a[2], b[2]))
+        extra = area - (a[1] - a[0]) * (a[3] - a[2]) - (b[1] - b[0]) * (b[3] - b[2])
+        if cost is None or extra < cost:
+          best, cost = i, extra
+      a, b = bands[best], bands.pop(best + 1)
+      a[1], a[2], a[3] = b[1], min(a[2], b[2]), max(a[3], b[3])
+    return [(x0, y0, x1 - x0, y1 - y0) for y0, y1, x0, x1 in bands]
+
+  def _box_packet(self, x, y, width, height, origin=(0, 0)):
+    """A PPM packet for one box, placed with the footer offsets relative
+    to the origin of the receiving panel."""
+    row = self.width * 3
+    data = [self._header(width, height)]
+    pos = self._start + y * row + x * 3
+    for line in xrange(height):
+      data.append(str(self._packet[pos:pos + width * 3]))
+      pos += row
+    data.append("\n" + self._footer(x - origin[0], y - origin[1]))
+    return ''.join(data)
+
+  def _tiles(self, x, y, width, height):
+    """Cut a box into tiles that fit into one datagram each."""
+    space = self.max_packet - PACKET_OVERHEAD
+    tile_w = max(1, min(width, space // 3))
+    tile_h = max(1, min(height, space // (tile_w * 3)))
+    for ty in xrange(y, y + height, tile_h):
+      for tx in xrange(x, x + width, tile_w):
+        yield (tx, ty, min(tile_w, x + width - tx), min(tile_h, y + height - ty))
+
+  def _send_boxes(self, boxes):
+    for x, y, width, height in boxes:
+      if self.panels:
+        for address, (px, py, pw, ph) in self.panels:
+          x0, y0 = max(x, px), max(y, py)
+          x1, y1 = min(x + width, px + pw), min(y + height, py + ph)
+          if x0 >= x1 or y0 >= y1:
+            continue
+          for tile in self._tiles(x0, y0, x1 - x0, y1 - y0):
+            self._send(self._box_packet(*tile, origin=(px, py)), address)
+      else:
+        for tile in self._tiles(x, y, width, height):
+          address = self.targets[self._next_target % len(self.targets)]
+          self._next_target += 1
+          self._send(self._box_packet(*tile), address)
+
+  def _send_full(self):
+    if self._single:
+      self._send(self._packet)
+    else:
+      self._send_boxes([(0, 0, self.width, self.height)])
+
+  def _unchanged(self, now):
+    """Whether the pixels are within tolerance of the last frame sent,
+    and no heartbeat is due."""
+    if self.tolerance is None or self._sent is None:
+      return False
+    if self.heartbeat and now - self._last_send >= self.heartbeat:
+      return False
+    pixels = self._packet[self._start:self._end]
+    if self.tolerance == 0:
+      return pixels == self._sent
+    new = numpy.frombuffer(pixels, numpy.uint8).astype(numpy.int16)
+    old = numpy.frombuffer(self._sent, numpy.uint8)
+    return numpy.abs(new - old).max() <= self.tolerance
+
   def show(self):
-    data = []
-    for y in xrange(0, 35):
-      for x in xrange(0, 45):
-        data.append(''.join([chr(c) for c in self.pixels[x][y]]))
+    with self._lock:
+      if self._unchanged(time.time()):
+        self.frames_suppressed += 1
+        if self.metrics is not None:
+          self.metrics.count('frames.suppressed')
+        return
+      if self.metrics is None:
+        self._show()
+        return
+      start = clock()
+      self._send_time = 0.0
+      self._show()
+      self.metrics.observe('send', self._send_time)
+      self.metrics.observe('encode', clock() - start - self._send_time)
+
+  def keepalive(self):
+    """Resend the last frame if nothing was sent for heartbeat seconds,
+    so the wall neither times out nor keeps lost packets wrong while the
+    picture stands still. Call it periodically."""
+    with self._lock:
+      now = time.time()
+      if not self.heartbeat or self._last_send is None or now - self._last_send < self.heartbeat:
+        return
+      self._send_full()
+      self._last_send = self._last_full = now
+      if self.delta or self.tolerance is not None:
+        self._sent = self._packet[self._start:self._end]
+      if self.metrics is not None:
+        self.metrics.count('heartbeats')
 
-    self._send(self._header() + ''.join(data) + "\n" + self._footer())
+  def _show(self):
+    now = time.time()
+    self._last_send = now
+    if not self.delta or self._sent is None or now - self._last_full >= self.refresh:
+      self._send_full()
+      self._last_full = now
+    else:
+      boxes = self._changed_boxes()
+      if sum([w * h for x, y, w, h in boxes]) >= self.width * self.height:
+        self._send_full()
+      else:
+        self._send_boxes(boxes)
+    if self.delta or self.tolerance is not None:
+      self._sent = self._packet[self._start:self._end]
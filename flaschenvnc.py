@@ -16,7 +16,7 @@ import flaschen
 
 #twisted modules
 from twisted.python import usage, log
-from twisted.internet import reactor, protocol
+from twisted.internet import reactor, protocol, threads, task
 #~ from twisted.internet import defer
 from twisted.internet.protocol import Factory, Protocol
 
@@ -28,6 +28,12 @@ import sys, struct, time
 
 #local
 import rfb
+import scaler
+import framebuffer
+import rfbrecord
+import compositor
+import metrics
+import control
 
 class FramerateCalculator(object):
 
@@ -44,33 +50,178 @@ class FramerateCalculator(object):
             self.framerate = (self.framerate * self._smoothing) + ( (1.0 / delta) * (1.0 - self._smoothing))
         self._last_frame = time.time()
 
+class UpdatePacer(object):
+    """Schedules the next incremental update request with callLater, so
+    that frames are no closer than 1/max_fps apart, and no closer than
+    the smoothed time the render stage needs per frame. A slow scaler or
+    UDP send thus lowers the request rate instead of wasting CPU on
+    frames that can't be shown."""
+
+    def __init__(self, request, max_fps=None, smoothing=0.8):
+        self.request = request
+        self.interval = max_fps and 1.0 / max_fps or 0.0
+        self.render_time = 0.0
+        self._smoothing = smoothing
+        self._last_request = None
+        self._call = None
+
+    def setMaxFps(self, max_fps):
+        """change the frame rate cap, None for none"""
+        self.interval = max_fps and 1.0 / max_fps or 0.0
+
+    def mark(self):
+        """a frame came in without a request, with continuous updates.
+        count it as requested now."""
+        self._last_request = time.time()
+
+    def rendered(self, seconds):
+        """report how long the render stage took for one frame. a plain
+        attribute store, so it is safe from the render worker thread."""
+        self.render_time = self.render_time * self._smoothing + seconds * (1.0 - self._smoothing)
+
+    def delay(self):
+        """seconds to wait before the next request"""
+        if self._last_request is None:
+            return 0.0
+        elapsed = time.time() - self._last_request
+        return max(0.0, max(self.interval, self.render_time) - elapsed)
+
+    def schedule(self):
+        if self._call is not None:
+            return
+        delay = self.delay()
+        if delay > 0:
+            self._call = reactor.callLater(delay, self._fire)
+        else:
+            self._fire()
+
+    def _fire(self):
+        self._call = None
+        self._last_request = time.time()
+        self.request()
+
+    def stop(self):
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+class RenderPipeline(object):
+    """Runs the render stage on the reactor's thread pool, one frame at a
+    time. Frames submitted while one is rendering wait in a single slot,
+    a newer frame replaces the waiting one and the older one is counted
+    as dropped, so a slow renderer never builds a backlog.
+
+    The worker reads a back buffer of the framebuffer. Only the damaged
+    rectangles are copied into it, on the reactor thread when the next
+    frame starts rendering, so decoding goes on into the framebuffer
+    meanwhile and the worker never sees half a frame."""
+
+    def __init__(self, render, metrics=None):
+        self.render = render
+        self.metrics = metrics
+        self.busy = False
+        self.frames_rendered = 0
+        self.frames_dropped = 0
+        self.back = None
+        self._pending = None
+
+    def submit(self, frame, rectangles=None):
+        """queue the Framebuffer frame, which decoding goes on into, for
+           render(back buffer, rectangles), from the reactor thread"""
+        if self._pending is not None:
+            self.frames_dropped += 1
+            if self.metrics is not None:
+                self.metrics.count('frames.dropped')
+            # the newer frame also has to repaint what the dropped one changed
+            dropped = self._pending[1]
+            if dropped is None or rectangles is None:
+                rectangles = None
+            else:
+                rectangles = dropped + rectangles
+        self._pending = (frame, rectangles)
+        if not self.busy:
+            self._next()
+
+    def _next(self):
+        frame, rectangles = self._pending
+        self._pending = None
+        self.busy = True
+        back = self.back
+        if back is None or (back.x, back.y, back.width, back.height) != (frame.x, frame.y, frame.width, frame.height):
+            # the first frame, or another viewport
+            back = self.back = frame.snapshot()
+        else:
+            back.copyFrom(frame, rectangles)
+        d = threads.deferToThread(self.render, back, rectangles)
+        d.addErrback(log.err)
+        d.addBoth(self._done)
+
+    def _done(self, result):
+        self.busy = False
+        self.frames_rendered += 1
+        if self._pending is not None:
+            self._next()
+
 class RFBToGUI(rfb.RFBClient):
     """RFBClient protocol that talks to the GUI app"""
 
     def vncConnectionMade(self):
         """choose appropriate color depth, resize screen"""
         self.setEncodings(self.factory.encodings)
-        self.setPixelFormat()           #set up pixel format to 32 bits
-        self.framebufferUpdateRequest() #request initial screen update
-
-        self.full_fb = []
-        for x in xrange(self.width):
-            self.full_fb.append([(0, 0, 0) for y in xrange(self.height)])
-
-        blank_data = "\x00" * (4 * self.width * self.height)
-        self.full_fb = Image.new('RGB', (self.width, self.height))
+        self.setPixelFormat(**self.factory.pixel_format)   #set up pixel format
 
+        # the framebuffer only covers the viewport, the whole screen by default
+        self.viewport = self.factory.viewport
+        x, y, width, height = self._clampViewport(self.viewport)
         self.ft = self.factory.ft
+        fb = self.factory.framebuffer
+        if fb is not None and (fb.x, fb.y, fb.width, fb.height) == (x, y, width, height):
+            # reconnected to a screen of the same size, the last
+            # connection's framebuffer and scaler caches still fit
+            self.fb = fb
+            self.scaler = self.factory.scaler
+        else:
+            self.fb = framebuffer.Framebuffer(width, height, x, y)
+            self.fb.setPixelFormat(**self.factory.pixel_format)
+            self.scaler = makeScaler(self.factory.scale_filter, (width, height), (self.ft.width, self.ft.height))
+        self.framebufferUpdateRequest(x, y, width, height) #request initial screen update
+
+        self.pacer = UpdatePacer(self.requestUpdate, self.factory.max_fps)
+        # screen areas whose pixels are unknown, for the next request
+        self._stale = []
+        # continuous updates are on, and paused to keep to the frame rate
+        self.continuous = False
+        self._paused = False
+        self._pausing = False
+        self.pipeline = None
+        if self.factory.pipeline:
+            self.pipeline = RenderPipeline(self.render, self.metrics)
 
         self.framerate = FramerateCalculator()
         self.last_framerate_time = time.time()
 
+        self.factory.resetDelay()
+        self.factory.connections += 1
+        self.factory.session = self
+        if self.factory.connections > 1:
+            # the wall keeps the last frame until the server sends one
+            if self.metrics is not None:
+                self.metrics.count('reconnects')
+            return
+
         # Clear the FT to start
-        for y in xrange(0, 35):
-            for x in xrange(0, 45):
-                self.ft.set(x, y, (0, 0, 0))
+        self.ft.set_buffer("\x00" * (3 * self.ft.width * self.ft.height))
         self.ft.show()
 
+    def connectionLost(self, reason):
+        if getattr(self, 'pacer', None) is not None:
+            self.pacer.stop()
+        if self.factory.session is self:
+            self.factory.session = None
+            # for the next connection
+            self.factory.framebuffer = self.fb
+            self.factory.scaler = self.scaler
+
     def vncRequestPassword(self):
         if self.factory.password is not None:
             self.sendPassword(self.factory.password)
@@ -81,54 +232,266 @@ class RFBToGUI(rfb.RFBClient):
 
     def commitUpdate(self, rectangles = None):
         """finish series of display updates"""
-        self.framebufferUpdateRequest(incremental=1)
-        img = self.full_fb.resize( (self.ft.width, self.ft.height), resample=Image.BILINEAR )
-        for x in xrange(0, self.ft.width):
-            for y in xrange(0, self.ft.height):
-                r, g, b = img.getpixel( (x, y) )
-                self.ft.set(x, y, (r, g, b))
-        self.ft.show()
+        if not self.continuous:
+            self.pacer.schedule()
+        else:
+            early = self.pacer.delay() > 0
+            self.pacer.mark()
+            if early and not self._paused:
+                # the server is ahead of max_fps or the renderer, stop
+                # the stream until the pacer asks for the next frame
+                self._paused = self._pausing = True
+                self.enableContinuousUpdates(0, self.fb.x, self.fb.y, self.fb.width, self.fb.height)
+                self.pacer.schedule()
+        if rectangles is not None:
+            rectangles = self.fb.clipAll(rectangles)
+        if self.pipeline:
+            self.pipeline.submit(self.fb, rectangles)
+        else:
+            self.render(self.fb, rectangles)
         self.framerate.increment()
         delta = time.time() - self.last_framerate_time
         if self.framerate.framerate is not None and delta > SHOW_FRAMERATE_EVERY:
-            print "Framerate: %.01f" % self.framerate.framerate
+            if self.pipeline:
+                print "Framerate: %.01f (%d frames dropped)" % (self.framerate.framerate, self.pipeline.frames_dropped)
+            else:
+                print "Framerate: %.01f" % self.framerate.framerate
             self.last_framerate_time = time.time()
 
+    def requestUpdate(self):
+        self._requestStale()
+        if self.continuous:
+            self._paused = False
+            self.enableContinuousUpdates(1, self.fb.x, self.fb.y, self.fb.width, self.fb.height)
+        else:
+            self.framebufferUpdateRequest(self.fb.x, self.fb.y, self.fb.width, self.fb.height, incremental=1)
+
+    def endOfContinuousUpdates(self):
+        """the server supports continuous updates, or stopped them"""
+        if self._pausing:
+            # the answer to our own pause
+            self._pausing = False
+            return
+        if self.continuous:
+            # the server ended them, go back to requesting updates
+            self.continuous = False
+            self.requestUpdate()
+        elif self.factory.continuous:
+            self.continuous = True
+            self.requestUpdate()
+
+    def _clampViewport(self, viewport):
+        """fit a viewport (x, y, width, height) onto the screen, None is
+           the whole screen"""
+        if viewport is None:
+            return (0, 0, self.width, self.height)
+        x, y, width, height = viewport
+        width = max(1, min(width, self.width))
+        height = max(1, min(height, self.height))
+        x = max(0, min(x, self.width - width))
+        y = max(0, min(y, self.height - height))
+        return (x, y, width, height)
+
+    def setViewport(self, x, y, width, height):
+        """show the screen area x, y, width, height from now on. only that
+           area is requested from the server, decoded and scaled."""
+        self.viewport = (x, y, width, height)
+        self._fitViewport()
+
+    def resetViewport(self):
+        """show the whole screen again"""
+        self.viewport = None
+        self._fitViewport()
+
+    def desktopResized(self, width, height):
+        """the server screen changed size"""
+        self._fitViewport()
+
+    def _fitViewport(self):
+        """reallocate the framebuffer and scaler for the viewport on the
+           current screen"""
+        x, y, width, height = self._clampViewport(self.viewport)
+        self.fb = self.fb.moved(x, y, width, height)
+        self.scaler = makeScaler(self.factory.scale_filter, (width, height), (self.ft.width, self.ft.height))
+        # the parts that were outside the old viewport are unknown
+        self._stale = []
+        self._requestArea(x, y, width, height)
+        if self.continuous and not self._paused:
+            self.enableContinuousUpdates(1, x, y, width, height)
+
+    def _requestArea(self, x, y, width, height):
+        """ask for all pixels of a screen area, not just its changes. it
+           goes out with the pacer's next request, so max_fps holds. only
+           while continuous updates stream, which the pacer doesn't
+           request, it goes out at once."""
+        self._stale.append((x, y, width, height))
+        if self.continuous and not self._paused:
+            self._requestStale()
+
+    def _requestStale(self):
+        stale, self._stale = self._stale, []
+        for area in stale:
+            self.framebufferUpdateRequest(*area)
+
+    def pan(self, dx, dy):
+        """move the viewport by dx, dy screen pixels"""
+        self.setViewport(self.fb.x + dx, self.fb.y + dy, self.fb.width, self.fb.height)
+
+    def zoom(self, factor):
+        """zoom in (factor > 1) or out around the middle of the viewport"""
+        if not factor > 0:
+            raise ValueError, "zoom factor must be more than 0"
+        width = int(round(self.fb.width / float(factor)))
+        height = int(round(self.fb.height / float(factor)))
+        self.setViewport(self.fb.x + (self.fb.width - width) // 2,
+                         self.fb.y + (self.fb.height - height) // 2,
+                         width, height)
+
+    def render(self, frame, rectangles=None):
+        """scale frame down and send it to the FT"""
+        scaler, fb = self.scaler, self.fb
+        if (frame.x, frame.y, frame.width, frame.height) != (fb.x, fb.y, fb.width, fb.height):
+            # a back buffer from before a viewport change
+            return
+        start = metrics.clock()
+        img = scaler.update(frame, rectangles)
+        self.ft.set_image(img)
+        if self.metrics is not None:
+            self.metrics.observe('scale', metrics.clock() - start)
+            self.metrics.count('frames')
+        self.ft.show()
+        self.pacer.rendered(metrics.clock() - start)
+
     def updateRectangle(self, x, y, width, height, data):
         """new bitmap data"""
-        img = Image.frombytes('RGBA', (width, height), data)     #TODO color format
         #~ log.msg("screen update")
+        self.fb.update(x, y, width, height, data)
 
-        self.full_fb.paste(
-            img,
-            (x, y)
-        )
+    def rectangleTarget(self, x, y, width, height):
+        """hextile decodes into the framebuffer when it can"""
+        return self.fb.target(x, y, width, height)
 
     def copyRectangle(self, srcx, srcy, x, y, width, height):
         """copy src rectangle -> destinantion"""
-        img = self.full_fb.crop( (srcx, srcy, width, height) )
-        self.full_fb.paste(
-            img,
-            (x, y)
-        )
+        if not self.fb.copy(srcx, srcy, x, y, width, height):
+            # the source was outside the viewport, ask for the real pixels
+            cx, cy, cw, ch = self.fb.clip(x, y, width, height)
+            self._requestArea(self.fb.x + cx, self.fb.y + cy, cw, ch)
 
     def fillRectangle(self, x, y, width, height, color):
         """fill rectangle with one color"""
-        #~ remoteframebuffer.CopyRect(srcx, srcy, x, y, width, height)
-        self.full_fb.paste(struct.unpack("BBBB", color), (x, y, width, height))
+        self.fb.fill(x, y, width, height, color)
+
+# encoding names accepted by --encodings
+ENCODINGS = {
+    'raw':      rfb.RAW_ENCODING,
+    'copyrect': rfb.COPY_RECTANGLE_ENCODING,
+    'rre':      rfb.RRE_ENCODING,
+    'corre':    rfb.CORRE_ENCODING,
+    'hextile':  rfb.HEXTILE_ENCODING,
+    'zrle':     rfb.ZRLE_ENCODING,
+    'tight':    rfb.TIGHT_ENCODING,
+}
+
+def parseEncodings(names):
+    """turn a comma separated list of encoding names into a preference list"""
+    try:
+        return [ENCODINGS[name.strip().lower()] for name in names.split(',')]
+    except KeyError, e:
+        raise ValueError, "unknown encoding %s" % e
+
+def parseViewport(value):
+    """parse an optional x,y,w,h viewport"""
+    if value is None:
+        return None
+    viewport = tuple([int(v) for v in value.split(',')])
+    if len(viewport) != 4 or viewport[2] <= 0 or viewport[3] <= 0:
+        raise ValueError, "viewport must be x,y,w,h"
+    return viewport
+
+def parseSources(spec, layer, width, height):
+    """parse "host[:display]@x,y,w,h[,layer];..." into a list of
+       (host, display, (x, y, width, height), layer). the boxes have to
+       start on the width x height wall, they are clipped to it."""
+    sources = []
+    for source in spec.split(';'):
+        address, box = source.split('@')
+        host, display = (address.strip().split(':') + ['0'])[:2]
+        box = [int(v) for v in box.split(',')]
+        if len(box) not in (4, 5):
+            raise ValueError, "source box must be x,y,w,h or x,y,w,h,layer: %r" % source
+        x, y, w, h = box[:4]
+        if not (0 <= x < width and 0 <= y < height and w > 0 and h > 0):
+            raise ValueError, "source box is not on the %dx%d wall: %r" % (width, height, source)
+        sources.append((host or 'localhost', int(display), (x, y, w, h), box[4] if len(box) == 5 else layer))
+    return sources
+
+def parseLevel(value):
+    """parse an optional tight quality or compression level"""
+    if value is None:
+        return None
+    level = int(value)
+    if not 0 <= level <= 9:
+        raise ValueError, "level must be 0-9"
+    return level
+
+# pixel formats for --depth. 16 and 8 bits are RGB565 and BGR233, which
+# halve or quarter what the server has to encode and send
+PIXEL_FORMATS = {
+    32: dict(bpp=32, depth=24, redmax=255, greenmax=255, bluemax=255, redshift=0, greenshift=8, blueshift=16),
+    16: dict(bpp=16, depth=16, redmax=31, greenmax=63, bluemax=31, redshift=11, greenshift=5, blueshift=0),
+    8:  dict(bpp=8, depth=8, redmax=7, greenmax=7, bluemax=3, redshift=0, greenshift=3, blueshift=6),
+}
+
+# filters accepted by --scale-filter: PIL resize on the damaged cells, or
+# precomputed resampling matrices on the framebuffer array
+SCALE_FILTERS = {
+    'bilinear': (scaler.RegionScaler, Image.BILINEAR),
+    'box':      (scaler.MatrixScaler, 'box'),
+    'lanczos':  (scaler.MatrixScaler, 'lanczos'),
+}
+
+def makeScaler(name, src_size, dst_size):
+    cls, filter = SCALE_FILTERS[name]
+    return cls(src_size, dst_size, filter)
+
+class VNCFactory(rfb.RFBFactory, protocol.ReconnectingClientFactory):
+    """A factory for remote frame buffer connections. Reconnects with a
+    jittered exponential backoff when the connection is lost or fails,
+    unless reconnect is off."""
+
+    # longest wait between attempts, in seconds
+    maxDelay = 30
 
-class VNCFactory(rfb.RFBFactory):
-    """A factory for remote frame buffer connections."""
-    
     def __init__(self, ft, depth, fast, *args, **kwargs):
+        encodings = kwargs.pop('encodings', None)
+        quality = kwargs.pop('quality', None)
+        compress = kwargs.pop('compress', None)
+        self.pipeline = kwargs.pop('pipeline', False)
+        self.max_fps = kwargs.pop('max_fps', None)
+        self.scale_filter = kwargs.pop('scale_filter', 'bilinear')
+        self.viewport = kwargs.pop('viewport', None)
+        self.continuous = kwargs.pop('continuous', False)
+        self.recorder = kwargs.pop('recorder', None)
+        self.metrics = kwargs.pop('metrics', None)
+        self.reconnect = kwargs.pop('reconnect', True)
         rfb.RFBFactory.__init__(self, *args, **kwargs)
         self.ft = ft
-        if depth == 32:
+        # the connected RFBToGUI, if any, and how many there were
+        self.session = None
+        self.connections = 0
+        # kept from the last connection, see RFBToGUI.vncConnectionMade
+        self.framebuffer = None
+        self.scaler = None
+        if depth in PIXEL_FORMATS:
             self.protocol = RFBToGUI
+            self.pixel_format = PIXEL_FORMATS[depth]
         else:
             raise ValueError, "color depth not supported"
             
-        if fast:
+        if encodings:
+            self.encodings = encodings
+        elif fast:
             self.encodings = [
                 rfb.COPY_RECTANGLE_ENCODING,
                 rfb.RAW_ENCODING,
@@ -136,11 +499,23 @@ class VNCFactory(rfb.RFBFactory):
         else:
             self.encodings = [
                 rfb.COPY_RECTANGLE_ENCODING,
+                rfb.TIGHT_ENCODING,
+                rfb.ZRLE_ENCODING,
                 rfb.HEXTILE_ENCODING,
                 rfb.CORRE_ENCODING,
                 rfb.RRE_ENCODING,
                 rfb.RAW_ENCODING,
             ]
+        #screen size changes and early ends of updates
+        self.encodings = self.encodings + [rfb.DESKTOP_SIZE_ENCODING, rfb.LAST_RECT_ENCODING]
+        #server push, see RFBToGUI.endOfContinuousUpdates
+        if self.continuous:
+            self.encodings = self.encodings + [rfb.CONTINUOUS_UPDATES_ENCODING, rfb.FENCE_ENCODING]
+        #tight pseudo-encodings, only sent when asked for
+        if quality is not None:
+            self.encodings = self.encodings + [rfb.TIGHT_QUALITY_LEVEL_0 + quality]
+        if compress is not None:
+            self.encodings = self.encodings + [rfb.TIGHT_COMPRESS_LEVEL_0 + compress]
 
     def buildProtocol(self, addr):
         display = addr.port - 5900
@@ -148,30 +523,69 @@ class VNCFactory(rfb.RFBFactory):
 
     def clientConnectionLost(self, connector, reason):
         log.msg("connection lost: %r" % reason.getErrorMessage())
-        reactor.stop()
+        if self.reconnect:
+            protocol.ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
+        else:
+            reactor.stop()
 
     def clientConnectionFailed(self, connector, reason):
         log.msg("cannot connect to server: %r\n" % reason.getErrorMessage())
-        reactor.stop()
+        if self.reconnect:
+            protocol.ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
+        else:
+            reactor.stop()
 
 class Options(usage.Options):
     optParameters = [
         ['display',     'd', '0',               'VNC display'],
         ['vnchost',     'h', 'localhost',       'vnc remote hostname'],
-        ['fthost',      't', 'localhost',       'flaschen taschen hostname'],
+        ['fthost',      't', 'localhost',       'flaschen taschen hostname, or comma separated host:port receivers that take tiles round-robin'],
         ['ftport',      None, 1337,              'flaschen taschen port'],
         ['width',       None, 45,                'flaschen taschen width'],
         ['height',      None, 35,                'flaschen taschen height'],
         ['layer',       None, 0,                'flaschen taschen layer'],
+        ['refresh',     None, 1.0,              'seconds between full frames in delta mode'],
+        ['panels',      None, None,             'panel map, host:port@x,y,w,h;... [default: one panel]'],
+        ['maxpacket',   None, flaschen.MAX_PACKET, 'largest UDP datagram to send'],
+        ['tolerance',   None, '0',              'Skip frames whose LEDs all changed by at most this much per channel, off to send every frame'],
+        ['heartbeat',   None, 1.0,              'seconds after which an unchanged frame is sent again'],
+        ['max-fps',     None, None,             'Frame rate cap [default: as fast as the server sends]'],
         ['outfile',     'o', None,              'Logfile [default: sys.stdout]'],
+        ['http',        None, None,             'Serve /metrics and /control on this [interface:]port, interface 127.0.0.1 unless given, /control has no authentication [default: off]'],
+        ['stats',       None, None,             'Log per stage timings every this many seconds [default: never]'],
+        ['record',      None, None,             'Record the server stream to this file, for bench.py replay (.gz to compress)'],
         ['password',    'p', None,              'VNC password'],
-        ['depth',       'D', '32',              'Color depth'],
+        ['depth',       'D', '32',              'Color depth: 32, 16 (RGB565) or 8 (BGR233) bits per pixel'],
+        ['encodings',   'e', None,              'Encoding preference, e.g. tight,zrle,hextile,raw'],
+        ['quality',     'q', None,              'Tight JPEG quality level (0-9)'],
+        ['compress',    'z', None,              'Tight compression level (0-9)'],
+        ['viewport',    None, None,             'Only show the screen area x,y,w,h [default: whole screen]'],
+        ['sources',     None, None,             'Several VNC servers on one wall, host:display@x,y,w,h[,layer];... [default: vnchost]'],
+        ['scale-filter', None, 'bilinear',      'Downscaling filter: ' + ', '.join(sorted(SCALE_FILTERS))],
     ]
     optFlags = [
         ['shared',      's',                    'Request shared session'],
         ['fast',        'f',                    'Fast connection is used'],
+        ['delta',       None,                   'Only send the parts of the frame that changed'],
+        ['pipeline',    None,                   'Scale and send frames on a worker thread'],
+        ['once',        None,                   'Exit when the connection is lost instead of reconnecting'],
+        ['continuous',  None,                   'Let the server stream updates without requests, if it supports it'],
     ]
 
+    def postOptions(self):
+        try:
+            if self.opts['tolerance'] == 'off':
+                self.opts['tolerance'] = None
+            else:
+                self.opts['tolerance'] = int(self.opts['tolerance'])
+            self.opts['heartbeat'] = float(self.opts['heartbeat'])
+        except ValueError, errortext:
+            raise usage.UsageError, errortext
+        if self.opts['tolerance'] is not None and self.opts['tolerance'] < 0:
+            raise usage.UsageError, "--tolerance must be off or >= 0"
+        if not self.opts['heartbeat'] >= 0:
+            raise usage.UsageError, "--heartbeat must be >= 0"
+
 def main():
     o = Options()
     try:
@@ -182,6 +596,31 @@ def main():
         raise SystemExit, 1
 
     depth = int(o.opts['depth'])
+    if depth not in PIXEL_FORMATS:
+        print "%s: color depth must be one of %s" % (sys.argv[0], ', '.join(map(str, sorted(PIXEL_FORMATS))))
+        raise SystemExit, 1
+    encodings = None
+    if o.opts['encodings']:
+        try:
+            encodings = parseEncodings(o.opts['encodings'])
+        except ValueError, errortext:
+            print "%s: %s" % (sys.argv[0], errortext)
+            raise SystemExit, 1
+    try:
+        quality = parseLevel(o.opts['quality'])
+        compress = parseLevel(o.opts['compress'])
+        viewport = parseViewport(o.opts['viewport'])
+    except ValueError, errortext:
+        print "%s: %s" % (sys.argv[0], errortext)
+        raise SystemExit, 1
+
+    if o.opts['scale-filter'] not in SCALE_FILTERS:
+        print "%s: unknown scale filter %r" % (sys.argv[0], o.opts['scale-filter'])
+        raise SystemExit, 1
+
+    max_fps = None
+    if o.opts['max-fps'] is not None:
+        max_fps = float(o.opts['max-fps'])
 
     logFile = sys.stdout
     if o.opts['outfile']:
@@ -198,24 +637,113 @@ def main():
             if host == '':  host = 'localhost'
             display = int(display)
 
-    ft = flaschen.Flaschen(o.opts['fthost'],
-                           o.opts['ftport'],
-                           o.opts['width'],
-                           o.opts['height'],
-                           int(o.opts['layer']))
-
-    # connect to this host and port, and reconnect if we get disconnected
-    reactor.connectTCP(
-        host,                                   #remote hostname
-        display + 5900,                         #TCP port number
-        VNCFactory(
+    ftport = int(o.opts['ftport'])
+    tolerance = o.opts['tolerance']
+    heartbeat = o.opts['heartbeat']
+    try:
+        targets = [flaschen.parse_address(address.strip(), ftport)
+                   for address in o.opts['fthost'].split(',')]
+        panels = None
+        if o.opts['panels']:
+            panels = flaschen.parse_panels(o.opts['panels'], ftport)
+    except ValueError, errortext:
+        print "%s: %s" % (sys.argv[0], errortext)
+        raise SystemExit, 1
+
+    sources = None
+    if o.opts['sources']:
+        try:
+            sources = parseSources(o.opts['sources'], int(o.opts['layer']),
+                                   int(o.opts['width']), int(o.opts['height']))
+        except ValueError, errortext:
+            print "%s: %s" % (sys.argv[0], errortext)
+            raise SystemExit, 1
+        if o.opts['record']:
+            print "%s: --record takes a single source" % sys.argv[0]
+            raise SystemExit, 1
+
+    # always collected, it is cheap
+    stats = metrics.Metrics()
+    # every VNCFactory and Flaschen, and a compositor per layer with --sources
+    factories, flaschens, compositors = [], [], {}
+    if o.opts['stats']:
+        def logStats():
+            print stats.logLine()
+        task.LoopingCall(logStats).start(float(o.opts['stats']), now=False)
+
+    def makeFlaschen(layer):
+        ft = flaschen.Flaschen(targets[0][0],
+                               targets[0][1],
+                               int(o.opts['width']),
+                               int(o.opts['height']),
+                               layer,
+                               o.opts['delta'],
+                               float(o.opts['refresh']),
+                               targets,
+                               panels,
+                               int(o.opts['maxpacket']),
+                               tolerance,
+                               heartbeat)
+        ft.metrics = stats
+        flaschens.append(ft)
+        return ft
+
+    recorder = None
+    if o.opts['record']:
+        recorder = rfbrecord.Recorder(o.opts['record'])
+        reactor.addSystemEventTrigger('before', 'shutdown', recorder.close)
+
+    def makeFactory(ft):
+        factory = VNCFactory(
                 ft,
                 depth,                          #color depth
                 o.opts['fast'],                 #if a fast connection is used
                 o.opts['password'],             #password or none
                 int(o.opts['shared']),          #shared session flag
+                encodings = encodings,          #encoding preference
+                quality = quality,              #tight jpeg quality
+                compress = compress,            #tight compression level
+                pipeline = o.opts['pipeline'],  #render on a worker thread
+                max_fps = max_fps,              #frame rate cap
+                scale_filter = o.opts['scale-filter'], #downscaling filter
+                viewport = viewport,            #screen area to show
+                continuous = o.opts['continuous'], #server push
+                recorder = recorder,            #session recording
+                metrics = stats,                #stage timings
+                reconnect = not o.opts['once'], #reconnect with backoff
+        )
+        factories.append(factory)
+        return factory
+
+    if sources is None:
+        # connect to this host and port
+        reactor.connectTCP(
+            host,                               #remote hostname
+            display + 5900,                     #TCP port number
+            makeFactory(makeFlaschen(int(o.opts['layer']))),
         )
-    )
+    else:
+        # every session renders into its region, one compositor per layer
+        # sends the frames
+        for host, display, (x, y, width, height), layer in sources:
+            if layer not in compositors:
+                compositors[layer] = compositor.Compositor(makeFlaschen(layer), max_fps)
+            region = compositors[layer].region(x, y, width, height)
+            reactor.connectTCP(host, display + 5900, makeFactory(region))
+
+    # resend a standing picture
+    if heartbeat:
+        def keepalive():
+            for ft in flaschens:
+                ft.keepalive()
+        task.LoopingCall(keepalive).start(heartbeat / 2, now=False)
+
+    if o.opts['http']:
+        # /control changes the session for anyone who can reach it, so
+        # other interfaces only when asked for, e.g. --http 0.0.0.0:8080
+        interface, port = (['127.0.0.1'] + o.opts['http'].rsplit(':', 1))[-2:]
+        bridge = control.Bridge(stats, factories, flaschens, list(compositors.values()))
+        reactor.listenTCP(int(port), control.site(bridge), interface=interface)
 
     # run the application
     reactor.run()
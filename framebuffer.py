@@ -0,0 +1,159 @@
+"""
+Framebuffer for the VNC to Flaschen-Taschen bridge.
+
+MIT License
+"""
+
+import numpy
+
+# PIL
+from PIL import Image
+
+def asPixels(data):
+    """a uint8 array over a memoryview or string, without copying"""
+    if isinstance(data, memoryview):
+        return numpy.asarray(data)
+    return numpy.frombuffer(data, numpy.uint8)
+
+def expansionTable(bpp, bigendian, redmax, greenmax, bluemax, redshift, greenshift, blueshift):
+    """a (2 ** bpp, 4) lookup table from 8 or 16 bit true colour pixel
+       values to red, green, blue and a padding byte"""
+    values = numpy.arange(1 << bpp, dtype=numpy.uint32)
+    table = numpy.zeros((1 << bpp, 4), numpy.uint8)
+    for n, (max, shift) in enumerate(((redmax, redshift), (greenmax, greenshift), (bluemax, blueshift))):
+        table[:, n] = ((values >> shift & max) * 255 + max // 2) // max
+    return table
+
+class Framebuffer(object):
+    """The remote screen as a preallocated (height, width, 4) uint8 array of
+       red, green, blue and a padding byte. All writes are in place.
+
+       Pixels come in that layout, the 32 bit format RFBToGUI negotiates by
+       default, or as 8 or 16 bit true colour values that are expanded
+       through a lookup table after setPixelFormat().
+
+       The framebuffer can cover just the part of the remote screen at x, y.
+       Writes are in screen coordinates and clipped to that viewport."""
+
+    def __init__(self, width, height, x=0, y=0):
+        self.width = width
+        self.height = height
+        self.x = x
+        self.y = y
+        self.array = numpy.zeros((height, width, 4), numpy.uint8)
+        self._table = None
+
+    def setPixelFormat(self, bpp=32, depth=24, bigendian=0, truecolor=1, redmax=255, greenmax=255, bluemax=255, redshift=0, greenshift=8, blueshift=16):
+        """the pixel format of later writes, same arguments as
+           RFBClient.setPixelFormat"""
+        if bpp == 32:
+            self._table = None
+        elif bpp in (8, 16) and truecolor:
+            self._table = expansionTable(bpp, bigendian, redmax, greenmax, bluemax, redshift, greenshift, blueshift)
+            self._dtype = numpy.dtype(bpp == 8 and 'u1' or (bigendian and '>u2' or '<u2'))
+        else:
+            raise ValueError, "pixel format not supported"
+
+    def _expand(self, data):
+        """pixels as an (n, 4) array"""
+        if self._table is None:
+            return asPixels(data).reshape(-1, 4)
+        return self._table[asPixels(data).view(self._dtype)]
+
+    def clip(self, x, y, width, height):
+        """the part of a screen rectangle inside the viewport, as
+           (x, y, width, height) in framebuffer coordinates, or None"""
+        x0, y0 = max(x - self.x, 0), max(y - self.y, 0)
+        x1, y1 = min(x + width - self.x, self.width), min(y + height - self.y, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    def clipAll(self, rectangles):
+        """clip() a list of screen rectangles, dropping the ones outside"""
+        clipped = [self.clip(*rectangle) for rectangle in rectangles]
+        return [rectangle for rectangle in clipped if rectangle is not None]
+
+    def update(self, x, y, width, height, data):
+        """new pixel data, from a memoryview or string"""
+        area = self.clip(x, y, width, height)
+        if area is None:
+            return
+        cx, cy, cw, ch = area
+        pixels = self._expand(data).reshape(height, width, 4)
+        if (cw, ch) != (width, height):
+            sx, sy = cx + self.x - x, cy + self.y - y
+            pixels = pixels[sy:sy+ch, sx:sx+cw]
+        self.array[cy:cy+ch, cx:cx+cw] = pixels
+
+    def target(self, x, y, width, height):
+        """for decoding a screen rectangle straight into the array:
+           (buffer, offset, stride) as rfb.RFBClient.rectangleTarget()
+           returns it, or None if pixels need expanding or the rectangle
+           is not all inside the viewport"""
+        if self._table is not None or self.clip(x, y, width, height) != (x - self.x, y - self.y, width, height):
+            return None
+        stride = self.width * 4
+        return memoryview(self.array.reshape(-1)), (y - self.y) * stride + (x - self.x) * 4, stride
+
+    def copy(self, srcx, srcy, x, y, width, height):
+        """copyrect, source and destination may overlap. returns False if
+           part of the source lies outside the viewport, that part of the
+           destination is stale then."""
+        area = self.clip(x, y, width, height)
+        if area is None:
+            return True
+        cx, cy, cw, ch = area
+        sx, sy = srcx - x + cx, srcy - y + cy
+        complete = sx >= 0 and sy >= 0 and sx + cw <= self.width and sy + ch <= self.height
+        # copy the part of the source that is known
+        x0, y0 = max(0, -sx), max(0, -sy)
+        x1, y1 = min(cw, self.width - sx), min(ch, self.height - sy)
+        if x0 < x1 and y0 < y1:
+            self.array[cy+y0:cy+y1, cx+x0:cx+x1] = self.array[sy+y0:sy+y1, sx+x0:sx+x1]
+        return complete
+
+    def fill(self, x, y, width, height, color):
+        """fill with one pixel value"""
+        area = self.clip(x, y, width, height)
+        if area is not None:
+            cx, cy, cw, ch = area
+            self.array[cy:cy+ch, cx:cx+cw] = self._expand(color)[0]
+
+    def rgb(self):
+        """view of the red, green and blue planes, no copy"""
+        return self.array[:, :, :3]
+
+    def image(self):
+        """PIL image sharing the array's memory, no copy. it sees all
+           later writes."""
+        return Image.frombuffer('RGBX', (self.width, self.height), self.array, 'raw', 'RGBX', 0, 1)
+
+    def snapshot(self):
+        """independent copy, for rendering while decoding goes on"""
+        fb = Framebuffer(self.width, self.height, self.x, self.y)
+        fb.array[:] = self.array
+        return fb
+
+    def copyFrom(self, other, rectangles=None):
+        """copy the (x, y, width, height) rectangles in framebuffer
+           coordinates, or all pixels, from a framebuffer of the same
+           viewport"""
+        if rectangles is None:
+            self.array[:] = other.array
+            return
+        for x, y, width, height in rectangles:
+            self.array[y:y+height, x:x+width] = other.array[y:y+height, x:x+width]
+
+    def moved(self, x, y, width, height):
+        """a framebuffer for another viewport, with the pixels this one
+           already knows about copied over"""
+        fb = Framebuffer(width, height, x, y)
+        fb._table = self._table
+        fb._dtype = getattr(self, '_dtype', None)
+        area = fb.clip(self.x, self.y, self.width, self.height)
+        if area is not None:
+            cx, cy, cw, ch = area
+            sx, sy = cx + x - self.x, cy + y - self.y
+            fb.array[cy:cy+ch, cx:cx+cw] = self.array[sy:sy+ch, sx:sx+cw]
+        return fb
@@ -0,0 +1,115 @@
+"""
+Per stage timings and counters of the VNC to Flaschen Taschen bridge.
+
+The stages of a frame, as they are recorded:
+
+  receive   from the framebuffer update header to its last rectangle,
+            waiting for the network and decoding
+  decode    time spent parsing and decoding in each dataReceived()
+  scale     framebuffer to LED pixels, in RFBToGUI.render()
+  encode    building the PPM packets in Flaschen.show()
+  send      the sendto() calls of one Flaschen.show()
+
+Every stage keeps its recent samples for percentiles, recording one is a
+list store and a few additions, so this stays on in production. The
+render stages run on a worker thread with --pipeline, a lost update of a
+counter there is of no concern.
+
+The clock is not monotonic on Python 2, it is the wall clock there. A
+step of it can make a timing negative, observe() records 0 for those.
+
+MIT License
+"""
+
+#std stuff
+import time
+
+# time.monotonic where there is one, the wall clock on Python 2
+clock = getattr(time, 'monotonic', time.time)
+
+# samples kept per histogram
+HISTOGRAM_SIZE = 1024
+
+class Histogram(object):
+    """The last size samples of a value, and count, total and max of all
+       of them."""
+
+    def __init__(self, size=HISTOGRAM_SIZE):
+        self.samples = [0.0] * size
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.samples[self.count % len(self.samples)] = value
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentiles(self, *percents):
+        """the given percentiles of the kept samples"""
+        samples = sorted(self.samples[:min(self.count, len(self.samples))])
+        if not samples:
+            return [0.0] * len(percents)
+        return [samples[min(len(samples) - 1, int(len(samples) * p / 100.0))] for p in percents]
+
+    def snapshot(self):
+        p50, p95, p99 = self.percentiles(50, 95, 99)
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'mean': self.count and self.total / self.count or 0.0,
+            'p50': p50,
+            'p95': p95,
+            'p99': p99,
+            'max': self.max,
+        }
+
+class Metrics(object):
+    """Stage timings in seconds, other distributions such as rectangles
+       per update, and counters, shared by all sessions that get it."""
+
+    def __init__(self):
+        self.started = clock()
+        self.stages = {}
+        self.distributions = {}
+        self.counters = {}
+
+    def observe(self, stage, seconds):
+        """one timing of a stage, 0 if the clock went back"""
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+        histogram.add(max(0.0, seconds))
+
+    def sample(self, name, value):
+        """one value of a distribution that is not a time"""
+        histogram = self.distributions.get(name)
+        if histogram is None:
+            histogram = self.distributions[name] = Histogram()
+        histogram.add(value)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        """everything as plain dicts and numbers, times in seconds"""
+        return {
+            'uptime': clock() - self.started,
+            'stages': dict([(name, h.snapshot()) for name, h in self.stages.items()]),
+            'distributions': dict([(name, h.snapshot()) for name, h in self.distributions.items()]),
+            'counters': dict(self.counters),
+        }
+
+    def logLine(self):
+        """a one line summary of the snapshot, stage times in ms"""
+        snapshot = self.snapshot()
+        parts = []
+        for name, stage in sorted(snapshot['stages'].items()):
+            parts.append("%s %.1f/%.1f/%.1fms" % (name, stage['p50'] * 1e3, stage['p95'] * 1e3, stage['p99'] * 1e3))
+        for name, distribution in sorted(snapshot['distributions'].items()):
+            parts.append("%s %g/%g/%g" % (name, distribution['p50'], distribution['p95'], distribution['p99']))
+        for name, value in sorted(snapshot['counters'].items()):
+            parts.append("%s=%d" % (name, value))
+        return "Stats (p50/p95/p99): " + ', '.join(parts)
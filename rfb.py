@@ -4,6 +4,12 @@ RFB protocol implementattion, client side.
 Override RFBClient and RFBFactory in your application.
 See vncviewer.py for an example.
 
+The protocol itself lives in RFBClientCore, which does no I/O and can be
+fed bytes directly. RFBClient is a thin Twisted adapter on top of it.
+Other event loops drive RFBClientCore themselves: pass every chunk read
+from the socket to feed(), handle the events it returns, and write what
+data_to_send() returns to the socket after each call.
+
 Reference:
 http://www.realvnc.com/docs/rfbproto.pdf
 
@@ -12,9 +18,14 @@ http://www.realvnc.com/docs/rfbproto.pdf
 MIT License
 """
 
-import sys
-from struct import pack, unpack
+import sys, zlib
+from struct import pack, unpack, unpack_from
+from cStringIO import StringIO
 import pyDes
+import fastdes
+from metrics import clock
+import numpy
+from PIL import Image
 from twisted.python import usage, log
 from twisted.internet.protocol import Factory, Protocol
 from twisted.internet import protocol
@@ -35,6 +46,36 @@ TIGHT_ENCODING =                7
 ZLIBHEX_ENCODING =              8 
 ZRLE_ENCODING =                 16
 #0xffffff00 to 0xffffffff tight options
+#add the level (0..9) to these pseudo-encodings
+TIGHT_COMPRESS_LEVEL_0 =        0xffffff00
+TIGHT_QUALITY_LEVEL_0 =         0xffffffe0
+#the server may send a new screen size (-223), and end an update early
+#with a last rectangle marker (-224)
+DESKTOP_SIZE_ENCODING =         0xffffff21
+LAST_RECT_ENCODING =            0xffffff20
+#tigervnc extensions: the server streams updates without requests (-313),
+#and both sides can sync with fences (-312)
+CONTINUOUS_UPDATES_ENCODING =   0xfffffec7
+FENCE_ENCODING =                0xfffffec8
+
+#names of the encodings that carry pixels, for the byte counters
+ENCODING_NAMES = {
+    RAW_ENCODING:               'raw',
+    COPY_RECTANGLE_ENCODING:    'copyrect',
+    RRE_ENCODING:               'rre',
+    CORRE_ENCODING:             'corre',
+    HEXTILE_ENCODING:           'hextile',
+    ZLIB_ENCODING:              'zlib',
+    TIGHT_ENCODING:             'tight',
+    ZLIBHEX_ENCODING:           'zlibhex',
+    ZRLE_ENCODING:              'zrle',
+}
+
+#fence flags
+FENCE_BLOCK_BEFORE =            1 << 0
+FENCE_BLOCK_AFTER =             1 << 1
+FENCE_SYNC_NEXT =               1 << 2
+FENCE_REQUEST =                 1 << 31
 
 #keycodes
 #for KeyEvent()
@@ -103,39 +144,122 @@ KEY_KP_8 =      0xFFB8
 KEY_KP_9 =      0xFFB9
 KEY_KP_Enter =  0xFF8D
 
-class RFBClient(Protocol):
+#translate() tables that pull the n-th packed palette index out of a byte,
+#keyed by bits per index. used by ZRLE packed palette tiles
+_INDEX_TABLES = {}
+for _bits in (1, 2, 4):
+    _INDEX_TABLES[_bits] = [
+        str(bytearray([(b >> (8 - _bits * (n + 1))) & ((1 << _bits) - 1) for b in range(256)]))
+        for n in range(8 // _bits)]
+
+def _unpackIndices(packed, bits, width, height):
+    """expand rows of packed palette indices (each row padded to a full
+       byte) into one byte per pixel"""
+    if bits == 8:
+        return packed
+    tables = _INDEX_TABLES[bits]
+    per_byte = len(tables)
+    indices = bytearray(len(packed) * per_byte)
+    for n, table in enumerate(tables):
+        indices[n::per_byte] = packed.translate(table)
+    row = (width * bits + 7) // 8 * per_byte
+    if row != width:
+        indices = bytearray().join([indices[pos:pos+width] for pos in xrange(0, row * height, row)])
+    return indices
+
+def _pixelDtype(bypp, bigendian):
+    """the numpy dtype of one pixel"""
+    return numpy.dtype((bigendian and '>' or '<') + {1: 'u1', 2: 'u2', 4: 'u4'}[bypp])
+
+def _paletteLookup(indices, palette, bypp):
+    """map one byte palette indices to pixels, one translate() per byte
+       of the pixel instead of a lookup per pixel"""
+    pixels = bytearray(len(indices) * bypp)
+    for n in range(bypp):
+        table = bytearray(256)
+        for i, color in enumerate(palette):
+            table[i] = color[n]
+        pixels[n::bypp] = indices.translate(str(table))
+    return pixels
+
+class RFBClientCore(object):
+    """RFB client protocol state machine that does no I/O itself.
+
+    feed() takes the bytes received from the server and returns the
+    events decoded from them, data_to_send() returns the bytes for the
+    server. Events are tuples whose first item names them:
+
+      ('connected',)                        server init done
+      ('begin',)                            framebuffer update starts
+      ('rect', x, y, width, height, data)   new pixel data
+      ('copyrect', srcx, srcy, x, y, width, height)
+      ('fill', x, y, width, height, color)
+      ('commit', rectangles)                framebuffer update done
+      ('resize', width, height)             new screen size
+      ('end-continuous-updates',)
+      ('fence', flags, payload)             answer to a fence we sent
+      ('bell',)
+      ('cut-text', text)
+      ('auth-failed', reason)
+      ('close',)                            the connection should close
+
+    Events are produced by the default callbacks at the end of this class.
+    Adapters and applications override the callbacks to handle them
+    directly instead, see RFBClient for Twisted.
+    """
     
-    def __init__(self):
-        self._packet = []
-        self._packet_len = 0
+    #decode hextile with _handleDecodeHextileTiles, not tile by tile
+    batch_hextile = True
+
+    #an rfbrecord.Recorder, or anything with session(), data() and pixelFormat()
+    recorder = None
+
+    #a metrics.Metrics for the receive and decode timings, bytes per
+    #encoding and rectangles per update
+    metrics = None
+
+    def __init__(self, password=None, shared=0):
+        self.password = password
+        self.shared = shared
+        self._outgoing = []
+        self._events = []
+        #receive buffer, consumed up to _offset. handlers get memoryview
+        #slices of it, so nothing is copied until _compact() runs
+        self._buffer = bytearray()
+        self._offset = 0
         self._handler = self._handleInitial
         self._already_expecting = 0
+        self.bytes_received = 0
+        self.bytes_copied = 0
+        #ZRLE uses one zlib stream for the whole connection, Tight four
+        self._zrle_stream = zlib.decompressobj()
+        self._tight_streams = [zlib.decompressobj() for i in range(4)]
+        #metrics bookkeeping, see _countRectangleBytes
+        self._update_start = self._commit_time = 0.0
+        self._rect_encoding = None
+        self._rect_start = 0
 
     #------------------------------------------------------
     # states used on connection startup
     #------------------------------------------------------
 
     def _handleInitial(self):
-        buffer = ''.join(self._packet)
-        if '\n' in buffer:
-            if buffer[:3] == 'RFB':
+        if '\n' in self._buffer:
+            version = str(self._buffer[:12])
+            if version[:3] == 'RFB':
                 #~ print "rfb"
-                print buffer[3:-1]
-                maj, min = [int(x) for x in buffer[3:-1].split('.')]
+                print version[3:-1]
+                maj, min = [int(x) for x in version[3:-1].split('.')]
                 #print maj, min
 #                if (maj, min) not in [(3,3), (3,7), (3,8)]:
 #                    log.msg("wrong protocol version\n")
-#                    self.transport.loseConnection()
-            buffer = buffer[12:]
-            self.transport.write('RFB 003.003\n')
+#                    self._close()
+            self._offset = 12
+            self._compact()
+            self._write('RFB 003.003\n')
             log.msg("connected\n")
-            self._packet[:] = [buffer]
-            self._packet_len = len(buffer)
             self._handler = self._handleExpected
             self.expect(self._handleAuth, 4)
-        else:
-            self._packet[:] = [buffer]
-            self._packet_len = len(buffer)
     
     def _handleAuth(self, block):
         (auth,) = unpack("!I", block)
@@ -155,19 +279,19 @@ class RFBClient(Protocol):
         self.expect(self._handleConnMessage, waitfor)
 
     def _handleConnMessage(self, block):
-        log.msg("Connection refused: %r\n" % block)
+        log.msg("Connection refused: %r\n" % block.tobytes())
 
     def _handleVNCAuth(self, block):
-        self._challenge = block
+        self._challenge = block.tobytes()
         self.vncRequestPassword()
         self.expect(self._handleVNCAuthResult, 4)
 
     def sendPassword(self, password):
         """send password"""
         pw = (password + '\0' * 8)[:8]        #make sure its 8 chars long, zero padded
-        des = RFBDes(pw)
+        des = fastdes.RFBDes(pw)
         response = des.encrypt(self._challenge)
-        self.transport.write(response)
+        self._write(response)
     
     def _handleVNCAuthResult(self, block):
         (result,) = unpack("!I", block)
@@ -177,15 +301,15 @@ class RFBClient(Protocol):
             return
         elif result == 1:   #failed
             self.vncAuthFailed("autenthication failed")
-            self.transport.loseConnection()
+            self._close()
         elif result == 2:   #too many
-            slef.vncAuthFailed("too many tries to log in")
-            self.transport.loseConnection()
+            self.vncAuthFailed("too many tries to log in")
+            self._close()
         else:
             log.msg("unknown auth response (%d)\n" % auth)
         
     def _doClientInitialization(self):
-        self.transport.write(pack("!B", self.factory.shared))
+        self._write(pack("!B", self.shared))
         self.expect(self._handleServerInit, 24)
     
     def _handleServerInit(self, block):
@@ -195,10 +319,11 @@ class RFBClient(Protocol):
          self.redshift, self.greenshift, self.blueshift) = \
            unpack("!BBBBHHHBBBxxx", pixformat)
         self.bypp = self.bpp / 8        #calc bytes per pixel
+        self._setPixelSizes()
         self.expect(self._handleServerName, namelen)
         
     def _handleServerName(self, block):
-        self.name = block
+        self.name = block.tobytes()
         #callback:
         self.vncConnectionMade()
         self.expect(self._handleConnection, 1)
@@ -215,6 +340,12 @@ class RFBClient(Protocol):
             self.expect(self._handleConnection, 1)
         elif msgid == 3:
             self.expect(self._handleServerCutText, 7)
+        elif msgid == 150:
+            #the server supports continuous updates, or stopped them
+            self.endOfContinuousUpdates()
+            self.expect(self._handleConnection, 1)
+        elif msgid == 248:
+            self.expect(self._handleFence, 8)
         else:
             log.msg("unknown message received (id %d)\n" % msgid)
             self.expect(self._handleConnection, 1)
@@ -222,33 +353,81 @@ class RFBClient(Protocol):
     def _handleFramebufferUpdate(self, block):
         (self.rectangles,) = unpack("!xH", block)
         self.rectanglePos = []
+        if self.metrics is not None:
+            self._update_start = clock()
+            self._rect_encoding = None
         self.beginUpdate()
         self._doConnection()
     
     def _doConnection(self):
         if self.rectangles:
             self.expect(self._handleRectangle, 12)
+        elif self.metrics is None:
+            self.commitUpdate(self.rectanglePos)
+            self.expect(self._handleConnection, 1)
         else:
+            metrics = self.metrics
+            start = clock()
+            metrics.observe('receive', start - self._update_start)
+            self._countRectangleBytes(None, 0)
+            metrics.count('updates')
+            metrics.sample('rectangles', len(self.rectanglePos))
             self.commitUpdate(self.rectanglePos)
+            self._commit_time += clock() - start
             self.expect(self._handleConnection, 1)
+
+    def _countRectangleBytes(self, encoding, header):
+        """add the bytes since the last rectangle header to the counter
+           of its encoding and start counting for encoding. header is the
+           size of the rectangle header just consumed, if any."""
+        consumed = self.bytes_received - (len(self._buffer) - self._offset)
+        if self._rect_encoding is not None:
+            name = 'bytes.' + ENCODING_NAMES.get(self._rect_encoding, 'other')
+            self.metrics.count(name, consumed - header - self._rect_start)
+        self._rect_encoding, self._rect_start = encoding, consumed
     
     def _handleRectangle(self, block):
         (x, y, width, height, encoding) = unpack("!HHHHI", block)
         if self.rectangles:
             self.rectangles -= 1
+            if encoding in (LAST_RECT_ENCODING, DESKTOP_SIZE_ENCODING) and self.metrics is not None:
+                #the header of a pseudo-rectangle is not part of the one before
+                self._countRectangleBytes(None, 12)
+            if encoding == LAST_RECT_ENCODING:
+                #the update has fewer rectangles than announced
+                self.rectangles = 0
+                self._doConnection()
+                return
+            elif encoding == DESKTOP_SIZE_ENCODING:
+                self.width, self.height = width, height
+                self.desktopResized(width, height)
+                self._doConnection()
+                return
             self.rectanglePos.append( (x, y, width, height) )
+            if self.metrics is not None:
+                self._countRectangleBytes(encoding, 12)
             if encoding == COPY_RECTANGLE_ENCODING:
                 self.expect(self._handleDecodeCopyrect, 4, x, y, width, height)
             elif encoding == RAW_ENCODING:
                 self.expect(self._handleDecodeRAW, width*height*self.bypp, x, y, width, height)
             elif encoding == HEXTILE_ENCODING:
-                self._doNextHextileSubrect(None, None, x, y, width, height, None, None)
+                if self.batch_hextile:
+                    target = self.rectangleTarget(x, y, width, height)
+                    if target is None:
+                        target = (bytearray(width * height * self.bypp), 0, width * self.bypp)
+                    self._hextile = [x, y, width, height, x, y, '\0' * self.bypp, '\0' * self.bypp,
+                                     target]
+                    self.expectRaw(self._handleDecodeHextileTiles, 0)
+                else:
+                    self._doNextHextileSubrect(None, None, x, y, width, height, None, None)
             elif encoding == CORRE_ENCODING:
                 self.expect(self._handleDecodeCORRE, 4 + self.bypp, x, y, width, height)
             elif encoding == RRE_ENCODING:
                 self.expect(self._handleDecodeRRE, 4 + self.bypp, x, y, width, height)
-            #~ elif encoding == ZRLE_ENCODING:
-                #~ self.expect(self._handleDecodeZRLE, )
+            elif encoding == ZRLE_ENCODING:
+                self.expect(self._handleDecodeZRLE, 4, x, y, width, height)
+            elif encoding == TIGHT_ENCODING:
+                self.expect(self._handleDecodeTight, 1, x, y, width, height)
             else:
                 log.msg("unknown encoding received (encoding %d)\n" % encoding)
                 self._doConnection()
@@ -273,7 +452,7 @@ class RFBClient(Protocol):
     
     def _handleDecodeRRE(self, block, x, y, width, height):
         (subrects,) = unpack("!I", block[:4])
-        color = block[4:]
+        color = block[4:].tobytes()
         self.fillRectangle(x, y, width, height, color)
         if subrects:
             self.expect(self._handleRRESubRectangles, (8 + self.bypp) * subrects, x, y)
@@ -287,7 +466,7 @@ class RFBClient(Protocol):
         sz  = self.bypp + 8
         format = "!%dsHHHH" % self.bypp
         while pos < end:
-            (color, x, y, width, height) = unpack(format, block[pos:pos+sz])
+            (color, x, y, width, height) = unpack_from(format, block, pos)
             self.fillRectangle(topx + x, topy + y, width, height, color)
             pos += sz
         self._doConnection()
@@ -296,7 +475,7 @@ class RFBClient(Protocol):
 
     def _handleDecodeCORRE(self, block, x, y, width, height):
         (subrects,) = unpack("!I", block[:4])
-        color = block[4:]
+        color = block[4:].tobytes()
         self.fillRectangle(x, y, width, height, color)
         if subrects:
             self.expect(self._handleDecodeCORRERectangles, (4 + self.bypp)*subrects, x, y)
@@ -310,7 +489,7 @@ class RFBClient(Protocol):
         sz  = self.bypp + 4
         format = "!%dsBBBB" % self.bypp
         while pos < sz:
-            (color, x, y, width, height) = unpack(format, block[pos:pos+sz])
+            (color, x, y, width, height) = unpack_from(format, block, pos)
             self.fillRectangle(topx + x, topy + y, width, height, color)
             pos += sz
         self._doConnection()
@@ -366,11 +545,11 @@ class RFBClient(Protocol):
         subrects = 0
         pos = 0
         if subencoding & 2:     #BackgroundSpecified
-            bg = block[:self.bypp]
+            bg = block[:self.bypp].tobytes()
             pos += self.bypp
         self.fillRectangle(tx, ty, tw, th, bg)
         if subencoding & 4:     #ForegroundSpecified
-            color = block[pos:pos+self.bypp]
+            color = block[pos:pos+self.bypp].tobytes()
             pos += self.bypp
         if subencoding & 8:     #AnySubrects
             #~ (subrects, ) = unpack("!B", block)
@@ -397,7 +576,7 @@ class RFBClient(Protocol):
         end = len(block)
         while pos < end:
             pos2 = pos + self.bypp
-            color = block[pos:pos2]
+            color = block[pos:pos2].tobytes()
             xy = ord(block[pos2])
             wh = ord(block[pos2+1])
             sx = xy >> 4
@@ -424,10 +603,374 @@ class RFBClient(Protocol):
         self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
 
 
+    def _handleDecodeHextileTiles(self):
+        """decode as many whole hextile tiles as the buffer holds, straight
+           into the buffer rectangleTarget() gave, or a pixel buffer for the
+           rectangle. at the end of the buffer, wait for the rest of the
+           next tile."""
+        x, y, width, height, tx, ty, bg, fg, target = self._hextile
+        pixels, base, stride = target
+        buffer = self._buffer
+        end = len(buffer)
+        pos = self._offset
+        bypp = self.bypp
+        need = 0
+        while ty < y + height:
+            tw = min(16, x + width - tx)
+            th = min(16, y + height - ty)
+            #size of the whole tile
+            if pos >= end:
+                need = 1
+                break
+            subencoding = buffer[pos]
+            if subencoding & 1:
+                size = 1 + tw * th * bypp
+            else:
+                size = 1
+                if subencoding & 2:
+                    size += bypp
+                if subencoding & 4:
+                    size += bypp
+                if subencoding & 8:
+                    if pos + size >= end:
+                        need = size + 1
+                        break
+                    if subencoding & 16:
+                        size += 1 + buffer[pos+size] * (bypp + 2)
+                    else:
+                        size += 1 + buffer[pos+size] * 2
+            if pos + size > end:
+                need = size
+                break
+            #rasterize it
+            p = pos + 1
+            dst = base + (ty - y) * stride + (tx - x) * bypp
+            row = tw * bypp
+            if subencoding & 1:
+                for line in xrange(th):
+                    pixels[dst:dst+row] = buffer[p:p+row]
+                    p += row
+                    dst += stride
+            else:
+                if subencoding & 2:
+                    bg = buffer[p:p+bypp]
+                    p += bypp
+                line = bg * tw
+                for n in xrange(th):
+                    pixels[dst+n*stride:dst+n*stride+row] = line
+                if subencoding & 4:
+                    fg = buffer[p:p+bypp]
+                    p += bypp
+                if subencoding & 8:
+                    subrects = buffer[p]
+                    p += 1
+                    color = fg
+                    for n in xrange(subrects):
+                        if subencoding & 16:
+                            color = buffer[p:p+bypp]
+                            p += bypp
+                        xy = buffer[p]
+                        wh = buffer[p+1]
+                        p += 2
+                        #clipped to the tile, past its edge they would
+                        #land on the neighbouring tiles or rows
+                        sx, sy = xy >> 4, xy & 0xf
+                        sw = min((wh >> 4) + 1, tw - sx)
+                        sh = min((wh & 0xf) + 1, th - sy)
+                        if sw <= 0 or sh <= 0:
+                            continue
+                        line = color * sw
+                        sw *= bypp
+                        sub = dst + sy * stride + sx * bypp
+                        for i in xrange(sh):
+                            pixels[sub:sub+sw] = line
+                            sub += stride
+            pos += size
+            tx += 16
+            if tx >= x + width:
+                tx = x
+                ty += 16
+        self._offset = pos
+        if ty < y + height:
+            self._hextile[4:8] = [tx, ty, bg, fg]
+            self.expectRaw(self._handleDecodeHextileTiles, need)
+        else:
+            self._hextile = None
+            if isinstance(pixels, bytearray) and pixels:
+                self.updateRectangle(x, y, width, height, memoryview(pixels))
+            self._doConnection()
+
     # ---  ZRLE Encoding
     
-    def _handleDecodeZRLE(self, block):
-        raise NotImplementedError
+    def _setPixelSizes(self):
+        """ZRLE sends 32 bit pixels as 3 byte CPIXELs when all colour bits
+           fit into the 3 least or most significant bytes. remember the
+           size and on which side the padding byte goes. Tight sends them
+           as 3 byte r, g, b TPIXELs for 24 bit depth."""
+        self.cpixel = self.bypp
+        self._cpixel_pad_first = False
+        if self.truecolor and self.bpp == 32 and self.depth <= 24:
+            mask = (self.redmax << self.redshift) | (self.greenmax << self.greenshift) | (self.bluemax << self.blueshift)
+            if mask & 0xff000000 == 0:
+                self.cpixel = 3
+                self._cpixel_pad_first = bool(self.bigendian)
+            elif mask & 0x000000ff == 0:
+                self.cpixel = 3
+                self._cpixel_pad_first = not self.bigendian
+        self.tpixel = self.bypp
+        if (self.truecolor and self.bpp == 32 and self.depth == 24 and
+                self.redmax == self.greenmax == self.bluemax == 255):
+            self.tpixel = 3
+        #r, g, b bytes to their bits of a pixel, for _rgbToPixels
+        self._pixel_dtype = _pixelDtype(self.bypp, self.bigendian)
+        self._channel_tables = [
+            (numpy.arange(256, dtype=numpy.uint32) * high // 255) << shift
+            for shift, high in ((self.redshift, self.redmax), (self.greenshift, self.greenmax),
+                                (self.blueshift, self.bluemax))]
+
+    def _expandCPixels(self, data):
+        """convert a bytearray of CPIXELs to the pixel format"""
+        if self.cpixel == self.bypp:
+            return data
+        pixels = bytearray(len(data) // 3 * 4)
+        first = self._cpixel_pad_first and 1 or 0
+        for n in range(3):
+            pixels[first+n::4] = data[n::3]
+        return pixels
+
+    def _rgbToPixels(self, data):
+        """convert a bytearray of r, g, b triplets to the pixel format"""
+        if self.tpixel == 3:
+            #channels are whole bytes, move them in place
+            pixels = bytearray(len(data) // 3 * 4)
+            for n, shift in enumerate((self.redshift, self.greenshift, self.blueshift)):
+                if self.bigendian:
+                    pixels[3-shift//8::4] = data[n::3]
+                else:
+                    pixels[shift//8::4] = data[n::3]
+            return pixels
+        rgb = numpy.frombuffer(data, numpy.uint8)[:len(data) // 3 * 3].reshape(-1, 3)
+        red, green, blue = self._channel_tables
+        pixels = red[rgb[:, 0]] | green[rgb[:, 1]] | blue[rgb[:, 2]]
+        return bytearray(pixels.astype(self._pixel_dtype).tostring())
+
+    def _expandTPixels(self, data):
+        """convert a bytearray of TPIXELs to the pixel format"""
+        if self.tpixel == self.bypp:
+            return data
+        return self._rgbToPixels(data)
+
+    def _handleDecodeZRLE(self, block, x, y, width, height):
+        (length,) = unpack("!I", block)
+        self.expect(self._handleDecodeZRLEData, length, x, y, width, height)
+
+    def _handleDecodeZRLEData(self, block, x, y, width, height):
+        data = bytearray(self._zrle_stream.decompress(block.tobytes()))
+        bypp = self.bypp
+        cpixel = self.cpixel
+        stride = width * bypp
+        pixels = bytearray(stride * height)
+        pos = 0
+        for ty in xrange(0, height, 64):
+            th = min(64, height - ty)
+            for tx in xrange(0, width, 64):
+                tw = min(64, width - tx)
+                count = tw * th
+                subencoding = data[pos]
+                pos += 1
+                if subencoding == 0:        #raw CPIXELs
+                    end = pos + count * cpixel
+                    tile = self._expandCPixels(data[pos:end])
+                    pos = end
+                elif subencoding == 1:      #solid
+                    tile = self._expandCPixels(data[pos:pos+cpixel]) * count
+                    pos += cpixel
+                elif subencoding <= 16:     #packed palette
+                    end = pos + subencoding * cpixel
+                    palette = self._expandCPixels(data[pos:end])
+                    palette = [palette[i:i+bypp] for i in xrange(0, len(palette), bypp)]
+                    if subencoding == 2:
+                        bits = 1
+                    elif subencoding <= 4:
+                        bits = 2
+                    else:
+                        bits = 4
+                    pos = end
+                    end = pos + (tw * bits + 7) // 8 * th
+                    tile = _paletteLookup(_unpackIndices(data[pos:end], bits, tw, th), palette, bypp)
+                    pos = end
+                elif subencoding == 128:    #plain RLE
+                    runs = []
+                    while count > 0:
+                        color = data[pos:pos+cpixel]
+                        pos += cpixel
+                        run = 1
+                        while data[pos] == 255:
+                            run += 255
+                            pos += 1
+                        run += data[pos]
+                        pos += 1
+                        runs.append(color * run)
+                        count -= run
+                    tile = self._expandCPixels(bytearray().join(runs))
+                elif subencoding >= 130:    #palette RLE
+                    end = pos + (subencoding - 128) * cpixel
+                    palette = self._expandCPixels(data[pos:end])
+                    palette = [palette[i:i+bypp] for i in xrange(0, len(palette), bypp)]
+                    pos = end
+                    runs = []
+                    while count > 0:
+                        index = data[pos]
+                        pos += 1
+                        run = 1
+                        if index & 128:
+                            while data[pos] == 255:
+                                run += 255
+                                pos += 1
+                            run += data[pos]
+                            pos += 1
+                        runs.append(palette[index & 127] * run)
+                        count -= run
+                    tile = bytearray().join(runs)
+                else:
+                    log.msg("unknown ZRLE subencoding (%d)\n" % subencoding)
+                    self._close()
+                    return
+                #copy the tile into the rectangle, row by row
+                row = tw * bypp
+                dst = ty * stride + tx * bypp
+                for src in xrange(0, row * th, row):
+                    pixels[dst:dst+row] = tile[src:src+row]
+                    dst += stride
+        self.updateRectangle(x, y, width, height, memoryview(pixels))
+        self._doConnection()
+
+    # ---  Tight Encoding
+
+    def _expectCompactLength(self, handler, *args):
+        """read a 1..3 byte compact length, then call handler(length, *args)"""
+        self.expect(self._handleCompactLength, 1, 0, 0, handler, args)
+
+    def _handleCompactLength(self, block, length, shift, handler, args):
+        (value,) = unpack("!B", block)
+        if shift == 14:
+            handler(length | value << 14, *args)
+        elif value & 0x80:
+            self.expect(self._handleCompactLength, 1, length | (value & 0x7f) << shift, shift + 7, handler, args)
+        else:
+            handler(length | value << shift, *args)
+
+    def _handleDecodeTight(self, block, x, y, width, height):
+        (control,) = unpack("!B", block)
+        for stream in range(4):
+            if control & (1 << stream):
+                self._tight_streams[stream] = zlib.decompressobj()
+        compression = control >> 4
+        if compression == 8:        #fill
+            self.expect(self._handleDecodeTightFill, self.tpixel, x, y, width, height)
+        elif compression == 9:      #jpeg
+            self._expectCompactLength(self._doTightJPEG, x, y, width, height)
+        elif compression > 9:
+            log.msg("invalid Tight compression control (0x%02x)\n" % control)
+            self._close()
+        elif compression & 4:       #explicit filter
+            self.expect(self._handleDecodeTightFilter, 1, compression & 3, x, y, width, height)
+        else:
+            self._doTightData(compression & 3, 0, None, x, y, width, height)
+
+    def _handleDecodeTightFill(self, block, x, y, width, height):
+        color = self._expandTPixels(bytearray(block))
+        self.fillRectangle(x, y, width, height, str(color))
+        self._doConnection()
+
+    def _doTightJPEG(self, length, x, y, width, height):
+        self.expect(self._handleDecodeTightJPEG, length, x, y, width, height)
+
+    def _handleDecodeTightJPEG(self, block, x, y, width, height):
+        img = Image.open(StringIO(block.tobytes())).convert('RGB')
+        pixels = self._rgbToPixels(bytearray(img.tobytes()))
+        self.updateRectangle(x, y, width, height, memoryview(pixels))
+        self._doConnection()
+
+    def _handleDecodeTightFilter(self, block, stream, x, y, width, height):
+        (filter,) = unpack("!B", block)
+        if filter == 1:             #palette
+            self.expect(self._handleDecodeTightPaletteSize, 1, stream, x, y, width, height)
+        elif filter in (0, 2):      #copy, gradient
+            self._doTightData(stream, filter, None, x, y, width, height)
+        else:
+            log.msg("invalid Tight filter (%d)\n" % filter)
+            self._close()
+
+    def _handleDecodeTightPaletteSize(self, block, stream, x, y, width, height):
+        (colors,) = unpack("!B", block)
+        self.expect(self._handleDecodeTightPalette, (colors + 1) * self.tpixel, stream, x, y, width, height)
+
+    def _handleDecodeTightPalette(self, block, stream, x, y, width, height):
+        bypp = self.bypp
+        palette = self._expandTPixels(bytearray(block))
+        palette = [palette[i:i+bypp] for i in xrange(0, len(palette), bypp)]
+        self._doTightData(stream, 1, palette, x, y, width, height)
+
+    def _doTightData(self, stream, filter, palette, x, y, width, height):
+        if filter == 1 and len(palette) == 2:
+            size = (width + 7) // 8 * height
+        elif filter == 1:
+            size = width * height
+        else:
+            size = width * height * self.tpixel
+        if size < 12:               #short data is sent uncompressed
+            self.expect(self._handleDecodeTightData, size, None, filter, palette, x, y, width, height)
+        else:
+            self._expectCompactLength(self._doTightCompressedData, stream, filter, palette, x, y, width, height)
+
+    def _doTightCompressedData(self, length, stream, filter, palette, x, y, width, height):
+        self.expect(self._handleDecodeTightData, length, stream, filter, palette, x, y, width, height)
+
+    def _handleDecodeTightData(self, block, stream, filter, palette, x, y, width, height):
+        if stream is None:
+            data = bytearray(block)
+        else:
+            data = bytearray(self._tight_streams[stream].decompress(block.tobytes()))
+        if filter == 1:
+            indices = data
+            if len(palette) == 2:
+                indices = _unpackIndices(data, 1, width, height)
+            pixels = _paletteLookup(indices, palette, self.bypp)
+        elif filter == 2:
+            pixels = self._expandTPixels(self._tightGradient(data, width, height))
+        else:
+            pixels = self._expandTPixels(data)
+        self.updateRectangle(x, y, width, height, memoryview(pixels))
+        self._doConnection()
+
+    def _tightGradient(self, data, width, height):
+        """undo the gradient filter: each channel was sent as the
+           difference to left + above - above left, clamped. a pixel only
+           depends on the ones left and above it, so the pixels of each
+           diagonal are predicted together."""
+        if self.tpixel == 3:
+            shifts, highs = (0, 8, 16), (255, 255, 255)
+            diffs = numpy.frombuffer(data, numpy.uint8)[:width * height * 3].reshape(height, width, 3).astype(numpy.int32)
+        else:
+            shifts = (self.redshift, self.greenshift, self.blueshift)
+            highs = (self.redmax, self.greenmax, self.bluemax)
+            values = numpy.frombuffer(data, self._pixel_dtype)[:width * height].astype(numpy.int32)
+            diffs = numpy.dstack([(values >> shift & high).reshape(height, width)
+                                  for shift, high in zip(shifts, highs)])
+        high = numpy.array(highs, numpy.int32)
+        #a row and column of zeros above and left of the pixels
+        pixels = numpy.zeros((height + 1, width + 1, 3), numpy.int32)
+        for diagonal in xrange(2, height + width + 1):
+            rows = numpy.arange(max(1, diagonal - width), min(height, diagonal - 1) + 1)
+            columns = diagonal - rows
+            predicted = pixels[rows, columns - 1] + pixels[rows - 1, columns] - pixels[rows - 1, columns - 1]
+            pixels[rows, columns] = (numpy.clip(predicted, 0, high) + diffs[rows - 1, columns - 1]) & high
+        pixels = pixels[1:, 1:]
+        if self.tpixel == 3:
+            return bytearray(pixels.astype(numpy.uint8).tostring())
+        value = pixels[:, :, 0] << shifts[0] | pixels[:, :, 1] << shifts[1] | pixels[:, :, 2] << shifts[2]
+        return bytearray(value.astype(self._pixel_dtype).tostring())
 
     # ---  other server messages
     
@@ -436,37 +979,103 @@ class RFBClient(Protocol):
         self.expect(self._handleServerCutTextValue, length)
     
     def _handleServerCutTextValue(self, block):
-        self.copy_text(block)
+        self.copy_text(block.tobytes())
         self.expect(self._handleConnection, 1)
     
+    # ---  Fence
+
+    def _handleFence(self, block):
+        (flags, length) = unpack("!xxxIB", block)
+        self.expect(self._handleFencePayload, length, flags)
+
+    def _handleFencePayload(self, block, flags):
+        payload = block.tobytes()
+        if flags & FENCE_REQUEST:
+            #messages are handled strictly in order, so the blocking and
+            #sync flags hold already. answer right away, this is what
+            #servers measure the round trip and throttle their output by
+            self.fence(flags & (FENCE_BLOCK_BEFORE | FENCE_BLOCK_AFTER | FENCE_SYNC_NEXT), payload)
+        else:
+            self.fenceResponse(flags, payload)
+        self.expect(self._handleConnection, 1)
+
     #------------------------------------------------------
     # incomming data redirector
     #------------------------------------------------------
-    def dataReceived(self, data):
+    def feed(self, data):
+        """process bytes received from the server, return the list of
+           events they produced"""
         #~ sys.stdout.write(repr(data) + '\n')
-        #~ print len(data), ", ", len(self._packet)
-        self._packet.append(data)
-        self._packet_len += len(data)
-        self._handler()
+        #~ print len(data), ", ", len(self._buffer) - self._offset
+        self._buffer += data
+        self.bytes_received += len(data)
+        self.bytes_copied += len(data)
+        if self.metrics is None:
+            self._handler()
+        else:
+            start = clock()
+            self._commit_time = 0.0
+            self._handler()
+            #commitUpdate() renders, that is not decoding
+            self.metrics.observe('decode', clock() - start - self._commit_time)
+        events, self._events = self._events, []
+        return events
+
+    def data_to_send(self):
+        """return the bytes queued for the server and clear the queue"""
+        data = ''.join(self._outgoing)
+        self._outgoing = []
+        return data
+
+    def _write(self, data):
+        self._outgoing.append(data)
+
+    def _close(self):
+        self._events.append(('close',))
 
     def _handleExpected(self):
-        if self._packet_len >= self._expected_len:
-            buffer = ''.join(self._packet)
-            while len(buffer) >= self._expected_len:
-                self._already_expecting = 1
-                block, buffer = buffer[:self._expected_len], buffer[self._expected_len:]
-                #~ log.msg("handle %r with %r\n" % (block, self._expected_handler.__name__))
-                self._expected_handler(block, *self._expected_args, **self._expected_kwargs)
-            self._packet[:] = [buffer]
-            self._packet_len = len(buffer)
+        buffer = self._buffer
+        if len(buffer) - self._offset >= self._expected_len:
+            view = memoryview(buffer)
+            self._already_expecting = 1
+            while len(buffer) - self._offset >= self._expected_len:
+                if self._expected_raw:
+                    self._expected_handler(*self._expected_args, **self._expected_kwargs)
+                    continue
+                start = self._offset
+                self._offset = end = start + self._expected_len
+                #~ log.msg("handle %r with %r\n" % (view[start:end].tobytes(), self._expected_handler.__name__))
+                self._expected_handler(view[start:end], *self._expected_args, **self._expected_kwargs)
+            del view
             self._already_expecting = 0
+            self._compact()
+
+    def _compact(self):
+        """drop consumed bytes from the front of the receive buffer.
+           only the unparsed tail is moved, which is at most one
+           incomplete message."""
+        if self._offset:
+            self.bytes_copied += len(self._buffer) - self._offset
+            del self._buffer[:self._offset]
+            self._offset = 0
     
     def expect(self, handler, size, *args, **kwargs):
         #~ log.msg("expect(%r, %r, %r, %r)\n" % (handler.__name__, size, args, kwargs))
+        self._expect(handler, size, args, kwargs, False)
+
+    def expectRaw(self, handler, size, *args, **kwargs):
+        """like expect(), but handler gets no block. once size bytes are
+           there it parses self._buffer from self._offset itself and
+           advances the offset past what it used. it must expect() again,
+           or expectRaw() more bytes than there are."""
+        self._expect(handler, size, args, kwargs, True)
+
+    def _expect(self, handler, size, args, kwargs, raw):
         self._expected_handler = handler
         self._expected_len = size
         self._expected_args = args
         self._expected_kwargs = kwargs
+        self._expected_raw = raw
         if not self._already_expecting:
             self._handleExpected()   #just in case that there is already enough data
     
@@ -476,58 +1085,121 @@ class RFBClient(Protocol):
     
     def setPixelFormat(self, bpp=32, depth=24, bigendian=0, truecolor=1, redmax=255, greenmax=255, bluemax=255, redshift=0, greenshift=8, blueshift=16):
         pixformat = pack("!BBBBHHHBBBxxx", bpp, depth, bigendian, truecolor, redmax, greenmax, bluemax, redshift, greenshift, blueshift)
-        self.transport.write(pack("!Bxxx16s", 0, pixformat))
+        self._write(pack("!Bxxx16s", 0, pixformat))
+        if self.recorder is not None:
+            self.recorder.pixelFormat(pixformat)
         #rember these settings
         self.bpp, self.depth, self.bigendian, self.truecolor = bpp, depth, bigendian, truecolor
         self.redmax, self.greenmax, self.bluemax = redmax, greenmax, bluemax
         self.redshift, self.greenshift, self.blueshift = redshift, greenshift, blueshift
         self.bypp = self.bpp / 8        #calc bytes per pixel
+        self._setPixelSizes()
         #~ print self.bypp
 
     def setEncodings(self, list_of_encodings):
-        self.transport.write(pack("!BxH", 2, len(list_of_encodings)))
+        self._write(pack("!BxH", 2, len(list_of_encodings)))
         for encoding in list_of_encodings:
-            self.transport.write(pack("!I", encoding))
+            self._write(pack("!I", encoding))
     
     def framebufferUpdateRequest(self, x=0, y=0, width=None, height=None, incremental=0):
         if width  is None: width  = self.width - x
         if height is None: height = self.height - y
-        self.transport.write(pack("!BBHHHH", 3, incremental, x, y, width, height))
+        self._write(pack("!BBHHHH", 3, incremental, x, y, width, height))
+
+    def enableContinuousUpdates(self, enable=1, x=0, y=0, width=None, height=None):
+        """let the server send updates of the area without waiting for
+           requests. only after endOfContinuousUpdates() was called once,
+           which says that the server supports it."""
+        if width  is None: width  = self.width - x
+        if height is None: height = self.height - y
+        self._write(pack("!BBHHHH", 150, enable, x, y, width, height))
+
+    def fence(self, flags, payload=''):
+        """send a fence, with FENCE_REQUEST the server answers it once
+           everything before it is processed"""
+        self._write(pack("!BxxxIB", 248, flags, len(payload)) + payload)
 
     def keyEvent(self, key, down=1):
         """For most ordinary keys, the "keysym" is the same as the corresponding ASCII value.
         Other common keys are shown in the KEY_ constants."""
-        self.transport.write(pack("!BBxxI", 4, down, key))
+        self._write(pack("!BBxxI", 4, down, key))
 
     def pointerEvent(self, x, y, buttonmask=0):
         """Indicates either pointer movement or a pointer button press or release. The pointer is
            now at (x-position, y-position), and the current state of buttons 1 to 8 are represented
            by bits 0 to 7 of button-mask respectively, 0 meaning up, 1 meaning down (pressed).
         """
-        self.transport.write(pack("!BBHH", 5, buttonmask, x, y))
+        self._write(pack("!BBHH", 5, buttonmask, x, y))
 
     def clientCutText(self, message):
         """The client has new ASCII text in its cut buffer.
            (aka clipboard)
         """
-        self.transport.write(pack("!BxxxI", 6, len(message)) + message)
+        self._write(pack("!BxxxI", 6, len(message)) + message)
     
     #------------------------------------------------------
     # callbacks
-    # override these in your application
+    # by default they queue events for feed() to return
     #------------------------------------------------------
     def vncConnectionMade(self):
-        """connection is initialized and ready.
-           typicaly, the pixel format is set here."""
+        self._events.append(('connected',))
 
     def vncRequestPassword(self):
         """a password is needed to log on, use sendPassword() to
            send one."""
-        if self.factory.password is None:
+        if self.password is None:
             log.msg("need a password\n")
-            self.transport.loseConnection()
+            self._close()
             return
-        self.sendPassword(self.factory.password)
+        self.sendPassword(self.password)
+
+    def vncAuthFailed(self, reason):
+        self._events.append(('auth-failed', reason))
+
+    def beginUpdate(self):
+        self._events.append(('begin',))
+
+    def commitUpdate(self, rectangles=None):
+        self._events.append(('commit', rectangles))
+
+    def desktopResized(self, width, height):
+        self._events.append(('resize', width, height))
+
+    def endOfContinuousUpdates(self):
+        self._events.append(('end-continuous-updates',))
+
+    def fenceResponse(self, flags, payload):
+        self._events.append(('fence', flags, payload))
+
+    def updateRectangle(self, x, y, width, height, data):
+        self._events.append(('rect', x, y, width, height, data.tobytes()))
+
+    def rectangleTarget(self, x, y, width, height):
+        return None
+
+    def copyRectangle(self, srcx, srcy, x, y, width, height):
+        self._events.append(('copyrect', srcx, srcy, x, y, width, height))
+
+    def fillRectangle(self, x, y, width, height, color):
+        self._events.append(('fill', x, y, width, height, color))
+
+    def bell(self):
+        self._events.append(('bell',))
+
+    def copy_text(self, text):
+        self._events.append(('cut-text', text))
+
+class RFBCallbacks(object):
+    """callbacks for adapters such as RFBClient, with no-op defaults in
+       place of RFBClientCore's events"""
+
+    #------------------------------------------------------
+    # callbacks
+    # override these in your application
+    #------------------------------------------------------
+    def vncConnectionMade(self):
+        """connection is initialized and ready.
+           typicaly, the pixel format is set here."""
 
     def vncAuthFailed(self, reason):
         """called when the authentication failed.
@@ -545,10 +1217,32 @@ class RFBClient(Protocol):
            update with FramebufferUpdateRequest(incremental=1).
            argument is a list of tuples (x,y,w,h) with the updated
            rectangles."""
+
+    def desktopResized(self, width, height):
+        """the server changed the screen size, width and height are
+           already updated. only sent with DESKTOP_SIZE_ENCODING in the
+           encoding list."""
+
+    def endOfContinuousUpdates(self):
+        """the server supports continuous updates, the first time it is
+           called after CONTINUOUS_UPDATES_ENCODING was set, or it stopped
+           sending them after enableContinuousUpdates(0)"""
+
+    def fenceResponse(self, flags, payload):
+        """the server answered a fence sent with FENCE_REQUEST"""
         
     def updateRectangle(self, x, y, width, height, data):
-        """new bitmap data. data is a string in the pixel format set
-           up earlier."""
+        """new bitmap data. data is a memoryview in the pixel format set
+           up earlier. it is only valid during the call, use data.tobytes()
+           to keep a copy."""
+
+    def rectangleTarget(self, x, y, width, height):
+        """where to decode a hextile rectangle straight into, instead of
+           getting it through updateRectangle(): (buffer, offset, stride),
+           a writable buffer of pixels in the pixel format set up earlier,
+           with the rectangle's top left pixel at offset and its rows
+           stride bytes apart. None for updateRectangle()."""
+        return None
     
     def copyRectangle(self, srcx, srcy, x, y, width, height):
         """used for copyrect encoding. copy the given rectangle
@@ -559,7 +1253,7 @@ class RFBClient(Protocol):
            the pixel format set up earlier"""
         #fallback variant, use update recatngle
         #override with specialized function for better performance
-        self.updateRectangle(x, y, width, height, color*width*height)
+        self.updateRectangle(x, y, width, height, memoryview(color*width*height))
 
     def bell(self):
         """bell"""
@@ -568,18 +1262,54 @@ class RFBClient(Protocol):
         """The server has new ASCII text in its cut buffer.
            (aka clipboard)"""
 
+class RFBClient(RFBCallbacks, RFBClientCore, Protocol):
+    """Twisted adapter, the password, shared flag, recorder and metrics
+       come from the factory"""
+
+    def __init__(self):
+        RFBClientCore.__init__(self)
+
+    def connectionMade(self):
+        factory = getattr(self, 'factory', None)
+        if factory is not None:
+            self.password = factory.password
+            self.shared = factory.shared
+            self.recorder = getattr(factory, 'recorder', None)
+            self.metrics = getattr(factory, 'metrics', None)
+        if self.recorder is not None:
+            self.recorder.session()
+
+    def dataReceived(self, data):
+        if self.recorder is not None:
+            self.recorder.data(data)
+        self.feed(data)
+
+    def _write(self, data):
+        self.transport.write(data)
+
+    def _close(self):
+        self.transport.loseConnection()
+
 class RFBFactory(protocol.ClientFactory):
     """A factory for remote frame buffer connections."""
 
     # the class of the protocol to build
     # should be overriden by application to use a derrived class
     protocol = RFBClient
+
+    # set to an rfbrecord.Recorder to record the sessions
+    recorder = None
+
+    # set to a metrics.Metrics to time the sessions
+    metrics = None
     
     def __init__(self, password = None, shared = 0):
         self.password = password
         self.shared = shared
 
 class RFBDes(pyDes.des):
+    """the pyDes reference for fastdes.RFBDes, which authentication uses"""
+
     def setKey(self, key):
         """RFB protocol for authentication requires client to encrypt
            challenge sent by server with password using DES method. However,
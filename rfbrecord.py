@@ -0,0 +1,136 @@
+"""
+Recording and replay of the bytes a VNC server sends, for offline
+benchmarks of decoding, scaling and Flaschen Taschen output.
+
+A recording is a magic string followed by records of a one byte type,
+the microseconds since the previous record and the payload length:
+
+  'D'   server to client bytes, as dataReceived() got them
+  'P'   the 16 byte pixel format the client asked for with setPixelFormat
+  'S'   a new connection starts, empty: a client that reconnects records
+        every session into the same file, each from its handshake on
+
+Files ending in .gz are gzip compressed.
+
+MIT License
+"""
+
+from twisted.internet import error
+from twisted.python import failure
+
+#std stuff
+import time, gzip
+from struct import pack, unpack
+
+MAGIC = "RFBREC\0\1"
+RECORD_HEADER = "!cII"
+RECORD_HEADER_SIZE = 9
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+class Recorder(object):
+    """Writes a recording. Give it to a factory as its recorder, the
+       RFBClients it builds then call session(), data() and
+       pixelFormat()."""
+
+    def __init__(self, path):
+        self.file = _open(path, 'wb')
+        self.file.write(MAGIC)
+        self._last = time.time()
+
+    def _record(self, kind, payload):
+        now = time.time()
+        delta = min(int((now - self._last) * 1e6), 0xffffffff)
+        self._last = now
+        self.file.write(pack(RECORD_HEADER, kind, delta, len(payload)) + payload)
+
+    def session(self):
+        """a connection starts"""
+        self._record('S', '')
+
+    def data(self, data):
+        """bytes from the server"""
+        self._record('D', data)
+
+    def pixelFormat(self, pixformat):
+        """the pixel format message body the client sent"""
+        self._record('P', pixformat)
+
+    def close(self):
+        self.file.close()
+
+class Recording(object):
+    """A recording read back: the (seconds since start, bytes) chunks of the
+       server stream, the same split into sessions, one list per
+       connection, and the keyword arguments of the first setPixelFormat()
+       call, or None."""
+
+    def __init__(self, path):
+        self.chunks = []
+        self.sessions = [[]]
+        self.pixel_format = None
+        f = _open(path, 'rb')
+        try:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError, "%s is not a recording" % path
+            now = 0.0
+            while True:
+                header = f.read(RECORD_HEADER_SIZE)
+                if len(header) < RECORD_HEADER_SIZE:
+                    break
+                kind, delta, length = unpack(RECORD_HEADER, header)
+                payload = f.read(length)
+                now += delta / 1e6
+                if kind == 'D':
+                    self.chunks.append((now, payload))
+                    self.sessions[-1].append((now, payload))
+                elif kind == 'S' and self.sessions[-1]:
+                    self.sessions.append([])
+                elif kind == 'P' and self.pixel_format is None:
+                    self.pixel_format = parsePixelFormat(payload)
+        finally:
+            f.close()
+
+    def size(self):
+        """bytes of server data"""
+        return sum([len(data) for when, data in self.chunks])
+
+    def duration(self):
+        """seconds from the first to the last chunk"""
+        if not self.chunks:
+            return 0.0
+        return self.chunks[-1][0] - self.chunks[0][0]
+
+def parsePixelFormat(pixformat):
+    """setPixelFormat() keyword arguments for a pixel format message body"""
+    names = ('bpp', 'depth', 'bigendian', 'truecolor', 'redmax', 'greenmax',
+             'bluemax', 'redshift', 'greenshift', 'blueshift')
+    return dict(zip(names, unpack("!BBBBHHHBBBxxx", pixformat)))
+
+def replay(recording, connect, paced=False):
+    """feed the recorded stream into client protocols, as fast as they
+       take it or, when paced, at the recorded times. connect() returns a
+       new connected client for every session, the one before is told
+       that its connection was lost. no network or reactor is involved.
+       returns the seconds it took."""
+    start = time.time()
+    first = recording.chunks[0][0] if recording.chunks else 0.0
+    client = None
+    for chunks in recording.sessions:
+        if client is not None:
+            client.connectionLost(failure.Failure(error.ConnectionDone()))
+        client = connect()
+        for when, data in chunks:
+            if paced:
+                wait = (when - first) - (time.time() - start)
+                if wait > 0:
+                    time.sleep(wait)
+            client.dataReceived(data)
+            # nobody reads what the client sends back
+            transport = getattr(client, 'transport', None)
+            if transport is not None and hasattr(transport, 'clear'):
+                transport.clear()
+    return time.time() - start
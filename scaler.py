@@ -0,0 +1,216 @@
+"""
+Downscaling of the VNC framebuffer to the Flaschen Taschen grid.
+
+MIT License
+"""
+
+import numpy
+
+# PIL
+from PIL import Image
+
+#std stuff
+import math
+from fractions import gcd
+
+# above this many damaged rectangles one full resize is cheaper
+MAX_REGIONS = 32
+
+# filter support in output pixels, for the PIL resampling filters
+RESAMPLE_SUPPORT = {Image.NEAREST: 0, Image.BOX: 0, Image.BILINEAR: 1,
+                    Image.HAMMING: 1, Image.BICUBIC: 2, Image.LANCZOS: 3}
+
+class RegionScaler(object):
+    """Scales a framebuffer image to the LED grid, recomputing only the
+       output cells that a list of damaged source rectangles can reach."""
+
+    def __init__(self, src_size, dst_size, resample=Image.BILINEAR):
+        self.src_size = src_size
+        self.dst_size = dst_size
+        self.resample = resample
+        self.image = Image.new('RGB', dst_size)
+        self._valid = False
+        self._mapAreas(RESAMPLE_SUPPORT[resample])
+
+    def _mapAreas(self, support):
+        """set up the mapping between source pixels and output cells for
+           a filter reaching support output pixels beyond a cell"""
+        src_w, src_h = self.src_size
+        dst_w, dst_h = self.dst_size
+
+        # area map: the source box of every output cell, and the first and
+        # one past the last cell that every source column and row covers,
+        # more than one when upscaling
+        self._x_edges = [float(i * src_w) / dst_w for i in xrange(dst_w + 1)]
+        self._y_edges = [float(i * src_h) / dst_h for i in xrange(dst_h + 1)]
+        self._col_cell = [x * dst_w // src_w for x in xrange(src_w)]
+        self._row_cell = [y * dst_h // src_h for y in xrange(src_h)]
+        self._col_end = [min(dst_w, ((x + 1) * dst_w + src_w - 1) // src_w) for x in xrange(src_w)]
+        self._row_end = [min(dst_h, ((y + 1) * dst_h + src_h - 1) // src_h) for y in xrange(src_h)]
+
+        # the filter reads this many source pixels beyond a cell's box, plus
+        # one for the pixels that straddle the edge between two cells
+        self._margin_x = int(math.ceil(support * max(1.0, float(src_w) / dst_w))) + 1
+        self._margin_y = int(math.ceil(support * max(1.0, float(src_h) / dst_h))) + 1
+
+        # PIL only resamples a box of the frame exactly like the whole frame
+        # when the box starts on a whole source pixel, which it does every
+        # dst / gcd(src, dst) cells
+        self._align_x = dst_w // gcd(src_w, dst_w)
+        self._align_y = dst_h // gcd(src_h, dst_h)
+
+    def invalidate(self):
+        """recompute every cell on the next update"""
+        self._valid = False
+
+    def cells(self, rectangles):
+        """map damaged source rectangles (x, y, w, h) to boxes of output
+           cells (x0, y0, x1, y1), merging the ones that overlap"""
+        src_w, src_h = self.src_size
+        dst_w, dst_h = self.dst_size
+        boxes = []
+        for x, y, width, height in rectangles:
+            if width <= 0 or height <= 0 or x >= src_w or y >= src_h:
+                continue
+            x0 = self._col_cell[max(0, x - self._margin_x)]
+            y0 = self._row_cell[max(0, y - self._margin_y)]
+            x1 = self._col_end[min(src_w - 1, x + width - 1 + self._margin_x)]
+            y1 = self._row_end[min(src_h - 1, y + height - 1 + self._margin_y)]
+            ax, ay = self._align_x, self._align_y
+            x0, y0 = x0 // ax * ax, y0 // ay * ay
+            x1, y1 = min(dst_w, -(-x1 // ax) * ax), min(dst_h, -(-y1 // ay) * ay)
+            box = (x0, y0, x1, y1)
+            # fold in every box that overlaps, until none does
+            merged = True
+            while merged:
+                merged = False
+                for other in boxes:
+                    if (other[0] < box[2] and box[0] < other[2] and
+                            other[1] < box[3] and box[1] < other[3]):
+                        boxes.remove(other)
+                        box = (min(box[0], other[0]), min(box[1], other[1]),
+                               max(box[2], other[2]), max(box[3], other[3]))
+                        merged = True
+                        break
+            boxes.append(box)
+        return boxes
+
+    def update(self, fb, rectangles=None):
+        """bring the scaled image up to date with the Framebuffer fb and
+           return it. without rectangles, or on the first call, everything
+           is recomputed."""
+        src = fb.image()
+        if not self._valid or rectangles is None or len(rectangles) > MAX_REGIONS:
+            self.image = src.resize(self.dst_size, resample=self.resample)
+            self._valid = True
+            return self.image
+        for x0, y0, x1, y1 in self.cells(rectangles):
+            box = (self._x_edges[x0], self._y_edges[y0], self._x_edges[x1], self._y_edges[y1])
+            part = src.resize((x1 - x0, y1 - y0), resample=self.resample, box=box)
+            self.image.paste(part, (x0, y0))
+        return self.image
+
+def _boxWeights(src, dst, i):
+    """exact area overlap of source pixels with output pixel i"""
+    scale = float(src) / dst
+    a, b = i * scale, (i + 1) * scale
+    j0, j1 = int(math.floor(a)), min(src, int(math.ceil(b)))
+    return j0, numpy.array([min(b, j + 1) - max(a, j) for j in xrange(j0, j1)])
+
+def _lanczosWeights(src, dst, i):
+    """lanczos3, stretched by the scale factor when downscaling"""
+    scale = float(src) / dst
+    stretch = max(scale, 1.0)
+    center = (i + 0.5) * scale
+    j0 = max(0, int(math.floor(center - 3 * stretch)))
+    j1 = min(src, int(math.ceil(center + 3 * stretch)))
+    x = (numpy.arange(j0, j1) + 0.5 - center) / stretch
+    return j0, numpy.sinc(x) * numpy.sinc(x / 3)
+
+# filter name: (weight function, support in output pixels)
+FILTERS = {
+    'box':      (_boxWeights, 0),
+    'lanczos':  (_lanczosWeights, 3),
+}
+
+_weights = {}
+
+def weights(src, dst, name):
+    """the rows of a src -> dst resampling matrix, as a list of
+       (first source index, normalized float32 weights) bands. cached, so
+       they are only built once per size."""
+    key = (src, dst, name)
+    if key not in _weights:
+        function = FILTERS[name][0]
+        bands = []
+        for i in xrange(dst):
+            start, w = function(src, dst, i)
+            bands.append((start, (w / w.sum()).astype(numpy.float32)))
+        _weights[key] = bands
+    return _weights[key]
+
+class MatrixScaler(RegionScaler):
+    """Scales the framebuffer array with precomputed resampling matrices,
+       one product for the rows and one for the columns. Like RegionScaler
+       only the output cells that damaged rectangles reach are recomputed.
+
+       The row matrix is kept as bands, each output row reads a few source
+       rows only. The column matrix is small enough to be dense."""
+
+    def __init__(self, src_size, dst_size, filter='box'):
+        self.src_size = src_size
+        self.dst_size = dst_size
+        self.filter = filter
+        src_w, src_h = src_size
+        dst_w, dst_h = dst_size
+        self.pixels = numpy.zeros((dst_h, dst_w, 3), numpy.uint8)
+        self.image = Image.new('RGB', dst_size)
+        self._valid = False
+        self._mapAreas(FILTERS[filter][1])
+        # the matrices give any box of cells, aligned or not
+        self._align_x = self._align_y = 1
+
+        self._rows = weights(src_h, dst_h, filter)
+        self._columns = numpy.zeros((src_w, dst_w), numpy.float32)
+        for i, (start, w) in enumerate(weights(src_w, dst_w, filter)):
+            self._columns[start:start + len(w), i] = w
+
+    def _scale(self, array, x0, y0, x1, y1):
+        """recompute the output cells in the box x0, y0 - x1, y1"""
+        rows = self._rows[y0:y1]
+        top = rows[0][0]
+        bottom = max([start + len(w) for start, w in rows])
+        columns = self._columns[:, x0:x1]
+        used = numpy.nonzero(columns.any(axis=1))[0]
+        left, right = used[0], used[-1] + 1
+        width = right - left
+
+        # rows first: each output row is a weighted sum of a band of
+        # source rows, every source pixel is converted to float once
+        block = array[top:bottom, left:right].reshape(bottom - top, width * 4).astype(numpy.float32)
+        tmp = numpy.empty((y1 - y0, width * 4), numpy.float32)
+        for i, (start, w) in enumerate(rows):
+            numpy.dot(w, block[start - top:start - top + len(w)], out=tmp[i])
+
+        # then columns, as (rows * channels, width) x (width, cells)
+        tmp = tmp.reshape(y1 - y0, width, 4).transpose(0, 2, 1).reshape((y1 - y0) * 4, width)
+        out = numpy.dot(tmp, columns[left:right]).reshape(y1 - y0, 4, x1 - x0)
+        out = out.transpose(0, 2, 1)[:, :, :3]
+        # lanczos lobes can over- and undershoot
+        numpy.clip(out + 0.5, 0, 255, out=out)
+        self.pixels[y0:y1, x0:x1] = out
+
+    def update(self, fb, rectangles=None):
+        """bring the scaled image up to date with the Framebuffer fb and
+           return it. without rectangles, or on the first call, everything
+           is recomputed."""
+        if not self._valid or rectangles is None or len(rectangles) > MAX_REGIONS:
+            boxes = [(0, 0) + self.dst_size]
+            self._valid = True
+        else:
+            boxes = self.cells(rectangles)
+        for box in boxes:
+            self._scale(fb.array, *box)
+        # PIL can't share memory with a 3 byte per pixel array
+        self.image = Image.fromarray(self.pixels, 'RGB')
+        return self.image
@@ -0,0 +1,58 @@
+"""
+POST /control applies every setting of a request, or none of them when
+any is invalid.
+
+  python -m unittest test_control
+
+MIT License
+"""
+
+import unittest, json
+
+from twisted.web.test.requesthelper import DummyRequest
+
+import control, flaschen, flaschenvnc, metrics
+
+class ControlTest(unittest.TestCase):
+
+    def setUp(self):
+        # no receiver, and nothing is sent before the first frame anyway
+        self.ft = flaschen.Flaschen('127.0.0.1', 9, 45, 35)
+        factories = [flaschenvnc.VNCFactory(self.ft, 32, False, None, 0) for i in xrange(2)]
+        self.bridge = control.Bridge(metrics.Metrics(), factories, [self.ft])
+        self.page = control.ControlPage(self.bridge)
+
+    def tearDown(self):
+        self.ft.sock.close()
+
+    def post(self, **args):
+        request = DummyRequest(['control'])
+        request.method = 'POST'
+        request.args = dict([(key, [value]) for key, value in args.items()])
+        body = self.page.render_POST(request)
+        return request.responseCode or 200, body
+
+    def testApply(self):
+        code, body = self.post(fps='15', brightness='0.0', viewport='0,0,960,540', source='1')
+        self.assertEqual(code, 200)
+        state = json.loads(body)
+        self.assertEqual(state['fps'], 15.0)
+        self.assertEqual(state['brightness'], 0.0)
+        self.assertEqual(state['sources'][0]['viewport'], None)
+        self.assertEqual(state['sources'][1]['viewport'], [0, 0, 960, 540])
+        code, body = self.post(fps='0')
+        self.assertEqual(json.loads(body)['fps'], None)
+
+    def testInvalid(self):
+        before = self.bridge.state()
+        for args in [dict(fps='-1', brightness='0.5'),
+                     dict(fps='10', brightness='1.5'),
+                     dict(brightness='0.5', viewport='1,2'),
+                     dict(fps='10', brightness='nan'),
+                     dict(fps='10', source='2', viewport='full')]:
+            code, body = self.post(**args)
+            self.assertEqual(code, 400, args)
+            self.assertEqual(self.bridge.state(), before, args)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+"""
+fastdes gives the known DES vectors and the same results as pyDes, with
+and without the VNC bit reversal of the key.
+
+  python -m unittest test_fastdes
+
+MIT License
+"""
+
+import unittest, random
+
+import pyDes
+
+import fastdes, rfb
+
+# FIPS 81 / textbook DES vectors, key, plaintext, ciphertext
+DES_VECTORS = [
+    ("133457799bbcdff1", "0123456789abcdef", "85e813540f0ab405"),
+    ("0123456789abcdef", "4e6f772069732074", "3fa40e8a984d4815"),
+    ("0000000000000000", "0000000000000000", "8ca64de9c1b123a7"),
+]
+
+class DESTest(unittest.TestCase):
+
+    def testVectors(self):
+        for key, plain, cipher in DES_VECTORS:
+            key, plain, cipher = key.decode('hex'), plain.decode('hex'), cipher.decode('hex')
+            self.assertEqual(fastdes.DES(key).encrypt(plain), cipher)
+            self.assertEqual(fastdes.DES(key).decrypt(cipher), plain)
+
+    def testRandomKeys(self):
+        rnd = random.Random(0)
+        for i in xrange(200):
+            key = "".join([chr(rnd.randrange(256)) for n in xrange(8)])
+            challenge = "".join([chr(rnd.randrange(256)) for n in xrange(16)])
+            self.assertEqual(fastdes.DES(key).encrypt(challenge), pyDes.des(key).encrypt(challenge))
+            self.assertEqual(fastdes.RFBDes(key).encrypt(challenge), rfb.RFBDes(key).encrypt(challenge))
+
+    def testLastKey(self):
+        first = fastdes.schedule("password")
+        self.assertTrue(fastdes.schedule("password") is first)
+        fastdes.schedule("another!")
+        self.assertEqual(fastdes._last[0], "another!")
+        self.assertEqual(fastdes.schedule("password"), first)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+"""
+Frames sent by Flaschen reassemble exactly at local UDP receivers: tiles
+of a small max packet, round-robin targets and a panel map, in full and
+in delta mode. A brightness change shows on a frame that stands still,
+and only black pixels are lifted, not the zero channels of colours.
+
+  python -m unittest test_flaschen
+
+MIT License
+"""
+
+import unittest, socket
+
+import numpy
+
+import flaschen, fakeflaschen
+
+WIDTH, HEIGHT = 45, 35
+
+def lifted(frame):
+    """frame as the LEDs should show it: black pixels are lifted to 1, 1, 1"""
+    frame = frame.copy()
+    frame[(frame == 0).all(axis=2)] = 1
+    return frame
+
+def receivers(n):
+    sockets = []
+    for i in xrange(n):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(0.02)
+        sockets.append(sock)
+    return sockets
+
+def drain(sock, receiver):
+    """feed every datagram waiting on sock into receiver"""
+    while True:
+        try:
+            data, address = sock.recvfrom(65536)
+        except socket.timeout:
+            return
+        receiver.datagramReceived(data, address)
+
+class ReassemblyTest(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(0)
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def frames(self):
+        """a random frame with some black pixels, then changes to a few
+           boxes of it"""
+        frame = numpy.random.randint(0, 256, (HEIGHT, WIDTH, 3)).astype(numpy.uint8)
+        frame[5:8, 5:30] = 0
+        yield frame
+        for x, y, w, h in [(3, 4, 5, 2), (40, 30, 5, 5), (0, 0, WIDTH, 1), (10, 10, 20, 20)]:
+            frame = frame.copy()
+            frame[y:y+h, x:x+w] = numpy.random.randint(0, 256, (h, w, 3))
+            yield frame
+
+    def show(self, ft, frame):
+        ft.set_buffer(frame.tostring())
+        ft.show()
+        return lifted(frame)
+
+    def checkTargets(self, n, max_packet, delta):
+        """tiles go round-robin to n receivers, at offsets of the whole
+           frame, so their packets together make up the frame"""
+        self.sockets = receivers(n)
+        targets = [sock.getsockname() for sock in self.sockets]
+        ft = flaschen.Flaschen(targets[0][0], targets[0][1], WIDTH, HEIGHT,
+                               delta=delta, refresh=3600, targets=targets, max_packet=max_packet)
+        wall = fakeflaschen.FlaschenReceiver(WIDTH, HEIGHT)
+        for frame in self.frames():
+            expected = self.show(ft, frame)
+            for sock in self.sockets:
+                drain(sock, wall)
+            self.assertEqual(wall.errors, 0)
+            self.assertTrue((wall.canvas == expected).all())
+        return wall
+
+    def testTiles(self):
+        wall = self.checkTargets(1, 500, False)
+        self.assertTrue(wall.packets >= 5 * (WIDTH * HEIGHT * 3) // 500)
+
+    def testTilesDelta(self):
+        wall = self.checkTargets(1, 500, True)
+        # one full frame, then the changed boxes only
+        self.assertTrue(wall.bytes_received < 2 * WIDTH * HEIGHT * 3)
+
+    def testRoundRobin(self):
+        self.checkTargets(3, 700, False)
+
+    def testRoundRobinDelta(self):
+        wall = self.checkTargets(3, 700, True)
+        self.assertTrue(wall.bytes_received < 2 * WIDTH * HEIGHT * 3)
+
+    def checkPanels(self, max_packet, delta):
+        """each receiver gets its panel, at offsets relative to it"""
+        boxes = [(0, 0, 23, 18), (23, 0, 22, 18), (0, 18, 23, 17), (23, 18, 22, 17)]
+        self.sockets = receivers(len(boxes))
+        panels = [(sock.getsockname(), box) for sock, box in zip(self.sockets, boxes)]
+        ft = flaschen.Flaschen('127.0.0.1', 1, WIDTH, HEIGHT, delta=delta, refresh=3600,
+                               panels=panels, max_packet=max_packet)
+        walls = [fakeflaschen.FlaschenReceiver(w, h) for x, y, w, h in boxes]
+        for frame in self.frames():
+            expected = self.show(ft, frame)
+            for sock, wall, (x, y, w, h) in zip(self.sockets, walls, boxes):
+                drain(sock, wall)
+                self.assertEqual(wall.errors, 0)
+                self.assertTrue((wall.canvas == expected[y:y+h, x:x+w]).all())
+
+    def testPanels(self):
+        self.checkPanels(flaschen.MAX_PACKET, False)
+
+    def testPanelsTiles(self):
+        self.checkPanels(400, False)
+
+    def testPanelsDelta(self):
+        self.checkPanels(400, True)
+
+class BrightnessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, = receivers(1)
+        host, port = self.sock.getsockname()
+        self.ft = flaschen.Flaschen(host, port, WIDTH, HEIGHT, delta=True, tolerance=0)
+        self.wall = fakeflaschen.FlaschenReceiver(WIDTH, HEIGHT)
+
+    def tearDown(self):
+        self.sock.close()
+
+    def testBeforeShow(self):
+        self.ft.set_brightness(0.5)
+        drain(self.sock, self.wall)
+        self.assertEqual(self.wall.packets, 0)
+
+    def testStandingStill(self):
+        numpy.random.seed(0)
+        frame = numpy.random.randint(0, 256, (HEIGHT, WIDTH, 3)).astype(numpy.uint8)
+        self.ft.set_buffer(frame.tostring())
+        self.ft.set(0, 0, (200, 100, 0))
+        frame[0, 0] = (200, 100, 0)
+        self.ft.show()
+        for brightness in [0.5, 0.0, 1.0]:
+            self.ft.set_brightness(brightness)
+            drain(self.sock, self.wall)
+            expected = lifted(numpy.floor(frame * brightness + 0.5).astype(numpy.uint8))
+            self.assertEqual(self.wall.errors, 0)
+            self.assertTrue((self.wall.canvas == expected).all(), brightness)
+            self.assertEqual(self.ft.brightness, brightness)
+
+class LiftTest(unittest.TestCase):
+
+    def testPrimaries(self):
+        """only black is lifted, saturated colours keep their zeros"""
+        sock, = receivers(1)
+        host, port = sock.getsockname()
+        ft = flaschen.Flaschen(host, port, 4, 1)
+        wall = fakeflaschen.FlaschenReceiver(4, 1)
+        ft.set_buffer('\xff\0\0' '\0\xff\0' '\0\0\xff' '\0\0\0')
+        ft.show()
+        drain(sock, wall)
+        sock.close()
+        self.assertEqual(wall.canvas.tolist(), [[[255, 0, 0], [0, 255, 0], [0, 0, 255], [1, 1, 1]]])
+        ft.set(0, 0, (0, 0, 0))
+        ft.set(1, 0, (0, 0, 255))
+        self.assertEqual(str(ft.pixels.tobytes()), '\1\1\1' '\0\0\xff' '\0\0\xff' '\1\1\1')
+
+if __name__ == '__main__':
+    unittest.main()
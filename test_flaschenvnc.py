@@ -0,0 +1,119 @@
+"""
+Command line parsing of flaschenvnc.py, negative --heartbeat and
+--tolerance rejected as usage errors, and the update requests of
+RFBToGUI when the viewport moves.
+
+  python -m unittest test_flaschenvnc
+
+MIT License
+"""
+
+import unittest, struct
+
+from twisted.internet.address import IPv4Address
+from twisted.python import usage
+from twisted.test import proto_helpers
+
+import flaschen, flaschenvnc, fakevnc
+
+class ParseSourcesTest(unittest.TestCase):
+
+    def parse(self, spec, layer=3):
+        return flaschenvnc.parseSources(spec, layer, 45, 35)
+
+    def testSources(self):
+        self.assertEqual(self.parse("a:1@0,0,22,35;b@23,0,22,35,5"),
+                         [('a', 1, (0, 0, 22, 35), 3), ('b', 0, (23, 0, 22, 35), 5)])
+
+    def testLayerZero(self):
+        self.assertEqual(self.parse("a@0,0,45,35,0"), [('a', 0, (0, 0, 45, 35), 0)])
+
+    def testPastTheEdge(self):
+        # clipped later, but still on the wall
+        self.assertEqual(self.parse("@40,30,20,20"), [('localhost', 0, (40, 30, 20, 20), 3)])
+
+    def testInvalid(self):
+        for spec in ["a@45,0,10,10", "a@0,35,10,10", "a@-1,0,10,10", "a@0,-5,10,10",
+                     "a@0,0,0,10", "a@0,0,10,-1", "a@0,0,10", "a@0,0,10,10,1,1"]:
+            self.assertRaises(ValueError, self.parse, spec)
+
+class OptionsTest(unittest.TestCase):
+
+    def parse(self, *args):
+        o = flaschenvnc.Options()
+        o.parseOptions(list(args))
+        return o
+
+    def testDefaults(self):
+        o = self.parse()
+        self.assertEqual((o.opts['tolerance'], o.opts['heartbeat']), (0, 1.0))
+
+    def testValues(self):
+        o = self.parse('--tolerance', 'off', '--heartbeat', '0')
+        self.assertEqual((o.opts['tolerance'], o.opts['heartbeat']), (None, 0.0))
+        o = self.parse('--tolerance', '4', '--heartbeat', '2.5')
+        self.assertEqual((o.opts['tolerance'], o.opts['heartbeat']), (4, 2.5))
+
+    def testInvalid(self):
+        for args in [('--heartbeat', '-1'), ('--heartbeat', 'nan'), ('--heartbeat', 'x'),
+                     ('--tolerance', '-1'), ('--tolerance', 'x')]:
+            self.assertRaises(usage.UsageError, self.parse, *args)
+
+def pump(client, server):
+    """pass the bytes written on either side to the other, until they
+       have nothing more to say"""
+    while client.transport.value() or server.transport.value():
+        data = server.transport.value()
+        server.transport.clear()
+        if data:
+            client.dataReceived(data)
+        data = client.transport.value()
+        client.transport.clear()
+        if data:
+            server.dataReceived(data)
+
+def updateRequests(data):
+    """(incremental, x, y, width, height) of the FramebufferUpdateRequests
+       in data, which holds nothing else"""
+    requests = []
+    for pos in xrange(0, len(data), 10):
+        kind, incremental, x, y, width, height = struct.unpack("!BBHHHH", data[pos:pos+10])
+        assert kind == 3
+        requests.append((incremental, x, y, width, height))
+    return requests
+
+class ViewportTest(unittest.TestCase):
+
+    def setUp(self):
+        # no receiver, lost datagrams are only counted
+        self.ft = flaschen.Flaschen('127.0.0.1', 9, 45, 35)
+        factory = flaschenvnc.VNCFactory(self.ft, 32, False, None, 0, viewport=(0, 0, 32, 24))
+        self.client = factory.buildProtocol(IPv4Address('TCP', '127.0.0.1', 5900))
+        self.client.makeConnection(proto_helpers.StringTransport())
+        self.server = fakevnc.FakeVNCFactory(64, 48).buildProtocol(IPv4Address('TCP', '127.0.0.1', 40000))
+        self.server.makeConnection(proto_helpers.StringTransport())
+        # the handshake and the first, requested update
+        pump(self.client, self.server)
+        self.client.pacer.stop()
+
+    def tearDown(self):
+        self.client.pacer.stop()
+        self.ft.sock.close()
+
+    def testPanWithThePacer(self):
+        """the pixels the new viewport needs are asked for with the
+           pacer's next request, not in between"""
+        self.client.pan(16, 8)
+        self.assertEqual(self.client.transport.value(), '')
+        self.client.requestUpdate()
+        self.assertEqual(updateRequests(self.client.transport.value()),
+                         [(0, 16, 8, 32, 24), (1, 16, 8, 32, 24)])
+
+    def testZoom(self):
+        self.client.zoom(2)
+        self.assertEqual((self.client.fb.width, self.client.fb.height), (16, 12))
+        for factor in (0, -1):
+            self.assertRaises(ValueError, self.client.zoom, factor)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+"""
+Stage timings of the metrics.
+
+  python -m unittest test_metrics
+
+MIT License
+"""
+
+import unittest
+
+import metrics
+
+class MetricsTest(unittest.TestCase):
+
+    def testClockStep(self):
+        """a wall clock that went back records 0, not a negative time"""
+        m = metrics.Metrics()
+        m.observe('scale', -0.5)
+        m.observe('scale', 0.25)
+        stage = m.snapshot()['stages']['scale']
+        self.assertEqual((stage['count'], stage['sum'], stage['max']), (2, 0.25, 0.25))
+        self.assertEqual(min(m.stages['scale'].samples[:2]), 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+"""
+Batched hextile decoding, straight into the framebuffer or through
+updateRectangle(), paints the same pixels as tile by tile decoding, in
+whole and in small chunks, and keeps subrects inside their tile. The
+bytes per encoding leave out the headers of pseudo-rectangles. Tight's
+r, g, b pixels and gradient filter convert like a pixel by pixel loop.
+
+  python -m unittest test_rfb
+
+MIT License
+"""
+
+import unittest, random, struct
+
+import numpy
+
+import rfb, framebuffer, metrics
+
+class FramebufferClient(rfb.RFBClientCore):
+    """decodes into a Framebuffer, straight or through updateRectangle()"""
+
+    def __init__(self, fb, batch, direct):
+        rfb.RFBClientCore.__init__(self)
+        self.fb = fb
+        self.batch_hextile = batch
+        self.direct = direct
+        self.width, self.height = 64, 48
+        self.setPixelFormat()
+        self.data_to_send()
+        self._handler = self._handleExpected
+        self.expect(self._handleConnection, 1)
+
+    def rectangleTarget(self, x, y, width, height):
+        if not self.direct:
+            return None
+        return self.fb.target(x, y, width, height)
+
+    def updateRectangle(self, x, y, width, height, data):
+        self.fb.update(x, y, width, height, data)
+
+    def fillRectangle(self, x, y, width, height, color):
+        self.fb.fill(x, y, width, height, color)
+
+def hextile(rnd, x, y, width, height, overflow=False):
+    """a FramebufferUpdate of one hextile rectangle with solid, subrect
+       and raw tiles. with overflow, some subrects run past their tile."""
+    def color():
+        return struct.pack("BBBB", rnd.randrange(256), rnd.randrange(256), rnd.randrange(256), 0)
+    data = [struct.pack("!BxH", 0, 1), struct.pack("!HHHHI", x, y, width, height, rfb.HEXTILE_ENCODING)]
+    for ty in xrange(0, height, 16):
+        for tx in xrange(0, width, 16):
+            tw, th = min(16, width - tx), min(16, height - ty)
+            kind = rnd.random()
+            if kind < 0.2:
+                data.append(struct.pack("!B", 2) + color())
+            elif kind < 0.9:
+                coloured = kind >= 0.6 and 16 or 4
+                subrects = rnd.randrange(1, 12)
+                tile = [struct.pack("!B", 2 | 8 | coloured) + color()]
+                if coloured == 4:
+                    tile.append(color())
+                tile.append(struct.pack("!B", subrects))
+                for i in xrange(subrects):
+                    if coloured == 16:
+                        tile.append(color())
+                    if overflow:
+                        sx, sy, sw, sh = [rnd.randrange(1, 17) for n in xrange(4)]
+                        sx, sy = sx - 1, sy - 1
+                    else:
+                        sx, sy = rnd.randrange(tw), rnd.randrange(th)
+                        sw, sh = rnd.randrange(1, tw - sx + 1), rnd.randrange(1, th - sy + 1)
+                    tile.append(struct.pack("!BB", sx << 4 | sy, (sw - 1) << 4 | (sh - 1)))
+                data.append("".join(tile))
+            else:
+                data.append(struct.pack("!B", 1) + "".join([color() for i in xrange(tw * th)]))
+    return "".join(data)
+
+def clamped(data, width, height):
+    """the same update with the subrects clipped to their tiles, and the
+       ones that start outside dropped"""
+    out, pos = [data[:16]], 16
+    for ty in xrange(0, height, 16):
+        for tx in xrange(0, width, 16):
+            tw, th = min(16, width - tx), min(16, height - ty)
+            subencoding = ord(data[pos])
+            if subencoding & 1:
+                size = 1 + tw * th * 4
+                out.append(data[pos:pos+size])
+                pos += size
+                continue
+            size = 1 + (subencoding & 2 and 4) + (subencoding & 4 and 4)
+            out.append(data[pos:pos+size])
+            pos += size
+            if not subencoding & 8:
+                continue
+            subrects = []
+            for i in xrange(ord(data[pos])):
+                color = ''
+                if subencoding & 16:
+                    color = data[pos+1:pos+5]
+                    pos += 4
+                xy, wh = ord(data[pos+1]), ord(data[pos+2])
+                pos += 2
+                sx, sy = xy >> 4, xy & 0xf
+                sw, sh = min((wh >> 4) + 1, tw - sx), min((wh & 0xf) + 1, th - sy)
+                if sw > 0 and sh > 0:
+                    subrects.append(color + struct.pack("!BB", xy, (sw - 1) << 4 | (sh - 1)))
+            pos += 1
+            out.append(chr(len(subrects)) + "".join(subrects))
+    return "".join(out)
+
+class HextileTest(unittest.TestCase):
+
+    def decode(self, data, viewport, batch, direct, chunk):
+        fb = framebuffer.Framebuffer(*viewport)
+        client = FramebufferClient(fb, batch, direct)
+        for pos in xrange(0, len(data), chunk):
+            client.feed(data[pos:pos+chunk])
+        # the next message is awaited, nothing is left over
+        self.assertEqual(client._expected_handler, client._handleConnection)
+        return fb.array
+
+    def check(self, data, reference=None):
+        reference = reference or data
+        for viewport in [(64, 48), (30, 30, 10, 10)]:
+            expected = self.decode(reference, viewport, False, False, len(reference))
+            for direct in (True, False):
+                for chunk in (len(data), 7):
+                    pixels = self.decode(data, viewport, True, direct, chunk)
+                    self.assertTrue((pixels == expected).all(), (viewport, direct, chunk))
+
+    def testTiles(self):
+        rnd = random.Random(0)
+        for i in xrange(5):
+            self.check(hextile(rnd, 5, 3, 50, 37))
+
+    def testSubrectsPastTheTile(self):
+        rnd = random.Random(1)
+        for i in xrange(5):
+            data = hextile(rnd, 5, 3, 50, 37, overflow=True)
+            self.check(data, clamped(data, 50, 37))
+
+class ExpectRawTest(unittest.TestCase):
+
+    def testRawBeforeDispatch(self):
+        """a handler expected raw gets no block, even when the bytes are
+           already there"""
+        client = rfb.RFBClientCore()
+        client._buffer = bytearray("abcd")
+        calls = []
+        def handler():
+            calls.append(client._offset)
+            client._offset += 4
+            client.expect(lambda block: None, 1)
+        client.expectRaw(handler, 4)
+        self.assertEqual(calls, [0])
+
+class ByteCountTest(unittest.TestCase):
+
+    def testPseudoRectangles(self):
+        raw = struct.pack("!HHHHI", 0, 0, 4, 4, rfb.RAW_ENCODING) + "\x80" * 64
+        # LastRect ends an update that announced more rectangles
+        for count, pseudo in [(3, struct.pack("!HHHHI", 0, 0, 0, 0, rfb.LAST_RECT_ENCODING)),
+                              (2, struct.pack("!HHHHI", 0, 0, 64, 48, rfb.DESKTOP_SIZE_ENCODING))]:
+            client = FramebufferClient(framebuffer.Framebuffer(64, 48), True, True)
+            client.metrics = metrics.Metrics()
+            client.feed(struct.pack("!BxH", 0, count) + raw + pseudo)
+            self.assertEqual(client.metrics.counters['bytes.raw'], 64)
+            self.assertEqual(client.metrics.counters['updates'], 1)
+
+# 16 and 8 bit true colour, as flaschenvnc asks for them, and a 32 bit
+# one with the channels in the high bytes
+PIXEL_FORMATS = [
+    dict(bpp=16, depth=16, redmax=31, greenmax=63, bluemax=31, redshift=11, greenshift=5, blueshift=0),
+    dict(bpp=16, depth=16, bigendian=1, redmax=31, greenmax=63, bluemax=31, redshift=11, greenshift=5, blueshift=0),
+    dict(bpp=8, depth=8, redmax=7, greenmax=7, bluemax=3, redshift=0, greenshift=3, blueshift=6),
+    dict(bpp=32, depth=32, bigendian=1, redshift=24, greenshift=16, blueshift=8),
+    dict(),
+]
+
+def pack(client, r, g, b):
+    value = r << client.redshift | g << client.greenshift | b << client.blueshift
+    return struct.pack((client.bigendian and '>' or '<') + {1: 'B', 2: 'H', 4: 'I'}[client.bypp], value)
+
+def channels(client, data, pos):
+    """r, g, b of the tpixel at pos"""
+    if client.tpixel == 3:
+        return tuple(data[pos:pos+3])
+    (value,) = struct.unpack_from((client.bigendian and '>' or '<') + {1: 'B', 2: 'H', 4: 'I'}[client.bypp], data, pos)
+    return (value >> client.redshift & client.redmax, value >> client.greenshift & client.greenmax,
+            value >> client.blueshift & client.bluemax)
+
+def gradient(client, data, width, height):
+    """the gradient filter undone one pixel after the other"""
+    highs = client.tpixel == 3 and (255, 255, 255) or (client.redmax, client.greenmax, client.bluemax)
+    out = []
+    above = [(0, 0, 0)] * width
+    for row in xrange(height):
+        left = upleft = (0, 0, 0)
+        line = []
+        for column in xrange(width):
+            diff = channels(client, data, (row * width + column) * client.tpixel)
+            up = above[column]
+            left = tuple([(min(high, max(0, l + u - ul)) + d) & high
+                          for l, u, ul, d, high in zip(left, up, upleft, diff, highs)])
+            upleft = up
+            line.append(left)
+        above = line
+        for r, g, b in line:
+            out.append(client.tpixel == 3 and chr(r) + chr(g) + chr(b) or pack(client, r, g, b))
+    return "".join(out)
+
+class TightPixelsTest(unittest.TestCase):
+
+    def testConversions(self):
+        rnd = random.Random(0)
+        for pixel_format in PIXEL_FORMATS:
+            client = rfb.RFBClientCore()
+            client.setPixelFormat(**pixel_format)
+            for width, height in [(1, 1), (16, 16), (37, 5), (0, 3)]:
+                rgb = bytearray([rnd.randrange(256) for i in xrange(width * height * 3)])
+                expected = "".join([pack(client, r * client.redmax // 255, g * client.greenmax // 255,
+                                         b * client.bluemax // 255)
+                                    for r, g, b in zip(rgb[0::3], rgb[1::3], rgb[2::3])])
+                self.assertEqual(str(client._rgbToPixels(rgb)), expected, pixel_format)
+                data = bytearray([rnd.randrange(256) for i in xrange(width * height * client.tpixel)])
+                self.assertEqual(str(client._tightGradient(data, width, height)),
+                                 gradient(client, data, width, height), pixel_format)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""
+A recording of a client that reconnected replays session by session,
+each from its own handshake, to the screens the server sent.
+
+  python -m unittest test_rfbrecord
+
+MIT License
+"""
+
+import unittest, os, tempfile
+
+import numpy
+
+from twisted.internet.address import IPv4Address
+from twisted.test import proto_helpers
+
+import rfb, rfbrecord, flaschen, flaschenvnc, fakevnc
+
+WIDTH, HEIGHT = 64, 48
+
+def pump(client, server):
+    """pass the bytes written on either side to the other, until they
+       have nothing more to say"""
+    while client.transport.value() or server.transport.value():
+        data = server.transport.value()
+        server.transport.clear()
+        if data:
+            client.dataReceived(data)
+        data = client.transport.value()
+        client.transport.clear()
+        if data:
+            server.dataReceived(data)
+
+class RecordingTest(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(0)
+        fd, self.path = tempfile.mkstemp('.rec')
+        os.close(fd)
+        # no receiver, lost datagrams are only counted
+        self.ft = flaschen.Flaschen('127.0.0.1', 9, 45, 35)
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            if client.pacer is not None:
+                client.pacer.stop()
+        self.ft.sock.close()
+        os.remove(self.path)
+
+    def factory(self, recorder=None):
+        return flaschenvnc.VNCFactory(self.ft, 32, False, None, 0, recorder=recorder)
+
+    def connect(self, factory):
+        client = factory.buildProtocol(IPv4Address('TCP', '127.0.0.1', 5900))
+        client.makeConnection(proto_helpers.StringTransport())
+        self.clients.append(client)
+        return client
+
+    def session(self, factory, server_factory):
+        """connect, get one screen full of random pixels, disconnect.
+           returns the screen."""
+        client = self.connect(factory)
+        server = server_factory.buildProtocol(IPv4Address('TCP', '127.0.0.1', 40000))
+        server.makeConnection(proto_helpers.StringTransport())
+        pump(client, server)
+        server_factory.screen[:] = numpy.random.randint(0, 256, server_factory.screen.shape)
+        server.frame([('update', 0, 0, WIDTH, HEIGHT, rfb.RAW_ENCODING)])
+        pump(client, server)
+        client.connectionLost(None)
+        server.connectionLost(None)
+        return server_factory.screen.copy()
+
+    def testTwoSessions(self):
+        recorder = rfbrecord.Recorder(self.path)
+        factory = self.factory(recorder)
+        server_factory = fakevnc.FakeVNCFactory(WIDTH, HEIGHT)
+        screens = [self.session(factory, server_factory) for i in xrange(2)]
+        recorder.close()
+        self.assertEqual(factory.connections, 2)
+
+        recording = rfbrecord.Recording(self.path)
+        self.assertEqual(len(recording.sessions), 2)
+        factory = self.factory()
+        # the screen every session ended with, the framebuffer itself
+        # carries over to the next one
+        replayed = []
+        def connect():
+            if self.clients:
+                replayed.append(self.clients[-1].fb.array[:, :, :3].copy())
+            return self.connect(factory)
+        del self.clients[:]
+        rfbrecord.replay(recording, connect)
+        replayed.append(self.clients[-1].fb.array[:, :, :3].copy())
+        self.assertEqual(len(replayed), 2)
+        for pixels, screen in zip(replayed, screens):
+            self.assertTrue((pixels == screen).all())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+"""
+Damage limited scaling gives the same LEDs as scaling the whole frame.
+The matrix scalers may be one level off: numpy sums the float32 products
+of a block in a different order than those of the whole frame.
+
+  python -m unittest test_scaler
+
+MIT License
+"""
+
+import unittest, random
+
+import numpy
+
+import scaler, framebuffer
+
+class IncrementalTest(unittest.TestCase):
+
+    def check(self, make, src_size, dst_size, tolerance):
+        """damage random rectangles, and the edges and corners, and
+           compare each damage limited update with a full resize"""
+        rng = random.Random(0)
+        numpy.random.seed(0)
+        width, height = src_size
+        fb = framebuffer.Framebuffer(width, height)
+        fb.array[:] = numpy.random.randint(0, 256, fb.array.shape)
+        s = make(src_size, dst_size)
+        s.update(fb)
+        damage = [(width - 1, height - 1, 1, 1), (0, 0, 1, 1),
+                  (width - 1, 0, 1, height), (0, height - 1, width, 1)]
+        for i in xrange(20):
+            x, y = rng.randrange(width), rng.randrange(height)
+            damage.append((x, y, rng.randrange(1, width - x + 1), rng.randrange(1, height - y + 1)))
+        for x, y, w, h in damage:
+            fb.fill(x, y, w, h, chr(rng.randrange(256)) + chr(rng.randrange(256)) + '\0\0')
+            out = numpy.asarray(s.update(fb, [(x, y, w, h)]), numpy.int16)
+            ref = numpy.asarray(make(src_size, dst_size).update(fb), numpy.int16)
+            self.assertTrue(abs(out - ref).max() <= tolerance, "damage %r, %r -> %r" % ((x, y, w, h), src_size, dst_size))
+
+    def sizes(self, make, tolerance=0):
+        for src_size, dst_size in [((30, 20), (45, 35)),    # upscaling
+                                   ((7, 5), (45, 35)),
+                                   ((300, 200), (45, 35)),  # downscaling
+                                   ((64, 30), (45, 35)),    # both
+                                   ((1920, 1080), (45, 35))]:
+            self.check(make, src_size, dst_size, tolerance)
+
+    def testBilinear(self):
+        self.sizes(lambda src, dst: scaler.RegionScaler(src, dst))
+
+    def testBox(self):
+        self.sizes(lambda src, dst: scaler.MatrixScaler(src, dst, 'box'), 1)
+
+    def testLanczos(self):
+        self.sizes(lambda src, dst: scaler.MatrixScaler(src, dst, 'lanczos'), 1)
+
+if __name__ == '__main__':
+    unittest.main()